@@ -2,14 +2,37 @@ import sys
 import sqlite3
 import requests
 import json
+import math
 import os
 import shutil
 import socket
 import threading
 import re
+import unicodedata
 import csv
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, send_from_directory
+import time
+import queue
+import selectors
+import uuid
+import functools
+import hashlib
+import base64
+import multiprocessing
+import weakref
+import logging
+import atexit
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+from flask import Flask, request, jsonify, send_from_directory, abort, make_response, g
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, make_server
+from werkzeug.wsgi import LimitedStream
+from werkzeug.security import safe_join
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image as PDFImage
 from reportlab.lib import colors
@@ -37,37 +60,860 @@ from PyQt6.QtCore import (QDate, Qt, pyqtSignal, QThread, QSettings, QDir,
 from PyQt6.QtGui import (QAction, QIcon, QColor, QBrush, QTextCharFormat,
                          QPixmap, QImage, QTextCursor, QFileSystemModel)
 
+# ==========================================
+# REGISTRO (LOGS)
+# ==========================================
+# Un logger por parte del programa; el nivel de cada uno se ajusta por separado
+log_servidor = logging.getLogger("mantpro.servidor")
+log_peticiones = logging.getLogger("mantpro.peticiones") # Una línea por petición (apagado por defecto)
+log_bd = logging.getLogger("mantpro.bd")
+log_app = logging.getLogger("mantpro.app")
+
+NIVELES_LOG = {"mantpro": "INFO", "mantpro.peticiones": "WARNING", "werkzeug": "WARNING"}
+LOG_MAX_MB = 5
+LOG_COPIAS = 5
+
+class FormatoJSON(logging.Formatter):
+    """ Una línea JSON por mensaje; los campos 'extra' (ruta, ms, bd_ms...) van como claves propias """
+    ESTANDAR = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        datos = {"ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "nivel": record.levelname, "logger": record.name, "hilo": record.threadName,
+                 "msg": record.getMessage()}
+        for clave, valor in vars(record).items():
+            if clave not in self.ESTANDAR: datos[clave] = valor
+        if record.exc_info: datos["traza"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+_OYENTE_LOG = None
+
+def configurar_logs(carpeta, niveles=None):
+    """
+    Los hilos solo meten el mensaje en una cola; un hilo aparte lo escribe en
+    'carpeta/mantpro.log' (rotando) y en la consola. Así un disco lento no frena
+    las peticiones ni al escritor de BD.
+    """
+    global _OYENTE_LOG
+    if _OYENTE_LOG is not None: return
+    os.makedirs(carpeta, exist_ok=True)
+    fichero = RotatingFileHandler(os.path.join(carpeta, "mantpro.log"), maxBytes=LOG_MAX_MB * 1024 * 1024,
+                                  backupCount=LOG_COPIAS, encoding="utf-8", delay=True)
+    fichero.setFormatter(FormatoJSON())
+    destinos = [fichero]
+    if sys.stderr is not None: # En el .exe sin consola no hay stderr
+        consola = logging.StreamHandler()
+        consola.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s", "%H:%M:%S"))
+        destinos.append(consola)
+    cola = queue.SimpleQueue()
+    raiz = logging.getLogger()
+    raiz.addHandler(QueueHandler(cola))
+    raiz.setLevel(logging.WARNING)
+    aplicar_niveles_log(niveles)
+    _OYENTE_LOG = QueueListener(cola, *destinos, respect_handler_level=True)
+    _OYENTE_LOG.start()
+    atexit.register(detener_logs)
+
+def aplicar_niveles_log(niveles=None):
+    """ 'niveles' como en la variable MANTPRO_LOG o la config 'log_niveles': "bd=DEBUG,peticiones=INFO" """
+    ajustes = dict(NIVELES_LOG)
+    for parte in (niveles or "").split(","):
+        nombre, _, nivel = parte.partition("=")
+        nombre, nivel = nombre.strip(), nivel.strip().upper()
+        if not nombre or logging.getLevelName(nivel) == f"Level {nivel}": continue # Nivel desconocido: se ignora
+        if nombre != "werkzeug" and not nombre.startswith("mantpro"): nombre = f"mantpro.{nombre}"
+        ajustes[nombre] = nivel
+    for nombre, nivel in ajustes.items(): logging.getLogger(nombre).setLevel(nivel)
+
+def detener_logs():
+    """ Vacía la cola de mensajes pendientes; la llama atexit, lo último antes de salir """
+    global _OYENTE_LOG
+    if _OYENTE_LOG is None: return
+    _OYENTE_LOG.stop()
+    _OYENTE_LOG = None
+
+class VersionBD:
+    """
+    Contador en memoria que sube con cada COMMIT que modifica datos (lo hace
+    ConexionVersionada). Es la base de los ETag de la API: si no ha cambiado,
+    se responde 304 sin consultar SQLite.
+    """
+    def __init__(self):
+        self.arranque = uuid.uuid4().hex[:8] # Tras reiniciar el contador vuelve a 0: cambiamos de prefijo
+        self.valor = 0
+        self._cambio = threading.Condition()
+        self._oyentes = []
+
+    def incrementar(self):
+        with self._cambio:
+            self.valor += 1
+            self._cambio.notify_all()
+            oyentes = list(self._oyentes)
+        for oyente in oyentes: oyente()
+
+    def esperar_cambio(self, valor, timeout):
+        """ Bloquea hasta que la versión deje de ser 'valor' (o pase 'timeout'); devuelve la actual """
+        with self._cambio:
+            self._cambio.wait_for(lambda: self.valor != valor, timeout)
+            return self.valor
+
+    def suscribir(self, oyente):
+        # El oyente se llama en el hilo que hizo el COMMIT: tiene que ser instantáneo
+        with self._cambio: self._oyentes.append(oyente)
+
+    def desuscribir(self, oyente):
+        with self._cambio:
+            if oyente in self._oyentes: self._oyentes.remove(oyente)
+
+    def etag(self, extra=""):
+        return f"{self.arranque}-{self.valor}" + (f"-{extra}" if extra else "")
+
+VERSION_BD = VersionBD()
+
+class ConexionVersionada(sqlite3.Connection):
+    """ Conexión que avisa a VERSION_BD cuando un COMMIT ha cambiado algo """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cambios_anotados = 0
+
+    def commit(self):
+        super().commit()
+        self._anotar_commit()
+
+    def __exit__(self, tipo, valor, tb):
+        # 'with conn:' confirma por su cuenta, sin pasar por commit()
+        resultado = super().__exit__(tipo, valor, tb)
+        if tipo is None: self._anotar_commit()
+        return resultado
+
+    def _anotar_commit(self):
+        # total_changes también cuenta lo deshecho con ROLLBACK: en el peor caso
+        # sube la versión sin necesidad, nunca al revés
+        if self.total_changes != self._cambios_anotados:
+            self._cambios_anotados = self.total_changes
+            VERSION_BD.incrementar()
+
+class MetricasServidor:
+    """
+    Métricas por ruta del servidor de sincronización: peticiones por estado, latencias
+    (histograma para Prometheus y últimas muestras para los percentiles del panel),
+    bytes recibidos/enviados y tiempo pasado en la base de datos.
+    """
+    LIMITES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Segundos (buckets 'le')
+    MUESTRAS = 1024 # Latencias recientes que se guardan por ruta
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hilo = threading.local()
+        self.inicio = time.time()
+        self.reiniciar()
+
+    def reiniciar(self):
+        with self._lock:
+            self._rutas = {}
+            self.en_curso = 0
+
+    # --- Tiempo de BD de la petición en curso (por hilo) ---
+    def empezar(self):
+        self._hilo.bd = 0.0
+        with self._lock: self.en_curso += 1
+
+    def sumar_bd(self, segundos):
+        # Fuera de una petición (hilo escritor, difusor, escritorio) no se apunta
+        if getattr(self._hilo, "bd", None) is not None: self._hilo.bd += segundos
+
+    @contextmanager
+    def medir_bd(self):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.sumar_bd(time.perf_counter() - t0)
+
+    def registrar(self, ruta, estado, segundos, bytes_entrada, bytes_salida):
+        bd = getattr(self._hilo, "bd", None) or 0.0
+        self._hilo.bd = None
+        with self._lock:
+            self.en_curso = max(self.en_curso - 1, 0)
+            m = self._rutas.get(ruta)
+            if m is None:
+                m = self._rutas[ruta] = {"estados": {}, "buckets": [0] * len(self.LIMITES), "suma": 0.0, "total": 0,
+                                         "entrada": 0, "salida": 0, "bd": 0.0, "muestras": deque(maxlen=self.MUESTRAS)}
+            clase = f"{estado // 100}xx"
+            m["estados"][clase] = m["estados"].get(clase, 0) + 1
+            for i, limite in enumerate(self.LIMITES):
+                if segundos <= limite: m["buckets"][i] += 1; break
+            m["suma"] += segundos; m["total"] += 1
+            m["entrada"] += bytes_entrada or 0; m["salida"] += bytes_salida or 0
+            m["bd"] += bd
+            m["muestras"].append(segundos)
+        return bd
+
+    def resumen(self):
+        """ Una fila por ruta para el panel del escritorio (latencias en ms) """
+        with self._lock:
+            copia = {ruta: (dict(m["estados"]), m["total"], m["entrada"], m["salida"], m["bd"], sorted(m["muestras"]))
+                     for ruta, m in self._rutas.items()}
+        filas = []
+        for ruta, (estados, total, entrada, salida, bd, muestras) in copia.items():
+            def percentil(p): return muestras[min(int(p * len(muestras)), len(muestras) - 1)] * 1000 if muestras else 0.0
+            errores = estados.get("5xx", 0) + estados.get("4xx", 0)
+            filas.append({"ruta": ruta, "peticiones": total, "errores_pct": 100.0 * errores / total if total else 0.0,
+                          "p50": percentil(0.50), "p95": percentil(0.95), "p99": percentil(0.99),
+                          "entrada": entrada, "salida": salida, "bd_ms": 1000 * bd / total if total else 0.0})
+        return sorted(filas, key=lambda f: f["peticiones"], reverse=True)
+
+    def prometheus(self, extra=None):
+        """ Formato de texto de Prometheus (text/plain; version=0.0.4) """
+        with self._lock:
+            rutas = {ruta: {**m, "estados": dict(m["estados"]), "buckets": list(m["buckets"])} for ruta, m in self._rutas.items()}
+            en_curso = self.en_curso
+        def etiqueta(v): return str(v).replace("\\", "\\\\").replace('"', '\\"')
+        lineas = []
+        def metrica(nombre, tipo, ayuda):
+            lineas.append(f"# HELP {nombre} {ayuda}"); lineas.append(f"# TYPE {nombre} {tipo}")
+        metrica("mantpro_peticiones_total", "counter", "Peticiones atendidas por ruta y clase de estado HTTP.")
+        for ruta, m in rutas.items():
+            for clase, n in sorted(m["estados"].items()):
+                lineas.append(f'mantpro_peticiones_total{{ruta="{etiqueta(ruta)}",estado="{clase}"}} {n}')
+        metrica("mantpro_peticion_segundos", "histogram", "Latencia de las peticiones por ruta.")
+        for ruta, m in rutas.items():
+            acumulado = 0
+            for limite, n in zip(self.LIMITES, m["buckets"]):
+                acumulado += n
+                lineas.append(f'mantpro_peticion_segundos_bucket{{ruta="{etiqueta(ruta)}",le="{limite}"}} {acumulado}')
+            lineas.append(f'mantpro_peticion_segundos_bucket{{ruta="{etiqueta(ruta)}",le="+Inf"}} {m["total"]}')
+            lineas.append(f'mantpro_peticion_segundos_sum{{ruta="{etiqueta(ruta)}"}} {m["suma"]:.6f}')
+            lineas.append(f'mantpro_peticion_segundos_count{{ruta="{etiqueta(ruta)}"}} {m["total"]}')
+        for nombre, campo, ayuda in (("mantpro_bytes_recibidos_total", "entrada", "Bytes de cuerpo recibidos por ruta."),
+                                     ("mantpro_bytes_enviados_total", "salida", "Bytes de cuerpo enviados por ruta."),
+                                     ("mantpro_bd_segundos_total", "bd", "Tiempo dentro de SQLite (incluida la espera de conexión o del escritor) por ruta.")):
+            metrica(nombre, "counter", ayuda)
+            for ruta, m in rutas.items():
+                valor = f"{m[campo]:.6f}" if isinstance(m[campo], float) else m[campo]
+                lineas.append(f'{nombre}{{ruta="{etiqueta(ruta)}"}} {valor}')
+        metrica("mantpro_peticiones_en_curso", "gauge", "Peticiones que se están atendiendo ahora mismo.")
+        lineas.append(f"mantpro_peticiones_en_curso {en_curso}")
+        metrica("mantpro_inicio_segundos", "gauge", "Hora de arranque del servidor (epoch).")
+        lineas.append(f"mantpro_inicio_segundos {self.inicio:.0f}")
+        # extra: {nombre: (valor, ayuda[, tipo])}; 'valor' puede ser {'etiqueta="x"': valor}
+        for nombre, (valor, ayuda, *tipo) in (extra or {}).items():
+            metrica(nombre, tipo[0] if tipo else "gauge", ayuda)
+            if isinstance(valor, dict): lineas.extend(f"{nombre}{{{etiquetas}}} {v}" for etiquetas, v in valor.items())
+            else: lineas.append(f"{nombre} {valor}")
+        return "\n".join(lineas) + "\n"
+
+METRICAS = MetricasServidor()
+
 # Función auxiliar para conectar de forma SEGURA
-def get_db_connection(db_path):
-    conn = sqlite3.connect(db_path, timeout=20) # 20 segundos de espera antes de dar error
+BD_MMAP_MB = 256
+BD_CACHE_MB = 16
+
+def get_db_connection(db_path, timeout=20, check_same_thread=True):
+    # 'timeout' es el busy timeout: segundos de espera antes de dar "database is locked"
+    conn = sqlite3.connect(db_path, timeout=timeout, check_same_thread=check_same_thread, cached_statements=256,
+                           factory=ConexionVersionada)
     conn.row_factory = sqlite3.Row
     # ACTIVAR MODO WAL: Esto es vital para evitar lo que te ha pasado
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
+    # Lecturas desde el fichero mapeado en memoria y más páginas en caché (negativo = KiB)
+    conn.execute(f"PRAGMA mmap_size={BD_MMAP_MB * 1024 * 1024};")
+    conn.execute(f"PRAGMA cache_size=-{BD_CACHE_MB * 1024};")
     return conn
 
-# --- FUNCIÓN PARA REPARAR LA BASE DE DATOS AUTOMÁTICAMENTE ---
-def reparar_base_datos(db_path):
-    print(f"Verificando estructura de BD en: {db_path}")
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+class PoolConexionesBD:
+    """
+    Pool de conexiones SQLite de larga duración para el servidor de sincronización.
+    Cada conexión se abre y se configura una sola vez (WAL, synchronous=NORMAL, busy
+    timeout y caché de sentencias preparadas) y después se presta a cada petición.
+    Con 'tamano' igual al número de hilos del servidor, cada hilo tiene la suya.
+    """
+    def __init__(self, db_path, tamano=8, timeout=20):
+        self.db_path = db_path
+        self.tamano = tamano
+        self.timeout = timeout
+        self._libres = queue.LifoQueue()
+        self._creadas = 0
+        self._generacion = 0   # Sube con cada cerrar(): las conexiones prestadas de antes se descartan al devolverlas
+        self._generacion_de = {}
+        self._lock = threading.Lock()
+
+    def _obtener(self):
+        try: return self._libres.get_nowait()
+        except queue.Empty: pass
+        with self._lock:
+            crear = self._creadas < self.tamano
+            if crear: self._creadas += 1
+        if not crear:
+            # Todas prestadas: esperamos a que se libere una (como mucho el busy timeout)
+            return self._libres.get(timeout=self.timeout)
+        try:
+            conn = get_db_connection(self.db_path, timeout=self.timeout, check_same_thread=False)
+        except Exception:
+            with self._lock: self._creadas -= 1
+            raise
+        with self._lock: self._generacion_de[id(conn)] = self._generacion
+        return conn
+
+    def _descartar(self, conn):
+        conn.close()
+        with self._lock:
+            self._creadas -= 1
+            self._generacion_de.pop(id(conn), None)
+
+    @contextmanager
+    def conexion(self):
+        t0 = time.perf_counter()
+        conn = self._obtener()
+        try:
+            yield conn
+        finally:
+            METRICAS.sumar_bd(time.perf_counter() - t0)
+            # Si la petición falló o se olvidó del commit, no dejamos la transacción abierta
+            try:
+                if conn.in_transaction: conn.rollback()
+                if self._generacion_de.get(id(conn)) != self._generacion: self._descartar(conn)
+                else: self._libres.put(conn)
+            except sqlite3.Error:
+                self._descartar(conn)
+
+    def cerrar(self):
+        """ Cierra las conexiones libres (p.ej. al parar el servidor o tras restaurar un backup) """
+        with self._lock: self._generacion += 1
+        while True:
+            try: conn = self._libres.get_nowait()
+            except queue.Empty: break
+            self._descartar(conn)
+
+class EscritorBD(threading.Thread):
+    """
+    Único hilo que escribe en la base de datos. Escritorio y API le mandan
+    mutaciones (funciones que reciben la conexión) y reciben un Future. Lo que
+    se haya acumulado en la cola se confirma en UNA transacción corta, cada
+    mutación en su SAVEPOINT: si una falla, solo se deshace ella.
+    Así nadie compite por el bloqueo de escritura ni espera al busy timeout.
+    """
+    MAX_GRUPO = 64 # Mutaciones como mucho por transacción (mantiene acotada la latencia)
+    _PARAR = object()
+    _LIBERAR = object()
+
+    def __init__(self, db_path):
+        super().__init__(name="bd-escritor", daemon=True)
+        self.db_path = db_path
+        self._cola = queue.Queue()
+        self._conn = None
+
+    def enviar(self, funcion):
+        """ Encola 'funcion(conn)' y devuelve un Future con su resultado (ya confirmado en disco) """
+        futuro = Future()
+        if threading.current_thread() is self:
+            # Una mutación que lanza otra: va dentro de la misma transacción
+            futuro.set_result(funcion(self._conn))
+            return futuro
+        self._cola.put((funcion, futuro))
+        return futuro
+
+    def ejecutar(self, funcion, timeout=None):
+        with METRICAS.medir_bd(): return self.enviar(funcion).result(timeout)
+
+    def liberar(self):
+        """ Cierra la conexión (p.ej. antes de restaurar un backup); la siguiente mutación la reabre """
+        futuro = Future(); self._cola.put((self._LIBERAR, futuro)); futuro.result()
+
+    def detener(self, timeout=10):
+        # Lo que ya esté en la cola se escribe antes de parar
+        self._cola.put((self._PARAR, None))
+        if self.is_alive(): self.join(timeout)
+
+    def run(self):
+        siguiente = None
+        while True:
+            funcion, futuro = siguiente or self._cola.get(); siguiente = None
+            if funcion is self._PARAR: break
+            if funcion is self._LIBERAR:
+                self._cerrar_conexion(); futuro.set_result(None); continue
+            grupo = [(funcion, futuro)]
+            # Group commit: sin esperar, nos llevamos lo que ya haya en cola
+            while len(grupo) < self.MAX_GRUPO:
+                try: otro = self._cola.get_nowait()
+                except queue.Empty: break
+                if otro[0] is self._PARAR or otro[0] is self._LIBERAR: siguiente = otro; break
+                grupo.append(otro)
+            self._confirmar(grupo)
+        self._cerrar_conexion()
+
+    def _confirmar(self, grupo):
+        hechos = []
+        try:
+            if self._conn is None: self._conn = get_db_connection(self.db_path)
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            for funcion, futuro in grupo:
+                if not futuro.set_running_or_notify_cancel(): continue
+                conn.execute("SAVEPOINT mutacion")
+                try:
+                    resultado = funcion(conn)
+                    conn.execute("RELEASE SAVEPOINT mutacion")
+                    hechos.append((futuro, resultado))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO SAVEPOINT mutacion"); conn.execute("RELEASE SAVEPOINT mutacion")
+                    futuro.set_exception(e)
+            conn.commit()
+            if log_bd.isEnabledFor(logging.DEBUG): log_bd.debug("Grupo confirmado: %d escrituras", len(grupo), extra={"grupo": len(grupo)})
+        except Exception as e:
+            # Falló la transacción entera (disco lleno, BD bloqueada por otro proceso...)
+            log_bd.error("Falló el COMMIT de un grupo de %d escrituras: %s", len(grupo), e)
+            try: self._conn.rollback()
+            except Exception: self._cerrar_conexion()
+            for _, futuro in grupo:
+                if not futuro.done(): futuro.set_exception(e)
+            return
+        # Los resultados se entregan solo cuando el COMMIT ya está hecho
+        for futuro, resultado in hechos: futuro.set_result(resultado)
+
+    def _cerrar_conexion(self):
+        if self._conn is not None:
+            try: self._conn.close()
+            except Exception: pass
+            self._conn = None
+
+_ESCRITORES = {}
+_LOCK_ESCRITORES = threading.Lock()
+
+def obtener_escritor(db_path):
+    """ El escritor de cada fichero de BD es único en todo el proceso """
+    clave = os.path.abspath(db_path)
+    with _LOCK_ESCRITORES:
+        escritor = _ESCRITORES.get(clave)
+        if escritor is None or not escritor.is_alive():
+            escritor = _ESCRITORES[clave] = EscritorBD(clave)
+            escritor.start()
+        return escritor
+
+def detener_escritores():
+    with _LOCK_ESCRITORES: escritores = list(_ESCRITORES.values()); _ESCRITORES.clear()
+    for escritor in escritores: escritor.detener()
+
+class LimitadorConcurrencia:
+    """
+    Semáforo con una cola de espera pequeña y acotada. Si están todos los huecos
+    ocupados y la cola llena (o se agota la espera), la petición se rechaza para
+    que el móvil reintente más tarde en lugar de amontonarse con las demás.
+    """
+    def __init__(self, limite, cola=0, espera=5.0):
+        self.limite = max(1, limite)
+        self.cola = cola
+        self.espera = espera
+        self.activos = 0
+        self.esperando = 0
+        self.rechazadas = 0
+        self._duracion = 1.0 # Media móvil de lo que dura una petición (para Retry-After)
+        self._cond = threading.Condition()
+
+    def entrar(self):
+        with self._cond:
+            # Si ya hay cola, el que llega se pone detrás (nadie se cuela)
+            if self.activos < self.limite and self.esperando == 0:
+                self.activos += 1; return True
+            if self.esperando >= self.cola:
+                self.rechazadas += 1; return False
+            self.esperando += 1
+            try:
+                fin = time.monotonic() + self.espera
+                while self.activos >= self.limite:
+                    restante = fin - time.monotonic()
+                    if restante <= 0:
+                        self.rechazadas += 1; return False
+                    self._cond.wait(restante)
+                self.activos += 1; return True
+            finally:
+                self.esperando -= 1
+
+    def salir(self, duracion):
+        with self._cond:
+            self.activos -= 1
+            self._duracion = 0.8 * self._duracion + 0.2 * duracion
+            self._cond.notify()
+
+    def reintentar_en(self):
+        """ Segundos razonables para el Retry-After: lo que tardaría en vaciarse lo que hay delante """
+        with self._cond: return max(1, math.ceil(self._duracion * (self.esperando + 1) / self.limite))
+
+class FotoDemasiadoGrande(Exception):
+    pass
+
+def copiar_stream_limitado(origen, destino, limite, bloque=64 * 1024, resumen=None):
+    """ Copia por bloques (memoria constante) y corta si se pasa de 'limite' bytes (None = sin límite) """
+    total = 0
+    while True:
+        datos = origen.read(bloque)
+        if not datos: break
+        total += len(datos)
+        if limite is not None and total > limite: raise FotoDemasiadoGrande(f"La foto supera el máximo de {limite // (1024 * 1024)} MB")
+        if resumen is not None: resumen.update(datos)
+        destino.write(datos)
+    return total
 
-    # 1. Intentar añadir columna 'raw_desc' si falta
+# ==========================================
+# ALMACÉN DE FOTOS POR CONTENIDO
+# ==========================================
+# Cada foto se guarda con el SHA-256 de su contenido como nombre: la misma imagen
+# (reenvío del móvil, volver a adjuntarla al editar...) ocupa disco y backup una sola vez.
+# El nombre descriptivo de siempre (app_<fecha>_<original>, pc_edit_...) queda como alias
+# en la tabla 'fotos_alias'.
+def nombre_por_contenido(resumen_hex, nombre_original):
+    ext = os.path.splitext(nombre_original or "")[1].lower()
+    if ext == ".jpeg": ext = ".jpg"
+    if not re.fullmatch(r"\.[a-z0-9]{1,5}", ext): ext = ".jpg"
+    return f"{resumen_hex[:32]}{ext}"
+
+def guardar_foto_por_contenido(origen, carpeta, nombre_original, limite=None, carpeta_temporal=None, normalizador=None):
+    """
+    Guarda 'origen' (ruta o stream) en 'carpeta' con su nombre por contenido.
+    Devuelve (nombre, ruta, nueva, original); 'nueva' es False si esa imagen ya estaba guardada.
+    """
+    resumen = hashlib.sha256()
+    temporal = os.path.join(carpeta_temporal or carpeta, f".{uuid.uuid4().hex}.tmp")
     try:
-        c.execute("ALTER TABLE tareas ADD COLUMN raw_desc TEXT")
-        print("🔧 REPARACIÓN: Columna 'raw_desc' añadida con éxito.")
-    except sqlite3.OperationalError:
-        pass # La columna ya existe, no hacemos nada
+        with open(temporal, 'wb') as destino:
+            if isinstance(origen, str):
+                with open(origen, 'rb') as f: copiar_stream_limitado(f, destino, limite, resumen=resumen)
+            else:
+                copiar_stream_limitado(origen, destino, limite, resumen=resumen)
+        return colocar_foto_por_contenido(temporal, carpeta, nombre_original, resumen.hexdigest(), normalizador)
+    finally:
+        if os.path.exists(temporal): os.remove(temporal)
+
+def resumen_fichero(ruta):
+    resumen = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(64 * 1024), b""): resumen.update(bloque)
+    return resumen.hexdigest()
+
+def colocar_foto_por_contenido(ruta_temporal, carpeta, nombre_original, resumen_hex=None, normalizador=None):
+    """
+    Mueve un fichero ya escrito a su sitio (o lo descarta si la imagen ya existía).
+    Devuelve (nombre, ruta, nueva, original); 'original' es el nombre en el archivo de originales, si lo hay.
+    """
+    original = None
+    if normalizador is not None:
+        ruta_temporal, nombre_original, resumen_hex, original = normalizador.procesar(ruta_temporal, nombre_original, resumen_hex)
+    if resumen_hex is None: resumen_hex = resumen_fichero(ruta_temporal)
+    nombre = nombre_por_contenido(resumen_hex, nombre_original)
+    ruta = os.path.join(carpeta, nombre)
+    nueva = not os.path.exists(ruta)
+    if nueva: os.replace(ruta_temporal, ruta)
+    else: os.remove(ruta_temporal)
+    return nombre, ruta, nueva, original
 
-    # 2. Intentar añadir columna 'foto' si falta (por seguridad)
+# ==========================================
+# NORMALIZACIÓN DE FOTOS AL RECIBIRLAS
+# ==========================================
+# Los móviles mandan JPEG de 8-12 MP que luego el visor, los diálogos, el PDF y el Excel
+# decodifican enteros. Al recibirlas se reducen a un lado máximo, se giran según EXIF y se
+# recodifican; el trabajo de Pillow va a un pool de PROCESOS para no frenar al servidor.
+def normalizar_foto(origen, destino, lado_max, calidad):
+    """ Se ejecuta en un proceso del pool. Devuelve True si ha escrito 'destino' """
     try:
-        c.execute("ALTER TABLE tareas ADD COLUMN foto TEXT")
-        print("🔧 REPARACIÓN: Columna 'foto' añadida con éxito.")
-    except sqlite3.OperationalError:
-        pass
+        from PIL import Image, ImageOps
+    except ImportError:
+        return False # Sin Pillow las fotos se guardan tal cual
+    try:
+        with Image.open(origen) as img:
+            orientacion = img.getexif().get(0x0112, 1)
+            if img.format == "JPEG" and max(img.size) <= lado_max and orientacion in (None, 1):
+                return False # Ya está bien: recodificarla solo perdería calidad
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((lado_max, lado_max))
+            img.convert("RGB").save(destino, "JPEG", quality=calidad, optimize=True, progressive=True)
+        return True
+    except Exception:
+        return False # No es una imagen que Pillow entienda: se guarda tal cual
+
+_POOL_FOTOS = None
+_LOCK_POOL_FOTOS = threading.Lock()
+
+def obtener_pool_fotos():
+    global _POOL_FOTOS
+    with _LOCK_POOL_FOTOS:
+        if _POOL_FOTOS is None:
+            # 'spawn' en todas las plataformas: hacer fork de un proceso con Qt e hilos no es seguro
+            _POOL_FOTOS = ProcessPoolExecutor(max_workers=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                                              mp_context=multiprocessing.get_context("spawn"))
+        return _POOL_FOTOS
+
+def detener_pool_fotos():
+    global _POOL_FOTOS
+    with _LOCK_POOL_FOTOS: pool, _POOL_FOTOS = _POOL_FOTOS, None
+    if pool is not None: pool.shutdown(wait=True, cancel_futures=True)
+
+class NormalizadorFotos:
+    """ Configuración de la etapa de ingesta (tabla config: foto_normalizar, foto_lado_max, foto_calidad, foto_archivar_original) """
+    TIMEOUT = 120
+
+    def __init__(self, lado_max=2048, calidad=85, carpeta_originales=None):
+        self.lado_max = lado_max
+        self.calidad = calidad
+        self.carpeta_originales = carpeta_originales
+
+    @classmethod
+    def desde_config(cls, db, carpeta_fotos):
+        if (db.get_config("foto_normalizar") or "1") != "1": return None
+        originales = None
+        if db.get_config("foto_archivar_original") == "1":
+            # Junto a la carpeta de fotos pero fuera de ella: no entra en los backups
+            originales = os.path.join(os.path.dirname(os.path.abspath(carpeta_fotos)), "fotos_originales")
+        return cls(int(db.get_config("foto_lado_max") or 2048), int(db.get_config("foto_calidad") or 85), originales)
+
+    def procesar(self, temporal, nombre_original, resumen_hex=None):
+        """ Devuelve (ruta, nombre_original, resumen, original) de lo que hay que guardar """
+        normalizada = f"{temporal}.norm.jpg"
+        try:
+            hecho = obtener_pool_fotos().submit(normalizar_foto, temporal, normalizada, self.lado_max, self.calidad).result(self.TIMEOUT)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool): detener_pool_fotos() # El siguiente arranca uno nuevo
+            log_servidor.warning("No se pudo normalizar la foto, se guarda tal cual: %s", e)
+            hecho = False
+        if not hecho:
+            if os.path.exists(normalizada): os.remove(normalizada)
+            return temporal, nombre_original, resumen_hex, None
+        original = None
+        if self.carpeta_originales:
+            os.makedirs(self.carpeta_originales, exist_ok=True)
+            original = nombre_por_contenido(resumen_hex or resumen_fichero(temporal), nombre_original)
+            destino = os.path.join(self.carpeta_originales, original)
+            if not os.path.exists(destino): shutil.move(temporal, destino)
+        if os.path.exists(temporal): os.remove(temporal)
+        return normalizada, f"{os.path.splitext(nombre_original or 'foto')[0]}.jpg", None, original
+
+def anotar_alias_foto(conn, alias, nombre, original=None):
+    """ Apunta el nombre descriptivo de una foto (dentro de una mutación del escritor) """
+    base, ext = os.path.splitext(alias); n = 1
+    while True:
+        actual = conn.execute("SELECT foto FROM fotos_alias WHERE alias=?", (alias,)).fetchone()
+        if actual is None:
+            conn.execute("INSERT INTO fotos_alias (alias, foto, original) VALUES (?,?,?)", (alias, nombre, original))
+            return alias
+        if actual[0] == nombre: return alias
+        # Mismo nombre descriptivo para otra imagen (p.ej. varias 'image.jpg' en el mismo segundo)
+        alias = f"{base}_{n}{ext}"; n += 1
+
+# --- ADJUNTOS DE CADA REGISTRO ---
+# Las marcas [FOTO: x], [FOTO_DESPUES: x] y [REF: n] siguen dentro del texto (el móvil las
+# devuelve tal cual al editar), pero se separan UNA vez, al guardar: el texto limpio y la
+# referencia van a las columnas 'texto' y 'ref', y las fotos a la tabla 'adjuntos'.
+# Pintar listas, exportar o buscar fotos huérfanas ya no analiza texto.
+PATRON_MARCAS = re.compile(r"\[(FOTO_DESPUES|FOTO|REF):\s*(.*?)\]")
+ROLES_FOTO = {"FOTO": "antes", "FOTO_DESPUES": "despues"}
+CAMPO_MARCAS = {"tareas": "descripcion", "pendientes": "detalles"}
+
+def separar_marcas(texto):
+    """ Devuelve (texto_limpio, ref, [(rol, foto), ...]) """
+    ref = None; fotos = []
+    for tipo, valor in PATRON_MARCAS.findall(texto or ""):
+        valor = valor.strip()
+        if tipo == "REF": ref = ref or valor
+        elif valor: fotos.append((ROLES_FOTO[tipo], valor))
+    return PATRON_MARCAS.sub("", texto or "").strip(), ref, fotos
+
+def guardar_adjuntos(conn, tabla, registro_id, fotos):
+    conn.execute("DELETE FROM adjuntos WHERE entidad=? AND registro_id=?", (tabla, registro_id))
+    conn.executemany("INSERT INTO adjuntos (entidad, registro_id, rol, foto) VALUES (?,?,?,?)",
+                     [(tabla, registro_id, rol, foto) for rol, foto in fotos])
+
+def guardar_con_marcas(conn, tabla, valores, registro_id=None):
+    """
+    INSERT en 'tareas'/'pendientes' (o UPDATE de 'registro_id') separando las marcas del texto
+    y, en tareas, indexando sus tags. Devuelve el id de la fila, o None si el UPDATE no encontró ninguna.
+    """
+    valores = dict(valores)
+    texto = valores.get(CAMPO_MARCAS[tabla])
+    fotos = None
+    if texto is not None: valores["texto"], valores["ref"], fotos = separar_marcas(texto)
+    columnas = list(valores)
+    if registro_id is None:
+        registro_id = conn.execute(f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join('?' * len(columnas))})",
+                                   list(valores.values())).lastrowid
+    elif conn.execute(f"UPDATE {tabla} SET {', '.join(f'{c}=?' for c in columnas)} WHERE id=?", [*valores.values(), registro_id]).rowcount == 0:
+        return None
+    if fotos is not None: guardar_adjuntos(conn, tabla, registro_id, fotos)
+    if tabla == "tareas" and "tags" in valores: guardar_tags(conn, registro_id, valores["tags"])
+    return registro_id
+
+# --- ÍNDICE DE TAGS ---
+# 'tareas.tags' es el texto que escribe el usuario ("Eléctrico, Urgente"); 'tareas_tags' guarda una
+# fila por tag con la clave sin acentos ni mayúsculas y otra por cada palabra del tag ("Cuadro Eléctrico"
+# -> "cuadro electrico", "cuadro", "electrico"), para filtrar y contar por tag en la consulta.
+# Se busca por prefijo de la clave (GLOB 'averia*', que usa el índice): "averia" encuentra "Averías".
+# Categorías de las barras del panel: clave de la barra -> prefijos que cuentan para ella
+CATEGORIAS_TAGS = {"electrico": ("electrico",), "mecanico": ("mecanico",),
+                   "preventivo": ("preventivo",), "urgente": ("urgente", "averia")}
+
+def clave_tag(tag):
+    """ "Eléctrico " -> "electrico" """
+    return "".join(c for c in unicodedata.normalize("NFD", tag.strip().casefold()) if not unicodedata.combining(c))
+
+def claves_tags(tags):
+    claves = set()
+    for clave in map(clave_tag, (tags or "").split(",")):
+        if clave: claves.add(clave); claves.update(re.findall(r"\w+", clave))
+    return claves
+
+def patron_tag(tag):
+    """ Patrón GLOB de las claves que empiezan por el tag (los comodines del tag se toman literalmente) """
+    return re.sub(r"([*?\[])", r"[\1]", clave_tag(tag)) + "*"
+
+def guardar_tags(conn, tarea_id, tags):
+    conn.execute("DELETE FROM tareas_tags WHERE tarea_id=?", (tarea_id,))
+    conn.executemany("INSERT INTO tareas_tags (clave, tarea_id) VALUES (?,?)", [(clave, tarea_id) for clave in claves_tags(tags)])
+
+def sql_foto(entidad, rol="antes", alias=None):
+    """ Subconsulta para un SELECT: la primera foto de ese rol de cada fila de 'entidad' """
+    return (f"(SELECT a.foto FROM adjuntos a WHERE a.entidad='{entidad}' AND a.registro_id={alias or entidad}.id"
+            f" AND a.rol='{rol}' ORDER BY a.id LIMIT 1)")
+
+def generar_miniatura(origen, destino, ancho):
+    """ Reduce 'origen' a 'ancho' píxeles (JPEG) y lo deja en 'destino' de forma atómica """
+    from PIL import Image, ImageOps
+    with Image.open(origen) as img:
+        img = ImageOps.exif_transpose(img) # Las fotos del móvil vienen giradas por EXIF
+        img.thumbnail((ancho, ancho * 4))
+        temporal = f"{destino}.{uuid.uuid4().hex}.tmp"
+        try:
+            img.convert("RGB").save(temporal, "JPEG", quality=80, optimize=True)
+            os.replace(temporal, destino)
+        finally:
+            if os.path.exists(temporal): os.remove(temporal)
+
+def codificar_cursor(clave, id_tarea):
+    """ Cursor opaco para la paginación del historial (el móvil no debe interpretarlo).
+        'clave' es la fecha de la última tarea de la página. """
+    return base64.urlsafe_b64encode(json.dumps([clave, id_tarea]).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decodificar_cursor(cursor):
+    if not cursor: return None
+    try:
+        clave, id_tarea = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(clave, str): raise ValueError # Los cursores antiguos de relevancia ya no valen
+        return clave, int(id_tarea)
+    except Exception:
+        raise ValueError("Cursor no válido")
 
-    conn.commit()
-    conn.close()
+def consulta_fts(texto):
+    """ Convierte lo que escribe el usuario en una consulta FTS5 segura: cada palabra como prefijo ("fug"* encuentra "Fuga") """
+    palabras = re.findall(r"\w+", texto or "")
+    return " ".join('"' + p.replace('"', '""') + '"*' for p in palabras)
+
+# ==========================================
+# RECURRENCIA DE AVISOS
+# ==========================================
+# Ocurrencia N de un aviso = inicio + N periodos, calculada directamente (sin avanzar periodo a
+# periodo). Los periodos en meses se cuentan siempre desde el inicio: un aviso del 31 de enero
+# cae el 28/29 de febrero y vuelve al 31 en marzo.
+PERIODOS_AVISO = {"Diario": (1, 0), "Semanal": (7, 0), "Mensual": (0, 1),
+                  "Trimestral": (0, 3), "Semestral": (0, 6), "Anual": (0, 12)} # (días, meses)
+
+def sumar_meses(fecha, meses):
+    """ Mismo día 'meses' después o, si ese mes es más corto, su último día """
+    anio, mes = divmod(fecha.year * 12 + fecha.month - 1 + meses, 12)
+    return fecha.replace(year=anio, month=mes + 1, day=min(fecha.day, monthrange(anio, mes + 1)[1]))
+
+def ocurrencia_aviso(inicio, frecuencia, duracion, fecha):
+    """
+    La ocurrencia que corresponde a 'fecha': la primera cuyo plazo (ocurrencia + duración) no ha
+    terminado antes de 'fecha'. Antes del inicio, o con una frecuencia desconocida, es el inicio.
+    """
+    dias, meses = PERIODOS_AVISO.get(frecuencia or "Anual", (0, 0))
+    limite = fecha - timedelta(days=duracion or 0) # La ocurrencia buscada es la primera >= limite
+    if limite <= inicio or not (dias or meses): return inicio
+    if dias: return inicio + timedelta(days=-(-(limite - inicio).days // dias) * dias)
+    # La del mismo mes que 'limite' (o la anterior del calendario) y, si se queda corta, la siguiente
+    n = ((limite.year - inicio.year) * 12 + limite.month - inicio.month) // meses
+    ocurrencia = sumar_meses(inicio, n * meses)
+    if ocurrencia < limite: ocurrencia = sumar_meses(inicio, (n + 1) * meses)
+    return ocurrencia
+
+def estado_aviso(inicio, frecuencia, duracion, ultima, fecha):
+    """
+    (ocurrencia, fin, activa, completada) del aviso en 'fecha'. Completada: 'ultima_completada'
+    es el día de esa ocurrencia o posterior (el PC guarda el inicio; el móvil, el día en que se hizo).
+    """
+    ocurrencia = ocurrencia_aviso(inicio, frecuencia, duracion, fecha)
+    fin = ocurrencia + timedelta(days=duracion or 0)
+    return ocurrencia, fin, ocurrencia <= fecha <= fin, bool(ultima) and ultima >= ocurrencia.isoformat()
+
+def estados_avisos(avisos, fecha, inicio_por_defecto=None):
+    """
+    Estado de todas las filas (id, titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada)
+    en 'fecha': [(fila, ocurrencia, fin, activa, completada), ...]. Las que no tienen una fecha de
+    inicio válida se omiten, salvo que se dé 'inicio_por_defecto'.
+    """
+    resultado = []
+    for fila in avisos:
+        inicio, frecuencia, duracion, ultima = fila[2:6]
+        try: inicio = date.fromisoformat(inicio) if inicio else inicio_por_defecto
+        except ValueError: inicio = None
+        if inicio is not None: resultado.append((fila, *estado_aviso(inicio, frecuencia, duracion, ultima, fecha)))
+    return resultado
+
+def plazos_aviso(inicio, frecuencia, duracion, desde, hasta):
+    """ Las ocurrencias (ocurrencia, fin) cuyo plazo toca [desde, hasta], en orden """
+    dias, meses = PERIODOS_AVISO.get(frecuencia or "Anual", (0, 0))
+    ocurrencia = ocurrencia_aviso(inicio, frecuencia, duracion, desde) # La primera que no ha terminado antes de 'desde'
+    n = (ocurrencia - inicio).days // dias if dias else ((ocurrencia.year - inicio.year) * 12 + ocurrencia.month - inicio.month) // (meses or 1)
+    plazos = []
+    while ocurrencia <= hasta:
+        fin = ocurrencia + timedelta(days=duracion or 0)
+        if fin >= desde: plazos.append((ocurrencia, fin)) # Con frecuencia desconocida solo existe el inicio
+        if not (dias or meses): break
+        n += 1
+        ocurrencia = inicio + timedelta(days=n * dias) if dias else sumar_meses(inicio, n * meses)
+    return plazos
+
+def plazos_avisos(avisos, desde, hasta):
+    """ [(fila, ocurrencia, fin, completada), ...] de todos los avisos en [desde, hasta], ordenados por fecha """
+    resultado = []
+    for fila in avisos:
+        inicio, frecuencia, duracion, ultima = fila[2:6]
+        try: inicio = date.fromisoformat(inicio) if inicio else None
+        except ValueError: inicio = None
+        if inicio is None: continue
+        resultado.extend((fila, oc, fin, bool(ultima) and ultima >= oc.isoformat()) for oc, fin in plazos_aviso(inicio, frecuencia, duracion, desde, hasta))
+    resultado.sort(key=lambda p: (p[1], p[0][0]))
+    return resultado
+
+def estado_plazo(ocurrencia, completada, hoy):
+    """ 'OK', 'FUTURO' (aún no ha empezado) o 'PENDIENTE' (en curso o vencido sin hacer) """
+    return "OK" if completada else "FUTURO" if ocurrencia > hoy else "PENDIENTE"
+
+class CacheRangosAvisos:
+    """
+    Plazos de los avisos por rango de fechas, calculados una sola vez por rango. La firma es el
+    último cambio de 'avisos_recurrentes' en el registro de cambios (lo rellenan triggers), así que
+    cualquier alta, edición, borrado o aviso completado, desde la app o desde la API, la invalida.
+    """
+    MAX_RANGOS = 32
+    SQL_FIRMA = """SELECT (SELECT MAX(id) FROM cambios WHERE entidad = 'avisos_recurrentes'),
+                          (SELECT valor FROM config WHERE clave = 'cambios_epoca')"""
+
+    def __init__(self):
+        self._rangos = {} # (desde, hasta) -> (firma, plazos); el orden de inserción hace de LRU
+        self._lock = threading.Lock()
+
+    def obtener(self, conn, desde, hasta):
+        # La firma se lee antes que los avisos: si cambian entre medias, la próxima vez no coincidirá
+        firma = tuple(conn.execute(self.SQL_FIRMA).fetchone())
+        clave = (desde, hasta)
+        with self._lock:
+            guardado = self._rangos.pop(clave, None)
+            if guardado and guardado[0] == firma:
+                self._rangos[clave] = guardado
+                return guardado[1]
+        avisos = conn.execute("SELECT id, titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada FROM avisos_recurrentes").fetchall()
+        plazos = plazos_avisos([tuple(a) for a in avisos], desde, hasta)
+        with self._lock:
+            self._rangos[clave] = (firma, plazos)
+            while len(self._rangos) > self.MAX_RANGOS: del self._rangos[next(iter(self._rangos))]
+        return plazos
 
 # ==========================================
 # GESTIÓN DE RUTAS (INTELIGENTE)
@@ -109,7 +955,7 @@ def obtener_ruta_datos():
         try:
             os.makedirs(ruta_sistema)
         except OSError as e:
-            print(f"Error creando directorio de datos: {e}")
+            log_app.error("Error creando directorio de datos: %s", e)
             # Fallback al directorio local si falla (ej. portable)
             return os.path.abspath(".")
 
@@ -207,7 +1053,7 @@ class GeneradorPDFThread(QThread):
                     elements.append(logo)
                     elements.append(Spacer(1, 10))
                 except Exception as e:
-                    print("Error cargando logo:", e)
+                    log_app.warning("Error cargando logo: %s", e)
             # -----------------
 
             elements.append(Paragraph(self.titulo_doc, styles['Title'])); elements.append(Spacer(1, 12))
@@ -215,15 +1061,11 @@ class GeneradorPDFThread(QThread):
             data_tabla = [["FECHA", "DESCRIPCIÓN", "TAGS", "FOTO"]]
             style_cell = styles["BodyText"]; style_cell.fontSize = 9
 
-            for fecha, desc, tags in self.datos:
-                desc_visual = desc
+            for fecha, desc_visual, tags, nombre_foto in self.datos:
                 img_obj = "-"
 
                 # Gestión de FOTO
-                m = re.search(r"\[FOTO:\s*(.*?)\]", desc)
-                if m:
-                    nombre_foto = m.group(1).split("]")[0].strip()
-
+                if nombre_foto:
                     if self.incluir_fotos:
                         ruta_foto = os.path.join(self.carpeta_fotos, nombre_foto)
                         if os.path.exists(ruta_foto):
@@ -237,11 +1079,6 @@ class GeneradorPDFThread(QThread):
                         else: img_obj = "No File"
                     else: img_obj = "SÍ"
 
-                # LIMPIEZA DE ETIQUETAS
-                desc_visual = re.sub(r"\[FOTO:.*?\]", "", desc_visual)
-                desc_visual = re.sub(r"\[REF:.*?\]", "", desc_visual)
-                desc_visual = desc_visual.strip()
-
                 p_desc = Paragraph(desc_visual.replace("\n", "<br/>"), style_cell)
                 p_tags = Paragraph(tags, style_cell)
                 data_tabla.append([fecha, p_desc, p_tags, img_obj])
@@ -395,19 +1232,554 @@ class DialogoQR(QDialog):
         l.addWidget(QLabel(url, alignment=Qt.AlignmentFlag.AlignCenter))
         self.setLayout(l)
 
+class _EntradaVacia:
+    """ rfile falso para el bucle con el que Werkzeug vacía el socket tras cada respuesta """
+    def read(self, *args): return b""
+
+class _SalidaNula:
+    """ wfile falso para una conexión ya entregada a otro hilo (lo que escriba Werkzeug se tira) """
+    closed = False
+    def write(self, datos): return len(datos)
+    def flush(self): pass
+    def close(self): pass
+
+class ManejadorHTTP11(WSGIRequestHandler):
+    """ Manejador con keep-alive HTTP/1.1 y timeout de socket por petición """
+    protocol_version = "HTTP/1.1"
+    max_drenado = 64 * 1024 # Cuerpo sin leer que aceptamos descartar para reutilizar la conexión
+    espera_ociosa = 5 # Segundos que una conexión keep-alive puede tener un hilo esperando la siguiente petición
+
+    def setup(self):
+        # El timeout se aplica al socket: un móvil que se queda colgado a mitad
+        # de subida libera el hilo en vez de bloquearlo para siempre
+        self.timeout = self.server.timeout_peticion
+        super().setup()
+
+    def make_environ(self):
+        environ = super().make_environ()
+        # Envolvemos la entrada para saber cuánto cuerpo ha dejado sin leer la app
+        if not environ.get("wsgi.input_terminated"):
+            try: longitud = int(environ.get("CONTENT_LENGTH") or 0)
+            except ValueError: longitud = 0
+            self._entrada = LimitedStream(self.rfile, longitud)
+            environ["wsgi.input"] = self._entrada
+        # Tras responder, Werkzeug lee "lo que quede" del socket, y con keep-alive eso
+        # sería la siguiente petición. Le damos un rfile vacío mientras dura run_wsgi.
+        self._rfile_real, self.rfile = self.rfile, _EntradaVacia()
+        # Las rutas de larga duración (/api/eventos) pueden quedarse con el socket
+        environ["mantpro.desacoplar"] = self.desacoplar
+        return environ
+
+    def send_header(self, keyword, value):
+        # Werkzeug responde siempre "Connection: close" porque no sabe vaciar el cuerpo
+        # pendiente antes de la siguiente petición; nosotros sí (handle_one_request)
+        if keyword.lower() == "connection" and value.lower() == "close" and self._keep_alive_posible():
+            value = "keep-alive"
+        super().send_header(keyword, value)
+
+    def _keep_alive_posible(self):
+        # Si hay conexiones esperando hilo, esta se cierra al responder y deja sitio
+        return not self.close_connection and not self.server.parando and self._entrada is not None and not self.server.saturado()
+
+    def desacoplar(self, estado, cabeceras):
+        """
+        Envía las cabeceras y entrega el socket a otro dueño (el difusor de eventos).
+        El hilo del pool queda libre: la respuesta que devuelva Flask se descarta.
+        """
+        lineas = [f"{self.protocol_version} {estado}"] + [f"{k}: {v}" for k, v in cabeceras] + ["Connection: close", "", ""]
+        self.connection.sendall("\r\n".join(lineas).encode("latin-1"))
+        self.wfile = _SalidaNula()
+        self.close_connection = True
+        self.server.desacoplar(self.connection)
+        return self.connection
+
+    def parse_request(self):
+        # Ya ha llegado una petición: a partir de aquí la conexión cuenta como ocupada
+        self.server.marcar_ocupada(self.connection, True)
+        self._ociosa = False
+        self.connection.settimeout(self.timeout)
+        return super().parse_request()
+
+    def log_error(self, format, *args):
+        # Que una conexión keep-alive ociosa caduque es normal, no un error
+        if getattr(self, "_ociosa", False) and format.startswith("Request timed out"): return
+        super().log_error(format, *args)
+
+    def handle_one_request(self):
+        self._entrada = None
+        self._rfile_real = None
+        try:
+            super().handle_one_request()
+        finally:
+            if self._rfile_real is not None: self.rfile = self._rfile_real
+            self.server.marcar_ocupada(self.connection, False)
+        if self.close_connection: return
+        entrada = self._entrada
+        if self.server.parando or entrada is None or entrada.limit - entrada.tell() > self.max_drenado:
+            self.close_connection = True
+            return
+        try: entrada.exhaust()
+        except Exception: self.close_connection = True
+        # Esperando la siguiente petición el hilo no hace nada: no lo retenemos mucho
+        self._ociosa = True
+        self.connection.settimeout(min(self.espera_ociosa, self.timeout))
+
+class ServidorWSGIPool(BaseWSGIServer):
+    """
+    Servidor WSGI de producción: pool fijo de hilos, keep-alive y parada limpia.
+    A diferencia del servidor de desarrollo de Werkzeug (un hilo nuevo por conexión,
+    sin límite), aquí como mucho hay 'hilos' peticiones atendiéndose a la vez y el
+    resto esperan en la cola del socket.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, hilos=16, timeout=30):
+        self.timeout_peticion = timeout
+        self.parando = False
+        self.pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="sync-http")
+        self._conexiones = set()
+        self._ocupadas = set()
+        self._desacopladas = set()
+        self._sin_hilo = 0 # Conexiones aceptadas que aún esperan un hilo libre
+        self._lock_conexiones = threading.Lock()
+        super().__init__(host, port, app, handler=ManejadorHTTP11)
+
+    def process_request(self, request, client_address):
+        with self._lock_conexiones: self._conexiones.add(request); self._sin_hilo += 1
+        self.pool.submit(self._atender, request, client_address)
+
+    def saturado(self):
+        return self._sin_hilo > 0
+
+    def _atender(self, request, client_address):
+        with self._lock_conexiones: self._sin_hilo -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def marcar_ocupada(self, sock, ocupada):
+        with self._lock_conexiones:
+            if ocupada: self._ocupadas.add(sock)
+            else: self._ocupadas.discard(sock)
+
+    def desacoplar(self, sock):
+        # A partir de aquí el socket es de otro: ni se espera por él ni se cierra al terminar
+        with self._lock_conexiones:
+            self._conexiones.discard(sock); self._ocupadas.discard(sock); self._desacopladas.add(sock)
+
+    def shutdown_request(self, request):
+        with self._lock_conexiones:
+            self._conexiones.discard(request); self._ocupadas.discard(request)
+            if request in self._desacopladas: self._desacopladas.discard(request); return
+        super().shutdown_request(request)
+
+    def server_close(self, gracia=5):
+        self.parando = True
+        super().server_close()
+        # 1. Damos un margen a las peticiones en curso para terminar
+        limite = time.monotonic() + gracia
+        while time.monotonic() < limite:
+            with self._lock_conexiones:
+                if not self._ocupadas: break
+            time.sleep(0.1)
+        # 2. Lo que quede (conexiones keep-alive ociosas o colgadas) se corta
+        with self._lock_conexiones: restantes = list(self._conexiones)
+        for sock in restantes:
+            try: sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+def evento_cambios(conn, desde, epoca=None, max_cambios=100):
+    """
+    Mensaje SSE con lo cambiado después del cursor 'desde' (o None si no hay nada).
+    Devuelve (mensaje, nuevo_cursor, epoca). Si el cursor ya no sirve (registro podado
+    o copia restaurada) el evento es 'reset' y el móvil debe recargar las listas.
+    """
+    config = dict(conn.execute("SELECT clave, valor FROM config WHERE clave IN ('cambios_epoca', 'cambios_minimo')").fetchall())
+    fila = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='cambios'").fetchone()
+    actual = fila[0] if fila else 0
+    epoca_actual = config.get('cambios_epoca', '')
+    datos = {"version": VERSION_BD.etag(), "epoca": epoca_actual, "cursor": actual}
+    if (desde is None or desde < int(config.get('cambios_minimo') or 0) or desde > actual
+            or (epoca is not None and epoca != epoca_actual)):
+        return f"event: reset\nid: {actual}\ndata: {json.dumps(datos)}\n\n".encode("utf-8"), actual, epoca_actual
+    if desde == actual: return None, actual, epoca_actual
+    marcas = ",".join("?" * len(TABLAS_SINCRONIZADAS))
+    filas = conn.execute(f"""SELECT entidad, entidad_id, tipo FROM cambios WHERE id IN (
+                                 SELECT MAX(id) FROM cambios WHERE id > ? AND entidad IN ({marcas}) GROUP BY entidad, entidad_id)
+                             ORDER BY id LIMIT ?""", (desde, *TABLAS_SINCRONIZADAS, max_cambios + 1)).fetchall()
+    if not filas: return None, actual, epoca_actual
+    # Solo avisamos de QUÉ ha cambiado; los datos se piden a /api/cambios?since=<cursor anterior>
+    datos["mas"] = len(filas) > max_cambios
+    datos["cambios"] = [{"entidad": e, "id": i, "tipo": t} for e, i, t in filas[:max_cambios]]
+    return f"event: cambios\nid: {actual}\ndata: {json.dumps(datos)}\n\n".encode("utf-8"), actual, epoca_actual
+
+class DifusorEventos(threading.Thread):
+    """
+    Canal push (Server-Sent Events) para los móviles. Todas las suscripciones
+    viven en UN solo hilo con un selector: cada móvil conectado es un socket
+    ocioso, no un hilo del pool bloqueado. Cuando un COMMIT cambia la versión
+    de la BD, se consulta el registro de cambios una vez y se reparte a todos.
+    """
+    LATIDO = 25             # s. Comentario SSE para que routers/NAT no corten la conexión
+    MAX_CLIENTES = 500
+    MAX_PENDIENTE = 256 * 1024 # Un móvil que no lee tanto se desconecta
+
+    def __init__(self, db_path):
+        super().__init__(name="sync-eventos", daemon=True)
+        self.db_path = db_path
+        self._selector = selectors.DefaultSelector()
+        self._despertar_r, self._despertar_w = socket.socketpair()
+        self._despertar_r.setblocking(False); self._despertar_w.setblocking(False)
+        self._nuevos = queue.Queue()
+        self._clientes = {} # socket -> bytearray con lo pendiente de enviar
+        self._parar = False
+        # Restaurar una copia: el hilo cierra su conexión (y con ella el WAL del fichero viejo) hasta que se le diga
+        self._soltar_bd = threading.Event()
+        self._bd_soltada = threading.Event()
+
+    # --- Llamadas desde otros hilos ---
+    def agregar(self, sock, desde=None):
+        if len(self._clientes) >= self.MAX_CLIENTES: return False
+        self._nuevos.put((sock, desde)); self.avisar()
+        return True
+
+    def avisar(self):
+        try: self._despertar_w.send(b"x")
+        except (BlockingIOError, OSError): pass # Ya hay un aviso pendiente
+
+    def detener(self):
+        self._parar = True; self.avisar()
+        if self.is_alive(): self.join(5)
+
+    def liberar_bd(self, timeout=5):
+        """ Cierra la conexión del difusor y espera a que esté cerrada (antes de sobrescribir la BD) """
+        self._soltar_bd.set(); self.avisar()
+        if self.is_alive(): self._bd_soltada.wait(timeout)
+
+    def reanudar_bd(self):
+        """ Vuelve a abrir la BD; los suscritos reciben un 'reset' si la época ha cambiado """
+        self._soltar_bd.clear(); self.avisar()
+
+    @property
+    def suscriptores(self): return len(self._clientes)
+
+    # --- Hilo del difusor ---
+    def run(self):
+        VERSION_BD.suscribir(self.avisar)
+        self._selector.register(self._despertar_r, selectors.EVENT_READ)
+        conn = None; cursor = epoca = None; aviso = False
+        try:
+            proximo_latido = time.monotonic() + self.LATIDO
+            while not self._parar:
+                if self._soltar_bd.is_set():
+                    if conn is not None: conn.close(); conn = None
+                    self._bd_soltada.set()
+                elif conn is None:
+                    conn = get_db_connection(self.db_path); self._bd_soltada.clear()
+                    if cursor is None: _, cursor, epoca = evento_cambios(conn, None)
+                    else: aviso = True # Puede ser otra BD: se comprueba la época enseguida
+                for clave, mascara in self._selector.select(timeout=max(0, proximo_latido - time.monotonic())):
+                    sock = clave.fileobj
+                    if sock is self._despertar_r:
+                        try:
+                            while self._despertar_r.recv(4096): pass
+                        except (BlockingIOError, OSError): pass
+                        aviso = True
+                    elif mascara & selectors.EVENT_READ and not self._leer(sock): self._cerrar(sock)
+                    elif mascara & selectors.EVENT_WRITE: self._vaciar(sock)
+                if self._parar: break
+                if time.monotonic() >= proximo_latido:
+                    for sock in list(self._clientes): self._enviar(sock, b": latido\n\n")
+                    proximo_latido = time.monotonic() + self.LATIDO
+                if conn is None: continue # Sin BD: los avisos y las altas esperan a reanudar_bd()
+
+                while not self._nuevos.empty():
+                    sock, desde = self._nuevos.get_nowait()
+                    self._alta(sock)
+                    if desde is not None and desde != cursor:
+                        # Reconexión (Last-Event-ID): se le manda lo que se perdió
+                        mensaje, _, _ = evento_cambios(conn, desde)
+                        if mensaje: self._enviar(sock, mensaje)
+
+                if aviso:
+                    mensaje, cursor, epoca = evento_cambios(conn, cursor, epoca)
+                    if mensaje:
+                        for sock in list(self._clientes): self._enviar(sock, mensaje)
+                    aviso = False
+        except Exception as e:
+            log_servidor.exception("Error en el difusor de eventos: %s", e)
+        finally:
+            VERSION_BD.desuscribir(self.avisar)
+            for sock in list(self._clientes): self._cerrar(sock)
+            if conn is not None: conn.close()
+            self._selector.close()
+            self._despertar_r.close(); self._despertar_w.close()
+
+    def _alta(self, sock):
+        try:
+            sock.setblocking(False)
+            self._clientes[sock] = bytearray()
+            self._selector.register(sock, selectors.EVENT_READ) # Solo para enterarnos de que se ha ido
+            self._enviar(sock, b"retry: 5000\n: conectado\n\n")
+        except (OSError, ValueError):
+            self._cerrar(sock)
+
+    def _leer(self, sock):
+        # El móvil no manda nada por aquí: leer 0 bytes significa que ha cerrado
+        try: return bool(sock.recv(4096))
+        except BlockingIOError: return True
+        except OSError: return False
+
+    def _enviar(self, sock, datos):
+        pendiente = self._clientes.get(sock)
+        if pendiente is None: return
+        pendiente += datos
+        if len(pendiente) > self.MAX_PENDIENTE: self._cerrar(sock); return
+        self._vaciar(sock)
+
+    def _vaciar(self, sock):
+        pendiente = self._clientes.get(sock)
+        if pendiente is None: return
+        try:
+            enviados = sock.send(pendiente)
+            del pendiente[:enviados]
+        except BlockingIOError: pass
+        except OSError: self._cerrar(sock); return
+        # Si no cabe todo en el buffer del socket, esperamos a que se pueda escribir
+        eventos = selectors.EVENT_READ | (selectors.EVENT_WRITE if pendiente else 0)
+        try: self._selector.modify(sock, eventos)
+        except (KeyError, ValueError): pass
+
+    def _cerrar(self, sock):
+        self._clientes.pop(sock, None)
+        try: self._selector.unregister(sock)
+        except (KeyError, ValueError): pass
+        try: sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        try: sock.close()
+        except OSError: pass
+
 class ServidorSincronizacion(QThread):
     registro_recibido = pyqtSignal(str, str, str, str, str)
     pendiente_actualizado = pyqtSignal()
 
-    def __init__(self, carpeta_destino, db_path):
+    MODOS_SERVIDOR = ("produccion", "desarrollo")
+    MAX_REGISTROS_LOTE = 100
+    ANCHOS_MINIATURA = (128, 256, 512, 1024)
+    PAGINA_HISTORIAL = 50
+    MAX_PAGINA_HISTORIAL = 200
+    MAX_DIAS_RANGO_AVISOS = 400 # /api/avisos/rango: hasta un año (con margen) por petición
+    COLORES_ESTADO_AVISO = {"OK": "green", "PENDIENTE": "red", "FUTURO": "blue"}
+    MAX_MB_MINIATURAS = 200
+    # Peticiones simultáneas por clase (configurables); lo que pase de ahí espera en una cola corta o recibe 503
+    LIMITES_CONCURRENCIA = {"subidas": 4, "lecturas": 12, "fotos": 6}
+    COLA_ESPERA = 8
+    SEGUNDOS_ESPERA = 5
+    PETICION_LENTA = 2.0 # Segundos a partir de los que una petición se anota como aviso
+    MAX_FOTOS_LOTE = 20 # Limita el tamaño de la petición de /api/upload_batch (fotos x tamaño máximo)
+    # Columnas de una tarea para el móvil (ver _tarea_json): texto limpio y fotos ya separados
+    COLUMNAS_TAREA = (f"t.id, t.fecha, t.descripcion, t.tags, COALESCE(t.texto, t.descripcion), "
+                      f"{sql_foto('tareas', 'antes', 't')}, {sql_foto('tareas', 'despues', 't')}")
+    # Mismas columnas que usan /api/historial, /api/pendientes y /api/avisos
+    SQL_FILAS_SINCRONIZADAS = {
+        "tareas": f"SELECT {COLUMNAS_TAREA} FROM tareas t",
+        "pendientes": "SELECT id, titulo, detalles FROM pendientes",
+        "avisos_recurrentes": "SELECT id, titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada FROM avisos_recurrentes",
+    }
+
+    def __init__(self, carpeta_destino, db_path, modo="produccion", hilos=16, timeout=30, max_foto_mb=25, normalizador=None,
+                 limites=None, cola_espera=None):
         super().__init__()
         self.carpeta_destino = carpeta_destino
+        self.normalizador = normalizador # NormalizadorFotos o None (fotos tal cual llegan)
+        # Las subidas a medias viven junto a fotos_recibidas (mismo disco => os.replace atómico)
+        self.carpeta_subidas = os.path.join(os.path.dirname(os.path.abspath(carpeta_destino)), "subidas_parciales")
+        os.makedirs(self.carpeta_subidas, exist_ok=True)
+        self._limpiar_subidas_caducadas()
+        self._lock_subidas = threading.Lock()
+        self._cerrojos_subida = weakref.WeakValueDictionary() # id de subida -> Lock (mientras alguien lo use)
+        self.max_foto_bytes = max_foto_mb * 1024 * 1024
+        # Caché de miniaturas en disco (también junto a fotos_recibidas, fuera de los backups)
+        self.carpeta_miniaturas = os.path.join(os.path.dirname(os.path.abspath(carpeta_destino)), "miniaturas")
+        os.makedirs(self.carpeta_miniaturas, exist_ok=True)
+        self.max_miniaturas_bytes = self.MAX_MB_MINIATURAS * 1024 * 1024
+        self._bytes_miniaturas = None
+        self._lock_miniaturas = threading.Lock()
         self.db_path = db_path
         self.app = Flask(__name__)
         self.server_port = 5000
+        self.modo = modo if modo in self.MODOS_SERVIDOR else "produccion"
+        self.hilos = hilos
+        self.timeout = timeout
+        self.servidor_http = None
+        self.pool_bd = PoolConexionesBD(db_path, tamano=hilos) # Solo lecturas
+        self.escritor = obtener_escritor(db_path)               # Todas las escrituras
+        self.rangos_avisos = CacheRangosAvisos()
+        self.difusor = DifusorEventos(db_path)
+        with self.pool_bd.conexion() as conn:
+            self.usar_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name='tareas_fts'").fetchone() is not None
+        self._detenido = False
+        self._lock_arranque = threading.Lock()
+        # Claves de idempotencia cuya petición se está atendiendo ahora mismo
+        self._claves_en_curso = {}
+        self._lock_idempotencia = threading.Lock()
+        self._ultima_poda_idempotencia = 0
+        limites = {**self.LIMITES_CONCURRENCIA, **(limites or {})}
+        cola = self.COLA_ESPERA if cola_espera is None else cola_espera
+        self.limitadores = {clase: LimitadorConcurrencia(n, cola, self.SEGUNDOS_ESPERA) for clase, n in limites.items()}
+
+        @self.app.before_request
+        def empezar_metricas():
+            g.inicio_peticion = time.perf_counter()
+            METRICAS.empezar()
+
+        @self.app.after_request
+        def registrar_metricas(resp):
+            # La plantilla de la ruta (no la URL) para no crear una serie por cada foto o ID
+            ruta = request.url_rule.rule if request.url_rule else "(sin ruta)"
+            # Con un cuerpo en streaming (SSE, ficheros) no se puede calcular la longitud sin consumirlo
+            salida = resp.content_length if resp.content_length is not None or resp.is_streamed else resp.calculate_content_length()
+            segundos = time.perf_counter() - g.inicio_peticion
+            bd = METRICAS.registrar(ruta, resp.status_code, segundos, request.content_length, salida)
+            g.metricas_registradas = True
+            # Con el nivel por defecto solo se escriben los errores 5xx y las peticiones lentas
+            lenta = resp.status_code >= 500 or segundos >= self.PETICION_LENTA
+            if lenta or log_peticiones.isEnabledFor(logging.INFO):
+                log_peticiones.log(logging.WARNING if lenta else logging.INFO, "%s %s -> %s en %.1f ms",
+                                   request.method, ruta, resp.status_code, segundos * 1000,
+                                   extra={"metodo": request.method, "ruta": ruta, "estado": resp.status_code,
+                                          "ms": round(segundos * 1000, 1), "bd_ms": round(bd * 1000, 1),
+                                          "entrada": request.content_length, "salida": salida,
+                                          "cliente": request.remote_addr})
+            return resp
+
+        @self.app.teardown_request
+        def cerrar_metricas(error):
+            # Excepción no capturada: Flask responde 500 sin pasar por after_request
+            if "inicio_peticion" in g and not g.get("metricas_registradas"):
+                ruta = request.url_rule.rule if request.url_rule else "(sin ruta)"
+                segundos = time.perf_counter() - g.inicio_peticion
+                METRICAS.registrar(ruta, 500, segundos, request.content_length, 0)
+                log_peticiones.error("%s %s -> excepción no capturada en %.1f ms: %s", request.method, ruta, segundos * 1000, error,
+                                     extra={"metodo": request.method, "ruta": ruta, "estado": 500, "ms": round(segundos * 1000, 1)})
+
+        @self.app.before_request
+        def limitar_tamano_peticion():
+            # Rechazamos antes de leer nada si el cuerpo declarado ya es demasiado grande
+            longitud = request.content_length
+            if longitud and longitud > self._limite_peticion(request.endpoint): abort(413)
+
+        @self.app.before_request
+        def limitar_concurrencia():
+            clase = self._clase_peticion(request.endpoint, request.method)
+            if clase is None: return None
+            limitador = self.limitadores[clase]
+            if not limitador.entrar():
+                resp = jsonify({"status": "error", "message": "Servidor ocupado, reintenta en unos segundos"})
+                resp.status_code = 503
+                resp.headers['Retry-After'] = str(limitador.reintentar_en())
+                return resp
+            g.limitador = (limitador, time.perf_counter())
+
+        @self.app.after_request
+        def soltar_limitador(resp):
+            if "limitador" not in g: return resp
+            limitador, inicio = g.pop("limitador")
+            if resp.direct_passthrough or resp.is_streamed:
+                # Las fotos se envían después de salir de la vista: el hueco se suelta al terminar de enviarlas.
+                # Con direct_passthrough Werkzeug entrega el fichero tal cual y no llamaría a call_on_close.
+                resp.direct_passthrough = False
+                resp.call_on_close(functools.partial(self._soltar_limitador, limitador, inicio))
+            else:
+                self._soltar_limitador(limitador, inicio) # Respuesta ya hecha en memoria
+            return resp
+
+        @self.app.teardown_request
+        def soltar_limitador_error(error):
+            # Excepción no capturada: after_request no ha llegado a ejecutarse
+            if "limitador" in g: self._soltar_limitador(*g.pop("limitador"))
+
+        def respuesta_condicional(por_dia=False):
+            """ ETag a partir de VERSION_BD: si el móvil ya tiene esta versión, 304 sin tocar SQLite """
+            def decorador(vista):
+                @functools.wraps(vista)
+                def envoltorio(*args, **kwargs):
+                    # El ETag se calcula ANTES de consultar: si algo cambia mientras tanto, la próxima no coincidirá.
+                    # Algunas respuestas dependen también del día (estado de avisos, registros del mes) y todas
+                    # de los parámetros (?cursor=, ?since=, ?desde=...): cada página tiene su propio ETag.
+                    partes = [datetime.now().strftime("%Y%m%d")] if por_dia else []
+                    if request.args:
+                        consulta = json.dumps(sorted(request.args.items(multi=True)), ensure_ascii=False)
+                        partes.append(hashlib.sha1(consulta.encode("utf-8")).hexdigest()[:16])
+                    etag = VERSION_BD.etag("-".join(partes))
+                    if request.if_none_match.contains_weak(etag):
+                        resp = self.app.response_class(status=304)
+                    else:
+                        resp = make_response(vista(*args, **kwargs))
+                        if resp.status_code != 200: return resp
+                    resp.set_etag(etag)
+                    resp.headers['Cache-Control'] = 'no-cache' # Guardar sí, pero preguntando siempre
+                    return resp
+                return envoltorio
+            return decorador
+
+        def idempotente(vista):
+            """
+            Con 'Idempotency-Key' (cabecera o campo 'idempotency_key') un reintento tras un timeout
+            devuelve la respuesta guardada de la primera vez en lugar de volver a escribir.
+            """
+            @functools.wraps(vista)
+            def envoltorio(*args, **kwargs):
+                clave = self._clave_idempotencia()
+                g.clave_idempotencia = clave
+                if clave is None: return vista(*args, **kwargs) # Móviles antiguos: sin protección
+                if len(clave) > 128: return jsonify({"status": "error", "message": "Idempotency-Key demasiado larga"}), 400
+
+                # Si otro hilo atiende ya esta misma clave (reintento impaciente), esperamos su resultado
+                while True:
+                    guardada = self._respuesta_guardada(clave, request.endpoint)
+                    if guardada is not None: return guardada
+                    with self._lock_idempotencia:
+                        en_curso = self._claves_en_curso.get(clave)
+                        if en_curso is None:
+                            propio = self._claves_en_curso[clave] = threading.Event()
+                            break
+                    if not en_curso.wait(self.timeout):
+                        return jsonify({"status": "error", "message": "Petición en curso"}), 409
+
+                guardando = False
+                try:
+                    resp = make_response(vista(*args, **kwargs))
+                    # Los 5xx no se guardan: el reintento tiene que poder funcionar. Si la petición escribió,
+                    # su respuesta ya está guardada en la misma transacción (ver _escribir_peticion)
+                    if resp.status_code < 500 and not resp.is_streamed and not g.get("respuesta_guardada"):
+                        futuro = self._guardar_respuesta(clave, request.endpoint, resp)
+                        futuro.add_done_callback(lambda _: self._liberar_clave(clave, propio))
+                        guardando = True
+                    return resp
+                finally:
+                    if not guardando: self._liberar_clave(clave, propio)
+            return envoltorio
+
+        @self.app.route('/api/metrics', methods=['GET'])
+        def api_metrics():
+            extra = {"mantpro_version_bd": (VERSION_BD.valor, "Versión de la base de datos (sube con cada cambio)."),
+                     "mantpro_eventos_suscriptores": (self.difusor.suscriptores, "Móviles suscritos a /api/eventos."),
+                     "mantpro_concurrencia_activas": ({f'clase="{c}"': l.activos for c, l in self.limitadores.items()},
+                                                      "Peticiones en curso por clase de límite."),
+                     "mantpro_concurrencia_esperando": ({f'clase="{c}"': l.esperando for c, l in self.limitadores.items()},
+                                                        "Peticiones en la cola de espera por clase."),
+                     "mantpro_rechazadas_503_total": ({f'clase="{c}"': l.rechazadas for c, l in self.limitadores.items()},
+                                                      "Peticiones rechazadas por saturación (503).", "counter")}
+            return self.app.response_class(METRICAS.prometheus(extra), mimetype="text/plain; version=0.0.4")
 
         # --- RUTAS EXISTENTES ---
         @self.app.route('/api/upload', methods=['POST'])
+        @idempotente
         def api_upload():
             try:
                 titulo = request.form.get('titulo', 'Sin Título')
@@ -425,42 +1797,216 @@ class ServidorSincronizacion(QThread):
                 filename, ruta_local = self._procesar_foto(request, 'foto')
                 filename_d, _ = self._procesar_foto(request, 'foto_despues')
                 raw_desc = ruta_local if ruta_local else detalles
+                desc_final = self._descripcion_tarea(titulo, detalles, filename, filename_d)
 
-                # --- FIX: CREAR LA DESCRIPCIÓN COMPLETA CON TÍTULO Y FOTO ---
-                desc_final = titulo
-                if detalles:
-                    desc_final += f"\n{detalles}"
-                if filename:
-                    desc_final += f"\n[FOTO: {filename}]"
-                if filename_d:
-                    desc_final += f"\n[FOTO_DESPUES: {filename_d}]"
-
-                # Usamos el bloque with para asegurar el guardado
-                with get_db_connection(self.db_path) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('INSERT INTO tareas (fecha, descripcion, tags, raw_desc, foto) VALUES (?,?,?,?,?)',
-                                   (fecha_final, desc_final, tags, raw_desc, filename))
-                    conn.commit()
+                self._escribir_peticion(lambda conn: guardar_con_marcas(conn, "tareas", {"fecha": fecha_final, "descripcion": desc_final, "tags": tags,
+                                                                                         "raw_desc": raw_desc, "foto": filename}))
 
                 # Emitimos la señal pasando el título correcto para la notificación
                 self.registro_recibido.emit(titulo, detalles, tags, raw_desc if raw_desc else "", filename if filename else "")
                 return jsonify({"status": "ok"})
             except Exception as e:
-                print(f"Error api_upload: {e}")
+                log_servidor.exception("Error api_upload: %s", e)
+                return jsonify({"status": "error", "message": str(e)}), 500
+
+        # ==========================================
+        # --- SUBIDA EN LOTE (SINCRONIZACIÓN OFFLINE) ---
+        # ==========================================
+        # Campo 'registros' = JSON con una lista de objetos:
+        #   {"id_cliente", "titulo", "detalles", "tags", "fecha",
+        #    "foto": <nombre del campo de fichero>, "foto_despues": ..., "foto_subida": <id>, ...}
+        # Todo se inserta en UNA transacción; cada registro va en su SAVEPOINT para que
+        # uno malo no tumbe al resto. La respuesta dice registro a registro qué entró.
+        @self.app.route('/api/upload_batch', methods=['POST'])
+        @idempotente
+        def api_upload_batch():
+            try:
+                datos = request.get_json(silent=True) if request.is_json else None
+                registros = datos.get('registros') if isinstance(datos, dict) else json.loads(request.form.get('registros') or '[]')
+                if not isinstance(registros, list): return jsonify({"status": "error", "message": "'registros' debe ser una lista"}), 400
+                if len(registros) > self.MAX_REGISTROS_LOTE:
+                    return jsonify({"status": "error", "message": f"Máximo {self.MAX_REGISTROS_LOTE} registros por lote"}), 413
+            except ValueError as e:
+                return jsonify({"status": "error", "message": f"JSON no válido: {e}"}), 400
+
+            # 1. Fotos y validación fuera de la transacción (el escritor no espera al disco de nadie)
+            resultados = []; preparados = []
+            for i, reg in enumerate(registros):
+                id_cliente = reg.get('id_cliente', i) if isinstance(reg, dict) else i
+                fotos_guardadas = []
+                try:
+                    if not isinstance(reg, dict): raise ValueError("El registro no es un objeto")
+                    titulo = reg.get('titulo') or 'Sin Título'
+                    detalles = reg.get('detalles') or ''
+                    tags = reg.get('tags') or 'General'
+                    fecha_final = reg.get('fecha') or datetime.now().strftime("%Y-%m-%d")
+
+                    filename, ruta_local = self._foto_de_lote(reg, 'foto'); fotos_guardadas.append(ruta_local)
+                    filename_d, ruta_d = self._foto_de_lote(reg, 'foto_despues'); fotos_guardadas.append(ruta_d)
+                    raw_desc = ruta_local if ruta_local else detalles
+                    desc_final = self._descripcion_tarea(titulo, detalles, filename, filename_d)
+                    # Los alias de sus fotos van con el registro: se apuntan en su SAVEPOINT, o no se apuntan
+                    preparados.append((len(resultados), {"fecha": fecha_final, "descripcion": desc_final, "tags": tags,
+                                                         "raw_desc": raw_desc, "foto": filename}, fotos_guardadas,
+                                       g.pop("alias_fotos", []), g.pop("subidas_usadas", [])))
+                    resultados.append({"id_cliente": id_cliente, "status": "ok"})
+                except Exception as e:
+                    g.pop("alias_fotos", None); g.pop("subidas_usadas", None) # Sus subidas siguen ahí para el reintento
+                    self._borrar_fotos(fotos_guardadas)
+                    resultados.append({"id_cliente": id_cliente, "status": "error", "message": str(e)})
+
+            # 2. Todas las inserciones en una transacción, cada registro en su SAVEPOINT
+            def insertar(conn):
+                ids = {}
+                for pos, fila, _, alias_fotos, _ in preparados:
+                    conn.execute("SAVEPOINT registro")
+                    try:
+                        for alias, filename, original in alias_fotos: anotar_alias_foto(conn, alias, filename, original)
+                        ids[pos] = guardar_con_marcas(conn, "tareas", fila)
+                        conn.execute("RELEASE SAVEPOINT registro")
+                    except sqlite3.Error as e:
+                        conn.execute("ROLLBACK TO SAVEPOINT registro"); conn.execute("RELEASE SAVEPOINT registro")
+                        ids[pos] = e
+                return ids
+
+            def respuesta(ids):
+                # Sale del resultado de la transacción (y, con Idempotency-Key, se guarda en ella)
+                filas = [dict(r) for r in resultados]
+                for pos, *_ in preparados:
+                    if isinstance(ids[pos], Exception): filas[pos].update(status="error", message=str(ids[pos]))
+                    else: filas[pos]["id"] = ids[pos]
+                return {"status": "ok", "insertados": sum(f["status"] == "ok" for f in filas), "resultados": filas}
+            try:
+                ids = self._escribir_peticion(insertar, respuesta) if preparados else {}
+            except Exception as e:
+                for _, _, fotos, *_ in preparados: self._borrar_fotos(fotos)
+                log_servidor.exception("Error api_upload_batch: %s", e)
                 return jsonify({"status": "error", "message": str(e)}), 500
+            fallidas, en_uso = set(), set()
+            for pos, _, fotos, _, subidas in preparados:
+                if isinstance(ids[pos], Exception): fallidas.update(fotos)
+                else: en_uso.update(fotos); self._consumir_subidas(subidas)
+            # Dos registros del lote pueden compartir foto: solo se borra si no la usa ninguno guardado
+            self._borrar_fotos(fallidas - en_uso)
+
+            cuerpo = respuesta(ids)
+            # Una sola notificación para todo el lote (no 80 refrescos seguidos de la UI)
+            if cuerpo["insertados"]:
+                self.registro_recibido.emit(f"{cuerpo['insertados']} registros (lote)", "", "", "", "")
+            return jsonify(cuerpo)
+
+        # ==========================================
+        # --- SINCRONIZACIÓN DELTA ---
+        # ==========================================
+        # GET /api/cambios?since=<cursor>&epoca=<epoca>
+        # Devuelve solo lo que ha cambiado desde 'since' (un elemento por fila, con su estado actual):
+        #   {"reset": false, "cursor": N, "epoca": "...", "mas": false,
+        #    "cambios": [{"entidad": "tareas", "id": 7, "tipo": "upsert", "datos": {...}}, {"tipo": "borrado", ...}]}
+        # Con "reset": true el móvil debe recargar las listas completas y seguir desde 'cursor'
+        # (primer arranque, cursor demasiado viejo o base de datos restaurada).
+        @self.app.route('/api/cambios', methods=['GET'])
+        @respuesta_condicional(por_dia=True)
+        def api_cambios():
+            try:
+                since = request.args.get('since', '')
+                epoca_cliente = request.args.get('epoca')
+                limite = min(max(int(request.args.get('limite', 500)), 1), 1000)
+                with self.pool_bd.conexion() as conn:
+                    conn.execute("BEGIN") # Cursor y filas salen de la misma instantánea
+                    config = dict(conn.execute("SELECT clave, valor FROM config WHERE clave IN ('cambios_epoca', 'cambios_minimo')").fetchall())
+                    epoca = config.get('cambios_epoca', '')
+                    fila = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='cambios'").fetchone()
+                    cursor_actual = fila[0] if fila else 0
+
+                    if (not since.isdigit() or int(since) < int(config.get('cambios_minimo') or 0)
+                            or int(since) > cursor_actual or (epoca_cliente and epoca_cliente != epoca)):
+                        return jsonify({"status": "ok", "reset": True, "epoca": epoca, "cursor": cursor_actual, "mas": False, "cambios": []})
+
+                    marcas = ",".join("?" * len(TABLAS_SINCRONIZADAS))
+                    filas = conn.execute(f"""SELECT entidad, entidad_id, MAX(id) AS ultimo FROM cambios
+                                             WHERE id > ? AND entidad IN ({marcas})
+                                             GROUP BY entidad, entidad_id ORDER BY ultimo LIMIT ?""",
+                                         (int(since), *TABLAS_SINCRONIZADAS, limite + 1)).fetchall()
+                    mas = len(filas) > limite; filas = filas[:limite]
+
+                    ids_por_tabla = {}
+                    for entidad, entidad_id, _ in filas: ids_por_tabla.setdefault(entidad, []).append(entidad_id)
+                    actuales = {}
+                    for entidad, ids in ids_por_tabla.items():
+                        sql = self.SQL_FILAS_SINCRONIZADAS[entidad] + f" WHERE id IN ({','.join('?' * len(ids))})"
+                        for r in conn.execute(sql, ids): actuales[(entidad, r[0])] = r
+
+                hoy = datetime.now().date()
+                avisos = {e[0][0]: e for e in estados_avisos([r for (entidad, _), r in actuales.items() if entidad == "avisos_recurrentes"], hoy)}
+                cambios = []
+                for entidad, entidad_id, ultimo in filas:
+                    r = actuales.get((entidad, entidad_id))
+                    if entidad == "tareas" and r: datos = self._tarea_json(r)
+                    elif entidad == "avisos_recurrentes": datos = self._aviso_json(avisos[entidad_id], hoy) if entidad_id in avisos else None
+                    elif r: datos = {"id": r[0], "titulo": r[1], "detalles": r[2]}
+                    else: datos = None
+                    if datos: cambios.append({"entidad": entidad, "id": entidad_id, "tipo": "upsert", "cursor": ultimo, "datos": datos})
+                    else: cambios.append({"entidad": entidad, "id": entidad_id, "tipo": "borrado", "cursor": ultimo})
+
+                # Si hay más páginas, se sigue desde el último cambio entregado
+                nuevo_cursor = filas[-1][2] if mas else cursor_actual
+                return jsonify({"status": "ok", "reset": False, "epoca": epoca, "cursor": nuevo_cursor, "mas": mas, "cambios": cambios})
+            except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
+
+        # ==========================================
+        # --- CANAL PUSH (SERVER-SENT EVENTS) ---
+        # ==========================================
+        # GET /api/eventos  (Accept: text/event-stream)
+        #   event: cambios -> {"version", "cursor", "cambios": [{"entidad", "id", "tipo"}], "mas"}
+        #   event: reset   -> recargar listas completas
+        # El 'id' de cada evento es el cursor: al reconectar, Last-Event-ID (o ?desde=) recupera lo perdido.
+        # Con ?espera=<s>&version=<v> funciona como long-poll: responde en cuanto cambia la versión.
+        @self.app.route('/api/eventos', methods=['GET'])
+        def api_eventos():
+            desde = request.headers.get('Last-Event-ID') or request.args.get('desde')
+            desde = int(desde) if desde and desde.isdigit() else None
+
+            if request.args.get('espera'):
+                # Long-poll: ocupa un hilo como mucho 'espera' segundos (máx. 25)
+                espera = min(max(request.args.get('espera', type=float) or 0, 0), 25)
+                version = VERSION_BD.esperar_cambio(request.args.get('version', VERSION_BD.valor, type=int), espera)
+                return jsonify({"status": "ok", "version": version, "etag": VERSION_BD.etag()})
+
+            cabeceras = [("Content-Type", "text/event-stream; charset=utf-8"), ("Cache-Control", "no-cache"), ("X-Accel-Buffering", "no")]
+            desacoplar = request.environ.get('mantpro.desacoplar')
+            if desacoplar and self.difusor.is_alive():
+                if self.difusor.suscriptores >= self.difusor.MAX_CLIENTES:
+                    return jsonify({"status": "error", "message": "Demasiados suscriptores"}), 503
+                # El socket pasa al hilo del difusor; este hilo del pool queda libre al volver
+                self.difusor.agregar(desacoplar("200 OK", cabeceras), desde)
+                return ("", 200)
+
+            # Modo desarrollo: flujo clásico que mantiene su hilo (un hilo por conexión, como el propio servidor)
+            def flujo():
+                yield "retry: 5000\n: conectado\n\n"
+                cursor = desde; epoca = None
+                with self.pool_bd.conexion() as conn:
+                    if cursor is None: _, cursor, epoca = evento_cambios(conn, None)
+                while not self._detenido:
+                    version = VERSION_BD.valor
+                    with self.pool_bd.conexion() as conn:
+                        mensaje, cursor, epoca = evento_cambios(conn, cursor, epoca)
+                    if mensaje: yield mensaje.decode("utf-8")
+                    if VERSION_BD.esperar_cambio(version, self.difusor.LATIDO) == version: yield ": latido\n\n"
+            return self.app.response_class(flujo(), headers=cabeceras[1:], mimetype="text/event-stream")
 
         @self.app.route('/api/pendientes', methods=['GET'])
+        @respuesta_condicional()
         def api_get_pendientes():
             try:
-                conn = sqlite3.connect(self.db_path)
-                c = conn.cursor()
-                c.execute('SELECT id, titulo, detalles FROM pendientes ORDER BY id DESC')
-                datos = [{"id": r[0], "titulo": r[1], "detalles": r[2]} for r in c.fetchall()]
-                conn.close()
+                with self.pool_bd.conexion() as conn:
+                    c = conn.execute('SELECT id, titulo, detalles FROM pendientes ORDER BY id DESC')
+                    datos = [{"id": r[0], "titulo": r[1], "detalles": r[2]} for r in c.fetchall()]
                 return jsonify(datos)
             except Exception as e: return jsonify({"error": str(e)}), 500
 
         @self.app.route('/api/completar_pendiente', methods=['POST'])
+        @idempotente
         def api_completar_pendiente():
             try:
                 id_pend = request.form.get('id')
@@ -476,33 +2022,24 @@ class ServidorSincronizacion(QThread):
                 filename, ruta_local = self._procesar_foto(request, 'foto')
                 filename_d, _ = self._procesar_foto(request, 'foto_despues')
                 raw_desc = ruta_local if ruta_local else detalles
+                desc_final = self._descripcion_tarea(titulo, detalles, filename, filename_d)
 
-                # --- FIX: CREAR LA DESCRIPCIÓN COMPLETA CON TÍTULO Y FOTO ---
-                desc_final = titulo
-                if detalles:
-                    desc_final += f"\n{detalles}"
-                if filename:
-                    desc_final += f"\n[FOTO: {filename}]"
-                if filename_d:
-                    desc_final += f"\n[FOTO_DESPUES: {filename_d}]"
-
-                with get_db_connection(self.db_path) as conn:
-                    c = conn.cursor()
-                    c.execute('DELETE FROM pendientes WHERE id=?', (id_pend,))
+                def completar(conn):
+                    conn.execute('DELETE FROM pendientes WHERE id=?', (id_pend,))
                     # Usamos el INSERT completo para alimentar todas las columnas
-                    c.execute('INSERT INTO tareas (fecha, descripcion, tags, raw_desc, foto) VALUES (?,?,?,?,?)',
-                              (fecha_final, desc_final, tags, raw_desc, filename))
-                    conn.commit()
+                    guardar_con_marcas(conn, "tareas", {"fecha": fecha_final, "descripcion": desc_final, "tags": tags,
+                                                        "raw_desc": raw_desc, "foto": filename})
+                self._escribir_peticion(completar)
 
                 self.pendiente_actualizado.emit()
                 return jsonify({"status": "ok"})
             except Exception as e:
-                print(f"Error completar_pendiente: {e}")
+                log_servidor.exception("Error completar_pendiente: %s", e)
                 return jsonify({"status": "error", "message": str(e)}), 500
 
         @self.app.route('/api/agregar_pendiente', methods=['POST'])
+        @idempotente
         def api_agregar_pendiente():
-            print(">>> PETICIÓN: AGREGAR PENDIENTE")
             try:
                 titulo = request.form.get('titulo')
                 detalles = request.form.get('detalles')
@@ -511,21 +2048,17 @@ class ServidorSincronizacion(QThread):
                 if filename: detalles += f"\n[FOTO: {filename}]"
                 if filename_d: detalles += f"\n[FOTO_DESPUES: {filename_d}]"
 
-                # Timeout de 10s para esperar si la BD está ocupada
-                conn = sqlite3.connect(self.db_path, timeout=10)
-                c = conn.cursor()
-                c.execute('INSERT INTO pendientes (titulo, detalles) VALUES (?,?)', (titulo, detalles))
-                conn.commit()
-                conn.close()
+                self._escribir_peticion(lambda conn: guardar_con_marcas(conn, "pendientes", {"titulo": titulo, "detalles": detalles}))
 
-                print("✅ Pendiente guardado OK")
+                log_servidor.info("Pendiente guardado: %s", titulo)
                 self.pendiente_actualizado.emit()
                 return jsonify({"status": "ok"})
             except Exception as e:
-                print(f"!!! ERROR AGREGAR PENDIENTE: {e}")
+                log_servidor.exception("Error agregar_pendiente: %s", e)
                 return jsonify({"status": "error", "message": str(e)}), 500
 
         @self.app.route('/api/editar_pendiente', methods=['POST'])
+        @idempotente
         def api_editar_pendiente():
             try:
                 id_p = request.form.get('id')
@@ -540,27 +2073,20 @@ class ServidorSincronizacion(QThread):
                 if filename_d:
                     detalles += f"\n[FOTO_DESPUES: {filename_d}]"
 
-                conn = sqlite3.connect(self.db_path)
-                c = conn.cursor()
                 # Actualizamos título y detalles
-                c.execute('UPDATE pendientes SET titulo=?, detalles=? WHERE id=?', (titulo, detalles, id_p))
-                conn.commit()
-                conn.close()
+                self._escribir_peticion(lambda conn: guardar_con_marcas(conn, "pendientes", {"titulo": titulo, "detalles": detalles}, id_p))
 
                 self.pendiente_actualizado.emit()
                 return jsonify({"status": "ok"})
             except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
 
         @self.app.route('/api/eliminar_pendiente', methods=['POST'])
+        @idempotente
         def api_eliminar_pendiente():
             # (Mantener código original)
             try:
                 id_p = request.form.get('id')
-                conn = sqlite3.connect(self.db_path)
-                c = conn.cursor()
-                c.execute('DELETE FROM pendientes WHERE id=?', (id_p,))
-                conn.commit()
-                conn.close()
+                self._escribir_peticion(lambda conn: conn.execute('DELETE FROM pendientes WHERE id=?', (id_p,)))
                 self.pendiente_actualizado.emit()
                 return jsonify({"status": "ok"})
             except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
@@ -570,30 +2096,26 @@ class ServidorSincronizacion(QThread):
         # ==========================================
 
         @self.app.route('/api/dashboard', methods=['GET'])
+        @respuesta_condicional(por_dia=True)
         def api_dashboard():
             try:
-                conn = sqlite3.connect(self.db_path)
-                c = conn.cursor()
-                # 1. Contar pendientes
-                c.execute("SELECT COUNT(*) FROM pendientes")
-                n_pendientes = c.fetchone()[0]
-
-                # 2. Contar registros del mes actual
-                mes_actual = datetime.now().strftime("%Y-%m")
-                c.execute("SELECT COUNT(*) FROM tareas WHERE fecha LIKE ?", (f"{mes_actual}%",))
-                n_mes = c.fetchone()[0]
-
-                # 3. Contar avisos activos (lógica simplificada para SQL)
-                c.execute("SELECT titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada FROM avisos_recurrentes")
-                avisos = c.fetchall()
-                n_avisos = 0
-                hoy = datetime.now().date() # Usamos objeto date de Python para calcular rápido aquí
-
-                # (Nota: Replicar lógica exacta de recurrencia en SQL puro es complejo,
-                # enviamos el total de avisos configurados como dato simple o hacemos un cálculo aproximado)
-                n_avisos_total = len(avisos)
-
-                conn.close()
+                with self.pool_bd.conexion() as conn:
+                    c = conn.cursor()
+                    # 1. Contar pendientes
+                    c.execute("SELECT COUNT(*) FROM pendientes")
+                    n_pendientes = c.fetchone()[0]
+
+                    # 2. Contar registros del mes actual
+                    mes_actual = datetime.now().strftime("%Y-%m")
+                    c.execute("SELECT COUNT(*) FROM tareas WHERE fecha BETWEEN ? AND ?", (f"{mes_actual}-01", f"{mes_actual}-31"))
+                    n_mes = c.fetchone()[0]
+
+                    # 3. Contar avisos configurados
+                    # (Nota: Replicar lógica exacta de recurrencia en SQL puro es complejo,
+                    # enviamos el total de avisos configurados como dato simple)
+                    c.execute("SELECT COUNT(*) FROM avisos_recurrentes")
+                    n_avisos_total = c.fetchone()[0]
+
                 return jsonify({
                     "pendientes": n_pendientes,
                     "registros_mes": n_mes,
@@ -602,155 +2124,97 @@ class ServidorSincronizacion(QThread):
             except Exception as e: return jsonify({"error": str(e)}), 500
 
         @self.app.route('/api/historial', methods=['GET'])
+        @respuesta_condicional()
         def api_historial():
+            # Paginación por clave (fecha, id): ?limite=50&cursor=<next_cursor de la página anterior>.
+            # Cada página cuesta lo mismo que la primera (búsqueda en el índice, sin OFFSET).
+            # Por compatibilidad el cuerpo sigue siendo la lista y el cursor va en 'X-Next-Cursor';
+            # con ?paginado=1 se devuelve {"items": [...], "next_cursor": ...}.
+            # Con ?q= se busca en el índice FTS5 (campo extra 'resaltado') y se pagina igual, por (fecha, id):
+            # la relevancia bm25 cambia al insertar tareas y no sirve como clave estable entre páginas.
             try:
                 query = request.args.get('q', '').lower()
-                conn = sqlite3.connect(self.db_path)
-                c = conn.cursor()
-
-                sql = "SELECT id, fecha, descripcion, tags FROM tareas ORDER BY fecha DESC LIMIT 50"
-                params = []
-
-                if query:
-                    sql = "SELECT id, fecha, descripcion, tags FROM tareas WHERE descripcion LIKE ? OR tags LIKE ? ORDER BY fecha DESC LIMIT 50"
-                    p_query = f"%{query}%"
-                    params = [p_query, p_query]
-
-                c.execute(sql, params)
-                # Procesamos para extraer nombre de foto si existe
-                resultados = []
-                for r in c.fetchall():
-                    desc = r[2]
-                    foto = None
-                    m = re.search(r"\[FOTO:\s*(.*?)\]", desc)
-                    if m: foto = m.group(1).split("]")[0].strip()
-
-                    foto_d = None
-                    m_d = re.search(r"\[FOTO_DESPUES:\s*(.*?)\]", desc)
-                    if m_d: foto_d = m_d.group(1).split("]")[0].strip()
-
-                    # Limpieza visual para el móvil
-                    desc_limpia = re.sub(r"\[FOTO.*?:.*?\]", "", desc)
-                    desc_limpia = re.sub(r"\[REF:.*?\]", "", desc_limpia).strip()
-
-                    resultados.append({
-                        "id": r[0],
-                        "fecha": r[1],
-                        "descripcion": desc_limpia,
-                        "tags": r[3],
-                        "foto": foto,
-                        "foto_d": foto_d,
-                        "raw_desc": desc # Necesario para editar
-                    })
-                conn.close()
-                return jsonify(resultados)
+                limite = min(max(request.args.get('limite', self.PAGINA_HISTORIAL, type=int), 1), self.MAX_PAGINA_HISTORIAL)
+                try: cursor = decodificar_cursor(request.args.get('cursor'))
+                except ValueError: return jsonify({"error": "Cursor no válido"}), 400
+
+                consulta = consulta_fts(query) if self.usar_fts else ""
+                if consulta:
+                    # Búsqueda FTS5 con el fragmento resaltado; el cursor es (fecha, id) como sin búsqueda
+                    sql = f'''SELECT {self.COLUMNAS_TAREA}, t.fecha, snippet(tareas_fts, -1, '<b>', '</b>', '…', 16)
+                             FROM tareas_fts f JOIN tareas t ON t.id = f.rowid WHERE tareas_fts MATCH ?'''
+                    params = [consulta]
+                    if cursor: sql += " AND (t.fecha, t.id) < (?, ?)"; params += list(cursor)
+                    sql += " ORDER BY t.fecha DESC, t.id DESC LIMIT ?"
+                else:
+                    condiciones = []; params = []
+                    if query:
+                        condiciones.append("(COALESCE(texto, descripcion) LIKE ? OR tags LIKE ?)")
+                        p_query = f"%{query}%"
+                        params += [p_query, p_query]
+                    if cursor:
+                        condiciones.append("(fecha, id) < (?, ?)")
+                        params += list(cursor)
+                    sql = f"SELECT {self.COLUMNAS_TAREA}, t.fecha FROM tareas t"
+                    if condiciones: sql += " WHERE " + " AND ".join(condiciones)
+                    sql += " ORDER BY fecha DESC, id DESC LIMIT ?"
+                params.append(limite + 1) # Una de más para saber si hay otra página
+
+                with self.pool_bd.conexion() as conn:
+                    filas = conn.execute(sql, params).fetchall()
+                siguiente = codificar_cursor(filas[limite - 1][7], filas[limite - 1][0]) if len(filas) > limite else None
+                items = []
+                for r in filas[:limite]:
+                    item = self._tarea_json(r)
+                    if consulta: item["resaltado"] = r[8]
+                    items.append(item)
+
+                if request.args.get('paginado') == '1': resp = jsonify({"items": items, "next_cursor": siguiente})
+                else: resp = jsonify(items)
+                if siguiente: resp.headers['X-Next-Cursor'] = siguiente
+                return resp
             except Exception as e: return jsonify({"error": str(e)}), 500
 
         # ---------------------------------------------------------
         # 1. API AVISOS (Lógica corregida: Acepta retrasos)
         # ---------------------------------------------------------
         @self.app.route('/api/avisos', methods=['GET'])
+        @respuesta_condicional(por_dia=True)
         def api_avisos():
             try:
-                conn = sqlite3.connect(self.db_path)
-                c = conn.cursor()
-                c.execute("SELECT id, titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada FROM avisos_recurrentes")
-                raw_avisos = c.fetchall()
-                conn.close()
+                with self.pool_bd.conexion() as conn:
+                    raw_avisos = conn.execute("SELECT id, titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada FROM avisos_recurrentes").fetchall()
 
-                lista_procesada = []
                 hoy = datetime.now().date()
-
-                for aid, tit, finicio, freq, dur, ult in raw_avisos:
-                    if not finicio: continue
-                    try:
-                        fi = datetime.strptime(finicio, "%Y-%m-%d").date()
-                    except: continue
-
-                    if not freq: freq = "Anual"
-
-                    # Calcular cuándo toca (Misma lógica matemática de antes)
-                    ocurrencia = fi
-                    while (ocurrencia + timedelta(days=dur)) < hoy:
-                        if freq == "Diario": ocurrencia += timedelta(days=1)
-                        elif freq == "Semanal": ocurrencia += timedelta(days=7)
-                        elif freq == "Mensual":
-                            ny = ocurrencia.year + (ocurrencia.month // 12)
-                            nm = (ocurrencia.month % 12) + 1
-                            try: ocurrencia = ocurrencia.replace(year=ny, month=nm)
-                            except: ocurrencia = ocurrencia.replace(year=ny, month=nm, day=28)
-                        elif freq == "Trimestral":
-                             m_add = ocurrencia.month + 3
-                             ny = ocurrencia.year + (m_add - 1) // 12
-                             nm = (m_add - 1) % 12 + 1
-                             try: ocurrencia = ocurrencia.replace(year=ny, month=nm)
-                             except: ocurrencia = ocurrencia.replace(year=ny, month=nm, day=28)
-                        elif freq == "Semestral":
-                             m_add = ocurrencia.month + 6
-                             ny = ocurrencia.year + (m_add - 1) // 12
-                             nm = (m_add - 1) % 12 + 1
-                             try: ocurrencia = ocurrencia.replace(year=ny, month=nm)
-                             except: ocurrencia = ocurrencia.replace(year=ny, month=nm, day=28)
-                        elif freq == "Anual": ocurrencia = ocurrencia.replace(year=ocurrencia.year + 1)
-                        else: break
-
-                    fin_ocurrencia = ocurrencia + timedelta(days=dur)
-
-                    # --- CORRECCIÓN DE ESTADO ---
-                    estado = "FUTURO"
-                    color_code = "blue"
-
-                    es_activo = (ocurrencia <= hoy <= fin_ocurrencia)
-
-                    # Lógica corregida: Si la última completada (ult) es posterior o igual a la fecha de ocurrencia, está OK.
-                    # Antes solo miraba si era EXACTAMENTE igual.
-                    es_completado = False
-                    if ult:
-                        fecha_ult = datetime.strptime(ult, "%Y-%m-%d").date()
-                        if fecha_ult >= ocurrencia:
-                            es_completado = True
-
-                    if es_activo:
-                        if es_completado:
-                            estado = "OK"
-                            color_code = "green"
-                        else:
-                            estado = "PENDIENTE"
-                            color_code = "red"
-                    elif hoy < ocurrencia:
-                        estado = "FUTURO"
-                        color_code = "blue"
-
-                    # Caso especial: Si ya lo completé hoy (aunque fuera futuro), que salga verde
-                    if ult == hoy.strftime("%Y-%m-%d"):
-                         estado = "OK"
-                         color_code = "green"
-
-                    lista_procesada.append({
-                        "id": aid,
-                        "titulo": tit,
-                        "frecuencia": freq,
-                        "rango": f"{ocurrencia.strftime('%d/%m')} - {fin_ocurrencia.strftime('%d/%m')}",
-                        "estado": estado,
-                        "color": color_code,
-                        "raw_inicio": ocurrencia.strftime("%Y-%m-%d"),
-                        "raw_fin": fin_ocurrencia.strftime("%Y-%m-%d")
-                    })
-
+                lista_procesada = [self._aviso_json(e, hoy) for e in estados_avisos(raw_avisos, hoy)]
                 return jsonify(lista_procesada)
             except Exception as e: return jsonify({"error": str(e)}), 500
 
+        @self.app.route('/api/avisos/rango', methods=['GET'])
+        @respuesta_condicional(por_dia=True)
+        def api_avisos_rango():
+            # Todos los plazos de avisos que tocan [desde, hasta] (p.ej. el mes que enseña el calendario del móvil)
+            try:
+                desde = date.fromisoformat(request.args.get('desde', ''))
+                hasta = date.fromisoformat(request.args.get('hasta', ''))
+            except ValueError: return jsonify({"error": "'desde' y 'hasta' tienen que ser fechas AAAA-MM-DD"}), 400
+            if not 0 <= (hasta - desde).days <= self.MAX_DIAS_RANGO_AVISOS:
+                return jsonify({"error": f"'hasta' no puede ser anterior a 'desde' ni estar a más de {self.MAX_DIAS_RANGO_AVISOS} días"}), 400
+            try:
+                with self.pool_bd.conexion() as conn: plazos = self.rangos_avisos.obtener(conn, desde, hasta)
+                hoy = datetime.now().date()
+                return jsonify([self._plazo_json(p, hoy) for p in plazos])
+            except Exception as e: return jsonify({"error": str(e)}), 500
+
         # ---------------------------------------------------------
         # 2. API COMPLETAR (Anti-Duplicados)
         # ---------------------------------------------------------
         @self.app.route('/api/completar_aviso', methods=['POST'])
+        @idempotente
         def api_completar_aviso():
-            print("\n" + "="*40)
-            print(">>> RECIBIDA PETICIÓN: COMPLETAR AVISO")
-
             try:
-                # 1. IMPRIMIR QUÉ NOS LLEGA EXACTAMENTE
-                print(f"Datos recibidos (RAW): {request.form}")
+                # 1. QUÉ NOS LLEGA EXACTAMENTE (solo con el nivel DEBUG: el formulario puede ser grande)
+                log_servidor.debug("completar_aviso recibido: %s", request.form)
 
                 id_aviso_str = request.form.get('id')
                 titulo = request.form.get('titulo') or "Sin Título"
@@ -758,75 +2222,73 @@ class ServidorSincronizacion(QThread):
 
                 # 2. VALIDACIÓN DE ID
                 if not id_aviso_str:
-                    print("!!! ERROR: No ha llegado el ID")
+                    log_servidor.warning("completar_aviso sin ID")
                     return jsonify({"status": "error", "message": "Falta ID"}), 400
 
                 try:
                     id_aviso = int(id_aviso_str)
-                    print(f"ID convertido a entero: {id_aviso}")
                 except ValueError:
-                    print(f"!!! ERROR: El ID '{id_aviso_str}' no es un número")
+                    log_servidor.warning("completar_aviso con ID no numérico: %r", id_aviso_str)
                     return jsonify({"status": "error", "message": "ID no numérico"}), 400
 
                 # 3. FECHA
                 fecha_final = fecha_custom if fecha_custom else datetime.now().strftime("%Y-%m-%d")
-                print(f"Fecha a guardar: {fecha_final}")
 
-                # 4. CONEXIÓN BASE DE DATOS
-                print("Intentando conectar a BD...")
-                conn = sqlite3.connect(self.db_path, timeout=10) # Timeout alto para evitar bloqueos
-                c = conn.cursor()
+                # Con clave de idempotencia los reintentos ya no llegan aquí; sin ella, comprobamos a mano
+                comprobar_duplicado = g.clave_idempotencia is None
 
-                # 5. ACTUALIZAR AVISO
-                print("Ejecutando UPDATE en avisos_recurrentes...")
-                c.execute('UPDATE avisos_recurrentes SET ultima_completada=? WHERE id=?', (fecha_final, id_aviso))
-                if c.rowcount == 0:
-                    print("⚠️ AVISO: No se actualizó ninguna fila. ¿Existe el ID?")
-                else:
-                    print("✅ UPDATE correcto.")
+                # 4. ESCRITURA (en el hilo escritor, una sola transacción)
+                def completar(conn):
+                    c = conn.cursor()
 
-                # 6. INSERTAR HISTORIAL
-                print("Verificando historial para evitar duplicados...")
-                desc_historial = f"Mantenimiento Preventivo: {titulo}"
-                tags_historial = "Preventivo, Aviso Recurrente"
+                    # 5. ACTUALIZAR AVISO
+                    c.execute('UPDATE avisos_recurrentes SET ultima_completada=? WHERE id=?', (fecha_final, id_aviso))
+                    if c.rowcount == 0:
+                        log_servidor.warning("completar_aviso: no existe el aviso %s", id_aviso)
 
-                c.execute("SELECT id FROM tareas WHERE fecha=? AND descripcion=?", (fecha_final, desc_historial))
-                existe = c.fetchone()
+                    # 6. INSERTAR HISTORIAL
+                    desc_historial = f"Mantenimiento Preventivo: {titulo}"
+                    tags_historial = "Preventivo, Aviso Recurrente"
 
-                if not existe:
-                    print("Insertando nueva tarea en historial...")
-                    c.execute('INSERT INTO tareas (fecha, descripcion, tags) VALUES (?,?,?)',
-                              (fecha_final, desc_historial, tags_historial))
-                else:
-                    print("La tarea ya existe en el historial. Saltando insert.")
+                    existe = None
+                    if comprobar_duplicado:
+                        c.execute("SELECT id FROM tareas WHERE fecha=? AND descripcion=?", (fecha_final, desc_historial))
+                        existe = c.fetchone()
 
-                conn.commit()
-                conn.close()
-                print("✅ BD CERRADA Y COMMIT REALIZADO")
+                    if not existe:
+                        guardar_con_marcas(conn, "tareas", {"fecha": fecha_final, "descripcion": desc_historial, "tags": tags_historial})
+                    else:
+                        log_servidor.info("completar_aviso: '%s' ya estaba en el historial del %s", desc_historial, fecha_final)
+                self._escribir_peticion(completar)
+                log_servidor.info("Aviso %s completado con fecha %s", id_aviso, fecha_final)
 
                 # 7. AVISAR INTERFAZ PC
                 self.pendiente_actualizado.emit()
-
-                print(">>> PROCESO TERMINADO CON ÉXITO")
-                print("="*40 + "\n")
                 return jsonify({"status": "ok"})
 
             except Exception as e:
-                print("\n!!! EXCEPCIÓN CRÍTICA EN EL SERVIDOR !!!")
-                print(f"Error: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                print("="*40 + "\n")
+                log_servidor.exception("Error completar_aviso: %s", e)
                 return jsonify({"status": "error", "message": str(e)}), 500
 
         @self.app.route('/api/foto/<path:filename>')
         def serve_foto(filename):
             try:
+                # ?w=256 -> miniatura (para las listas del móvil); sin 'w' -> foto original
+                ancho = request.args.get('w', type=int)
+                filename = self._resolver_foto(filename)
+                if ancho:
+                    ruta = self._miniatura(filename, ancho)
+                    if ruta:
+                        resp = send_from_directory(self.carpeta_miniaturas, os.path.basename(ruta), max_age=31536000)
+                        # La clave incluye la fecha de la foto: si cambia, cambia el nombre en caché
+                        resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+                        return resp
                 return send_from_directory(self.carpeta_destino, filename)
             except Exception as e:
                 return str(e), 404
 
         @self.app.route('/api/editar_historial', methods=['POST'])
+        @idempotente
         def api_editar_historial():
             try:
                 id_t = request.form.get('id')
@@ -842,66 +2304,392 @@ class ServidorSincronizacion(QThread):
                 if filename_d:
                     desc_final += f"\n[FOTO_DESPUES: {filename_d}]"
 
-                conn = sqlite3.connect(self.db_path)
-                c = conn.cursor()
-                c.execute("UPDATE tareas SET descripcion=?, tags=? WHERE id=?", (desc_final, tags, id_t))
-                conn.commit()
-                conn.close()
+                self._escribir_peticion(lambda conn: guardar_con_marcas(conn, "tareas", {"descripcion": desc_final, "tags": tags}, id_t))
 
                 self.pendiente_actualizado.emit() # Para refrescar la UI de escritorio
                 return jsonify({"status": "ok"})
             except Exception as e: return jsonify({"status": "error", "message": str(e)}), 500
 
         @self.app.route('/api/descompletar_aviso', methods=['POST'])
+        @idempotente
         def api_descompletar_aviso():
             try:
                 id_aviso = request.form.get('id')
 
-                conn = sqlite3.connect(self.db_path)
-                c = conn.cursor()
-
-                # 1. Obtener datos actuales del aviso
-                c.execute("SELECT titulo, ultima_completada FROM avisos_recurrentes WHERE id=?", (id_aviso,))
-                row = c.fetchone()
+                def descompletar(conn):
+                    c = conn.cursor()
 
-                if row:
-                    titulo, ult_fecha = row
+                    # 1. Obtener datos actuales del aviso
+                    c.execute("SELECT titulo, ultima_completada FROM avisos_recurrentes WHERE id=?", (id_aviso,))
+                    row = c.fetchone()
 
-                    # 2. Intentar borrar del historial la entrada generada para esa fecha
-                    # La descripción debe coincidir con la que generamos automáticamente
-                    desc = f"Mantenimiento Preventivo: {titulo}"
-                    if ult_fecha:
-                        c.execute("DELETE FROM tareas WHERE descripcion=? AND fecha=?", (desc, ult_fecha))
+                    if row:
+                        titulo, ult_fecha = row
 
-                    # 3. Buscar cuál es la NUEVA última fecha real (la anterior a la borrada)
-                    # Esto evita que se quede en NULL si ya se había hecho el mes pasado
-                    c.execute("SELECT MAX(fecha) FROM tareas WHERE descripcion=?", (desc,))
-                    resultado = c.fetchone()
-                    prev_fecha = resultado[0] if resultado else None # Puede ser None si nunca se hizo antes
+                        # 2. Intentar borrar del historial la entrada generada para esa fecha
+                        # La descripción debe coincidir con la que generamos automáticamente
+                        desc = f"Mantenimiento Preventivo: {titulo}"
+                        if ult_fecha:
+                            c.execute("DELETE FROM tareas WHERE descripcion=? AND fecha=?", (desc, ult_fecha))
 
-                    # 4. Actualizar el aviso con la fecha histórica correcta
-                    c.execute("UPDATE avisos_recurrentes SET ultima_completada=? WHERE id=?", (prev_fecha, id_aviso))
+                        # 3. Buscar cuál es la NUEVA última fecha real (la anterior a la borrada)
+                        # Esto evita que se quede en NULL si ya se había hecho el mes pasado
+                        c.execute("SELECT MAX(fecha) FROM tareas WHERE descripcion=?", (desc,))
+                        resultado = c.fetchone()
+                        prev_fecha = resultado[0] if resultado else None # Puede ser None si nunca se hizo antes
 
-                conn.commit()
-                conn.close()
+                        # 4. Actualizar el aviso con la fecha histórica correcta
+                        c.execute("UPDATE avisos_recurrentes SET ultima_completada=? WHERE id=?", (prev_fecha, id_aviso))
+                self._escribir_peticion(descompletar)
 
                 self.pendiente_actualizado.emit()
                 return jsonify({"status": "ok"})
             except Exception as e:
                 return jsonify({"status": "error", "message": str(e)}), 500
 
+        # ==========================================
+        # --- SUBIDA DE FOTOS POR TROZOS (REANUDABLE) ---
+        # ==========================================
+        # 1. POST /api/subida                  -> {"id", "offset": 0}
+        # 2. PUT  /api/subida/<id>?offset=N    -> cuerpo = bytes del trozo, responde el nuevo offset
+        #    (si se corta la Wi-Fi: GET /api/subida/<id> devuelve el offset y se sigue desde ahí)
+        # 3. El registro se envía como siempre con 'foto_subida=<id>' (o 'foto_despues_subida')
+        #    en lugar del fichero; el servidor copia la foto a fotos_recibidas y borra la subida
+        #    cuando el registro ya está guardado (si falla, se puede reintentar con el mismo ID).
+        @self.app.route('/api/subida', methods=['POST'])
+        def api_subida_crear():
+            # El ID lo pone el servidor, y hay un máximo de subidas a medias (cada una es un fichero en disco)
+            with self._lock_subidas:
+                if self._subidas_abiertas() >= self.MAX_SUBIDAS_ABIERTAS:
+                    self._limpiar_subidas_caducadas()
+                    if self._subidas_abiertas() >= self.MAX_SUBIDAS_ABIERTAS:
+                        resp = jsonify({"status": "error", "message": "Demasiadas subidas a medias, reintenta más tarde"})
+                        resp.headers['Retry-After'] = '60'
+                        return resp, 503
+                id_subida = uuid.uuid4().hex
+                open(self._ruta_subida(id_subida), 'xb').close()
+            return jsonify({"status": "ok", "id": id_subida, "offset": 0, "max": self.max_foto_bytes})
+
+        @self.app.route('/api/subida/<id_subida>', methods=['GET'])
+        def api_subida_estado(id_subida):
+            ruta = self._ruta_subida(id_subida)
+            if not ruta or not os.path.exists(ruta): return jsonify({"status": "error", "message": "Subida no encontrada"}), 404
+            return jsonify({"status": "ok", "id": id_subida, "offset": os.path.getsize(ruta), "max": self.max_foto_bytes})
+
+        @self.app.route('/api/subida/<id_subida>', methods=['PUT', 'PATCH'])
+        def api_subida_trozo(id_subida):
+            ruta = self._ruta_subida(id_subida)
+            if not ruta or not os.path.exists(ruta): return jsonify({"status": "error", "message": "Subida no encontrada"}), 404
+            # Un trozo a la vez: dos PUT con el mismo offset (reintento impaciente) no pueden añadir los dos
+            cerrojo = self._cerrojo_subida(id_subida)
+            if not cerrojo.acquire(blocking=False):
+                return jsonify({"status": "error", "message": "Ya se está recibiendo un trozo de esta subida"}), 409
+            try:
+                if not os.path.exists(ruta): return jsonify({"status": "error", "message": "Subida no encontrada"}), 404
+                actual = os.path.getsize(ruta)
+                try: offset = int(request.args.get('offset', request.headers.get('Upload-Offset', actual)))
+                except ValueError: return jsonify({"status": "error", "message": "Offset no numérico"}), 400
+                if offset != actual:
+                    # El móvil cree que va por otro sitio: le decimos dónde estamos de verdad
+                    return jsonify({"status": "error", "message": "Offset incorrecto", "offset": actual}), 409
+                try:
+                    with open(ruta, 'ab') as f:
+                        copiar_stream_limitado(request.stream, f, self.max_foto_bytes - actual)
+                except FotoDemasiadoGrande as e:
+                    os.remove(ruta)
+                    return jsonify({"status": "error", "message": str(e)}), 413
+                except ClientDisconnected:
+                    pass # Lo recibido ya está en disco; el móvil reanudará desde el nuevo offset
+                return jsonify({"status": "ok", "id": id_subida, "offset": os.path.getsize(ruta)})
+            finally: cerrojo.release()
+
+        @self.app.route('/api/subida/<id_subida>', methods=['DELETE'])
+        def api_subida_cancelar(id_subida):
+            ruta = self._ruta_subida(id_subida)
+            if ruta and os.path.exists(ruta): os.remove(ruta)
+            return jsonify({"status": "ok"})
+
+    def _miniatura(self, filename, ancho):
+        """ Devuelve la ruta de la miniatura (generándola una sola vez) o None si toca servir el original """
+        origen = safe_join(self.carpeta_destino, filename)
+        if not origen or not os.path.isfile(origen): return None
+        # Solo anchos estándar: pocas variantes por foto y más aciertos de caché
+        ancho = next((a for a in self.ANCHOS_MINIATURA if a >= ancho), self.ANCHOS_MINIATURA[-1])
+        st = os.stat(origen)
+        clave = hashlib.sha1(f"{filename}|{st.st_mtime_ns}|{st.st_size}".encode("utf-8")).hexdigest()
+        ruta = os.path.join(self.carpeta_miniaturas, f"{clave}_{ancho}.jpg")
+        if os.path.exists(ruta):
+            try: os.utime(ruta) # Marca de uso para el LRU
+            except OSError: pass
+            return ruta
+        try:
+            generar_miniatura(origen, ruta, ancho)
+        except Exception as e:
+            # Sin Pillow o foto que no es imagen: mejor el original que un error
+            log_servidor.info("Miniatura no disponible para %s: %s", filename, e)
+            return None
+        self._anotar_miniatura(ruta)
+        return ruta
+
+    def _anotar_miniatura(self, nueva):
+        tamano = os.path.getsize(nueva)
+        with self._lock_miniaturas:
+            if self._bytes_miniaturas is None:
+                self._bytes_miniaturas = sum(e.stat().st_size for e in os.scandir(self.carpeta_miniaturas) if e.is_file())
+            else:
+                self._bytes_miniaturas += tamano
+            if self._bytes_miniaturas <= self.max_miniaturas_bytes: return
+            # LRU: fuera las menos usadas hasta quedar al 90% del límite
+            entradas = sorted((e for e in os.scandir(self.carpeta_miniaturas) if e.is_file()), key=lambda e: e.stat().st_mtime)
+            total = sum(e.stat().st_size for e in entradas)
+            for e in entradas:
+                if total <= self.max_miniaturas_bytes * 0.9: break
+                if e.path == nueva: continue # La que vamos a servir ahora mismo se queda
+                try:
+                    tam = e.stat().st_size; os.remove(e.path); total -= tam
+                except OSError: pass
+            self._bytes_miniaturas = total
+
+    def _nombre_foto(self, nombre_original):
+        # Nombre descriptivo (alias): el fichero en disco se llama por su contenido
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        safe_name = re.sub(r'[^a-zA-Z0-9.]', '_', nombre_original)
+        return f"app_{timestamp}_{safe_name}"
+
+    def _foto_guardada(self, nombre_original, filename, ruta, nueva, original=None):
+        # El alias se apunta con el registro que usa la foto, en la misma transacción (ver _escribir_peticion)
+        g.setdefault("alias_fotos", []).append((self._nombre_foto(nombre_original), filename, original))
+        # Solo lo creado por esta petición se puede borrar si luego falla (lo demás ya lo usa alguien)
+        if nueva: g.setdefault("fotos_creadas", set()).add(ruta)
+        return filename, ruta
+
+    RESPUESTA_OK = {"status": "ok"}
+
+    def _escribir_peticion(self, funcion, respuesta=None):
+        """
+        La mutación de una petición de la API, en una sola transacción del escritor: los alias de las fotos
+        recibidas, 'funcion(conn)' y, con Idempotency-Key, la respuesta 'respuesta(resultado)' (un dict, 200;
+        por defecto RESPUESTA_OK).
+        Así no puede quedar el registro guardado sin su clave: el reintento nunca lo duplica.
+        """
+        alias_fotos = g.pop("alias_fotos", []); subidas = g.pop("subidas_usadas", [])
+        clave, endpoint = g.get("clave_idempotencia"), request.endpoint
+        def escribir(conn):
+            for alias, filename, original in alias_fotos: anotar_alias_foto(conn, alias, filename, original)
+            resultado = funcion(conn)
+            if clave is not None:
+                cuerpo = respuesta(resultado) if respuesta else self.RESPUESTA_OK
+                self._anotar_respuesta(conn, clave, endpoint, 200, json.dumps(cuerpo, ensure_ascii=False), "application/json")
+            return resultado
+        resultado = self.escritor.ejecutar(escribir)
+        self._consumir_subidas(subidas)
+        if clave is not None: g.respuesta_guardada = True # idempotente() ya no tiene que guardarla
+        return resultado
+
+    def _resolver_foto(self, filename):
+        """ Acepta tanto el nombre en disco como un alias descriptivo """
+        if os.path.isfile(os.path.join(self.carpeta_destino, filename)): return filename
+        with self.pool_bd.conexion() as conn:
+            fila = conn.execute("SELECT foto FROM fotos_alias WHERE alias=?", (filename,)).fetchone()
+        return fila[0] if fila else filename
+
+    def _tarea_json(self, r):
+        # Fila con las columnas de COLUMNAS_TAREA: texto limpio y fotos ya vienen separados
+        return {
+            "id": r[0],
+            "fecha": r[1],
+            "descripcion": r[4],
+            "tags": r[3],
+            "foto": r[5],
+            "foto_d": r[6],
+            "raw_desc": r[2] # Necesario para editar
+        }
+
+    def _aviso_json(self, estado_av, hoy):
+        (aid, tit, finicio, freq, dur, ult), ocurrencia, fin_ocurrencia, es_activo, es_completado = estado_av
+        if not freq: freq = "Anual"
+
+        # --- CORRECCIÓN DE ESTADO ---
+        estado = "FUTURO"
+        color_code = "blue"
+
+        if es_activo:
+            if es_completado:
+                estado = "OK"
+                color_code = "green"
+            else:
+                estado = "PENDIENTE"
+                color_code = "red"
+        elif hoy < ocurrencia:
+            estado = "FUTURO"
+            color_code = "blue"
+
+        # Caso especial: Si ya lo completé hoy (aunque fuera futuro), que salga verde
+        if ult == hoy.strftime("%Y-%m-%d"):
+             estado = "OK"
+             color_code = "green"
+
+        return {
+            "id": aid,
+            "titulo": tit,
+            "frecuencia": freq,
+            "rango": f"{ocurrencia.strftime('%d/%m')} - {fin_ocurrencia.strftime('%d/%m')}",
+            "estado": estado,
+            "color": color_code,
+            "raw_inicio": ocurrencia.strftime("%Y-%m-%d"),
+            "raw_fin": fin_ocurrencia.strftime("%Y-%m-%d")
+        }
+
+    def _plazo_json(self, plazo, hoy):
+        (aid, tit, _, freq, _, _), ocurrencia, fin, completada = plazo
+        estado = estado_plazo(ocurrencia, completada, hoy)
+        return {"id": aid, "titulo": tit, "frecuencia": freq or "Anual", "inicio": ocurrencia.isoformat(), "fin": fin.isoformat(),
+                "estado": estado, "color": self.COLORES_ESTADO_AVISO[estado]}
+
+    def _borrar_fotos(self, rutas):
+        creadas = g.get("fotos_creadas", set())
+        for ruta in rutas:
+            if ruta in creadas and os.path.exists(ruta): os.remove(ruta); creadas.discard(ruta)
+
+    def _descripcion_tarea(self, titulo, detalles, filename, filename_d):
+        # --- FIX: CREAR LA DESCRIPCIÓN COMPLETA CON TÍTULO Y FOTO ---
+        desc_final = titulo
+        if detalles:
+            desc_final += f"\n{detalles}"
+        if filename:
+            desc_final += f"\n[FOTO: {filename}]"
+        if filename_d:
+            desc_final += f"\n[FOTO_DESPUES: {filename_d}]"
+        return desc_final
+
     def _procesar_foto(self, req, key='foto'):
         if key in req.files:
             file = req.files[key]
             if file and file.filename != '':
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                safe_name = re.sub(r'[^a-zA-Z0-9.]', '_', file.filename)
-                filename = f"app_{timestamp}_{safe_name}"
-                ruta = os.path.join(self.carpeta_destino, filename)
-                file.save(ruta)
-                return filename, ruta
+                return self._guardar_fichero_foto(file)
+
+        # Foto subida antes por trozos (/api/subida/<id>): basta con mandar su ID
+        id_subida = req.form.get(f"{key}_subida")
+        if id_subida:
+            return self._completar_subida(id_subida, req.form.get(f"{key}_nombre"))
+        return "", ""
+
+    def _foto_de_lote(self, reg, key):
+        # En un lote el registro dice en qué campo de fichero viene su foto (o el ID de subida)
+        campo = reg.get(key)
+        if campo:
+            file = request.files.get(campo)
+            if not file or file.filename == '': raise ValueError(f"Falta el fichero '{campo}'")
+            return self._guardar_fichero_foto(file)
+        if reg.get(f"{key}_subida"):
+            return self._completar_subida(reg[f"{key}_subida"], reg.get(f"{key}_nombre"))
         return "", ""
 
+    def _guardar_fichero_foto(self, file):
+        # Se copia por bloques a un temporal (calculando el hash) y se renombra: nunca queda una foto a medias
+        filename, ruta, nueva, original = guardar_foto_por_contenido(file.stream, self.carpeta_destino, file.filename, limite=self.max_foto_bytes,
+                                                                     carpeta_temporal=self.carpeta_subidas, normalizador=self.normalizador)
+        return self._foto_guardada(file.filename, filename, ruta, nueva, original)
+
+    def _completar_subida(self, id_subida, nombre=None):
+        ruta_parcial = self._ruta_subida(id_subida)
+        if not ruta_parcial: raise ValueError(f"Subida '{id_subida}' no encontrada")
+        nombre = nombre or "foto.jpg"
+        # Se trabaja sobre una copia: la subida solo se borra cuando el registro que usa la foto
+        # está guardado (ver _escribir_peticion), así un fallo o un reintento la siguen encontrando
+        temporal = f"{ruta_parcial}.{uuid.uuid4().hex}.tmp"
+        with self._cerrojo_subida(id_subida):
+            if not os.path.exists(ruta_parcial): raise ValueError(f"Subida '{id_subida}' no encontrada")
+            shutil.copyfile(ruta_parcial, temporal)
+        try:
+            filename, ruta, nueva, original = colocar_foto_por_contenido(temporal, self.carpeta_destino, nombre, normalizador=self.normalizador)
+        finally:
+            if os.path.exists(temporal): os.remove(temporal)
+        g.setdefault("subidas_usadas", []).append(ruta_parcial)
+        return self._foto_guardada(nombre, filename, ruta, nueva, original)
+
+    MAX_SUBIDAS_ABIERTAS = 200 # Subidas a medias a la vez (cada móvil tiene como mucho unas pocas)
+
+    def _subidas_abiertas(self):
+        return sum(1 for e in os.scandir(self.carpeta_subidas) if e.name.endswith(".part"))
+
+    def _cerrojo_subida(self, id_subida):
+        with self._lock_subidas:
+            cerrojo = self._cerrojos_subida.get(id_subida)
+            if cerrojo is None: cerrojo = self._cerrojos_subida[id_subida] = threading.Lock()
+        return cerrojo
+
+    def _consumir_subidas(self, rutas):
+        """ Borra las subidas cuyas fotos ya están en un registro confirmado """
+        for ruta in rutas:
+            try: os.remove(ruta)
+            except OSError: pass
+
+    def _ruta_subida(self, id_subida):
+        # El ID acaba en una ruta de disco: solo aceptamos caracteres seguros
+        if not re.fullmatch(r"[A-Za-z0-9_-]{8,64}", id_subida or ""): return None
+        return os.path.join(self.carpeta_subidas, f"{id_subida}.part")
+
+    def _clase_peticion(self, endpoint, metodo):
+        if endpoint in ('api_upload', 'api_upload_batch', 'api_subida_trozo', 'api_completar_pendiente'): return "subidas"
+        if endpoint == 'serve_foto': return "fotos"
+        # /api/eventos ya tiene su propio tope de suscriptores y /api/metrics tiene que contestar siempre
+        if endpoint in (None, 'api_eventos', 'api_metrics'): return None
+        # Las escrituras pequeñas (pendientes, avisos) van directas a la cola del escritor
+        return "lecturas" if metodo == 'GET' else None
+
+    def _soltar_limitador(self, limitador, inicio):
+        limitador.salir(time.perf_counter() - inicio)
+
+    def _limite_peticion(self, endpoint):
+        if endpoint == 'api_subida_trozo': return self.max_foto_bytes
+        if endpoint == 'api_upload_batch': return self.MAX_FOTOS_LOTE * self.max_foto_bytes + 4 * 1024 * 1024
+        # Formulario normal: hasta dos fotos (antes/después) más los campos de texto
+        return 2 * self.max_foto_bytes + 1024 * 1024
+
+    def _clave_idempotencia(self):
+        clave = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+        if not clave and request.is_json:
+            datos = request.get_json(silent=True)
+            if isinstance(datos, dict): clave = datos.get('idempotency_key')
+        return str(clave).strip() if clave else None
+
+    def _respuesta_guardada(self, clave, endpoint):
+        with self.pool_bd.conexion() as conn:
+            fila = conn.execute("SELECT endpoint, estado, cuerpo, tipo FROM idempotencia WHERE clave=?", (clave,)).fetchone()
+        if fila is None: return None
+        if fila[0] != endpoint:
+            return jsonify({"status": "error", "message": "Idempotency-Key ya usada en otra operación"}), 422
+        resp = self.app.response_class(fila[2], status=fila[1], mimetype=fila[3])
+        resp.headers['Idempotent-Replayed'] = 'true'
+        return resp
+
+    def _anotar_respuesta(self, conn, clave, endpoint, estado, cuerpo, tipo):
+        """ Guarda la respuesta de una clave de idempotencia (dentro de una mutación del escritor) """
+        conn.execute("INSERT OR REPLACE INTO idempotencia (clave, endpoint, estado, cuerpo, tipo) VALUES (?,?,?,?,?)",
+                     (clave, endpoint, estado, cuerpo, tipo))
+        if time.time() - self._ultima_poda_idempotencia > 3600:
+            self._ultima_poda_idempotencia = time.time()
+            conn.execute("DELETE FROM idempotencia WHERE fecha < datetime('now', ?)", (f"-{DIAS_IDEMPOTENCIA} days",))
+
+    def _guardar_respuesta(self, clave, endpoint, resp):
+        # Respuestas que no vienen de _escribir_peticion (errores de validación, lotes sin nada que insertar...)
+        fila = (clave, endpoint, resp.status_code, resp.get_data(as_text=True), resp.mimetype)
+        # No hace falta esperar: la clave sigue "en curso" hasta que esté en disco
+        return self.escritor.enviar(lambda conn: self._anotar_respuesta(conn, *fila))
+
+    def _liberar_clave(self, clave, evento):
+        with self._lock_idempotencia: self._claves_en_curso.pop(clave, None)
+        evento.set()
+
+    def _limpiar_subidas_caducadas(self, horas=48):
+        limite = time.time() - horas * 3600
+        for f in os.listdir(self.carpeta_subidas):
+            ruta = os.path.join(self.carpeta_subidas, f)
+            try:
+                if os.path.getmtime(ruta) < limite: os.remove(ruta)
+            except OSError: pass
+
     def obtener_ip_local(self):
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -910,156 +2698,511 @@ class ServidorSincronizacion(QThread):
             return ip
         except: return "127.0.0.1"
 
+    def crear_servidor_http(self):
+        if self.modo == "produccion":
+            return ServidorWSGIPool('0.0.0.0', self.server_port, self.app, hilos=self.hilos, timeout=self.timeout)
+        # Modo desarrollo: el servidor de Werkzeug de siempre (un hilo por conexión),
+        # pero creado a mano para poder pararlo desde closeEvent
+        return make_server('0.0.0.0', self.server_port, self.app, threaded=True)
+
     def run(self):
-        self.app.run(host='0.0.0.0', port=self.server_port, debug=False, use_reloader=False)
+        try:
+            with self._lock_arranque:
+                if self._detenido: return
+                self.servidor_http = self.crear_servidor_http()
+            log_servidor.info("Servidor de sincronización (%s) escuchando en el puerto %s", self.modo, self.server_port,
+                              extra={"modo": self.modo, "puerto": self.server_port})
+            if self.modo == "produccion": self.difusor.start()
+            self.servidor_http.serve_forever()
+        except (OSError, SystemExit) as e:
+            # Werkzeug hace sys.exit(1) si el puerto está ocupado; no debe tumbar la app
+            log_servidor.error("Error arrancando el servidor de sincronización: %s", e)
+        finally:
+            self.difusor.detener()
+            self.pool_bd.cerrar()
+
+    def detener(self, espera_ms=10000):
+        """ Parada limpia: deja de aceptar conexiones y espera a las peticiones en curso """
+        with self._lock_arranque:
+            self._detenido = True
+            servidor = self.servidor_http
+        if servidor: servidor.shutdown()
+        self.wait(espera_ms)
 
 # ==========================================
 # 2. GESTORES DE DATOS
 # ==========================================
 
+# Tablas cuyos cambios se apuntan (por triggers) en 'cambios' para la sincronización delta
+TABLAS_SINCRONIZADAS = ("tareas", "pendientes", "avisos_recurrentes")
+DIAS_REGISTRO_CAMBIOS = 90
+DIAS_IDEMPOTENCIA = 7 # Un móvil no reintenta una petición después de una semana
+
 class GestorBaseDatos:
     def __init__(self):
         # USAMOS DATA_DIR PARA UBICAR LA DB
         # La lógica de DATA_DIR se calcula arriba globalmente
         self.db_name = os.path.join(DATA_DIR, "mantenimiento.db")
+        self.usar_fts = False
+        self.normalizador = None # Lo pone la ventana principal según la configuración
+        # Una conexión de lectura por hilo, abierta una vez y reutilizada (ver conectar())
+        self._hilo = threading.local()
+        self._conexiones = weakref.WeakSet()
+        self._generacion = 0
+        self._lock_conexiones = threading.Lock()
+        self.rangos_avisos = CacheRangosAvisos()
         self.inicializar_tablas()
 
+    def _abrir(self):
+        conn = get_db_connection(self.db_name, check_same_thread=False) # Solo para poder cerrarla desde cerrar_conexiones()
+        conn.row_factory = None # Las vistas trabajan con tuplas
+        return conn
+
     def conectar(self):
-        return sqlite3.connect(self.db_name)
+        """
+        Conexión de LECTURA de este hilo (las escrituras van por escribir() al hilo escritor).
+        Se abre y configura una sola vez y se reutiliza, con su caché de sentencias: no se cierra.
+        Mejor usarla con 'with self.lectura() as conn'.
+        """
+        conn = getattr(self._hilo, "conn", None)
+        if conn is None or self._hilo.generacion != self._generacion:
+            conn = self._abrir()
+            with self._lock_conexiones: self._conexiones.add(conn)
+            self._hilo.conn, self._hilo.generacion = conn, self._generacion
+        return conn
+
+    @contextmanager
+    def lectura(self):
+        conn = self.conectar()
+        try: yield conn
+        finally:
+            # Una lectura nunca deja transacción abierta (retendría una instantánea vieja del WAL)
+            if conn.in_transaction: conn.rollback()
+
+    def cerrar_conexiones(self):
+        """ Cierra las conexiones de lectura de todos los hilos (al restaurar un backup o salir); se reabren solas """
+        with self._lock_conexiones:
+            self._generacion += 1
+            conexiones = list(self._conexiones); self._conexiones.clear()
+        for conn in conexiones:
+            try: conn.close()
+            except sqlite3.Error: pass
+
+    def escribir(self, funcion):
+        """ Ejecuta 'funcion(conn)' en el hilo escritor y espera a que esté confirmada """
+        return obtener_escritor(self.db_name).ejecutar(funcion)
+
+    def escribir_async(self, funcion):
+        """ Igual que escribir() pero sin esperar: devuelve un Future """
+        return obtener_escritor(self.db_name).enviar(funcion)
+
+    def _ejecutar_escritura(self, sql, parametros=()):
+        return self.escribir(lambda conn: conn.execute(sql, parametros).rowcount)
 
     def inicializar_tablas(self):
         try:
-            conn = self.conectar()
-            c = conn.cursor()
-            c.execute('CREATE TABLE IF NOT EXISTS tareas (id INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, descripcion TEXT, tags TEXT)')
-            c.execute('CREATE TABLE IF NOT EXISTS dias_especiales (fecha TEXT PRIMARY KEY, tipo TEXT)')
-            c.execute('CREATE TABLE IF NOT EXISTS pendientes (id INTEGER PRIMARY KEY AUTOINCREMENT, titulo TEXT, detalles TEXT)')
-            c.execute('CREATE TABLE IF NOT EXISTS config (clave TEXT PRIMARY KEY, valor TEXT)')
-
-            necesita_recrear = False
+            conn = self._abrir()
             try:
-                c.execute("PRAGMA table_info(avisos_recurrentes)")
-                cols = [info[1] for info in c.fetchall()]
-                if 'mes' in cols: necesita_recrear = True
-            except: pass
-
-            if necesita_recrear:
-                c.execute("DROP TABLE IF EXISTS avisos_recurrentes")
-
-            c.execute('''CREATE TABLE IF NOT EXISTS avisos_recurrentes (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        titulo TEXT, fecha_inicio TEXT, frecuencia TEXT, duracion_dias INTEGER, ultima_completada TEXT)''')
-            conn.commit()
-            conn.close()
-        except Exception as e: print(f"Error crítico inicializando BD: {e}")
+                self.migrar_esquema(conn)
+                c = conn.cursor()
+                self.usar_fts = c.execute("SELECT 1 FROM sqlite_master WHERE name='tareas_fts'").fetchone() is not None
+                # Filas escritas desde fuera de la app (índice parcial: no recorre la tabla)
+                sin_separar = any(c.execute(f"SELECT 1 FROM {tabla} WHERE texto IS NULL LIMIT 1").fetchone() for tabla in CAMPO_MARCAS)
+                self.podar_registros(c)
+                conn.commit()
+            finally: conn.close()
+            # Se separan como cualquier otra mutación: por el escritor y en su transacción
+            if sin_separar: self.escribir(self.migrar_marcas)
+        except Exception as e: log_bd.critical("Error crítico inicializando BD: %s", e, exc_info=True)
+
+    # --- MIGRACIONES DEL ESQUEMA ---
+    # 'PRAGMA user_version' guarda cuántas se han aplicado: con el esquema al día, arrancar no prueba
+    # columnas ni tablas. Cada una pasa de la versión N-1 a la N en su propia transacción. Las bases de
+    # datos anteriores a este sistema están en la versión 0 aunque ya tengan parte del esquema, así que
+    # todas toleran lo que ya exista. Una migración publicada no se cambia: se añade otra al final.
+    def migrar_esquema(self, conn):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > len(self.MIGRACIONES):
+            log_bd.warning("La BD es de una versión más nueva del programa (esquema %d, conocido %d)", version, len(self.MIGRACIONES))
+            return
+        for numero, migracion in enumerate(self.MIGRACIONES[version:], start=version + 1):
+            log_bd.info("Migrando la BD al esquema %d (%s)", numero, migracion.__name__)
+            conn.execute("BEGIN")
+            try:
+                migracion(self, conn.cursor())
+                conn.execute(f"PRAGMA user_version = {numero}")
+                conn.commit()
+            except Exception:
+                conn.rollback(); raise
+
+    def _esquema_base(self, c):
+        # 1: el esquema tal y como estaba antes de las migraciones (incluye lo que añadía reparar_base_datos)
+        c.execute('CREATE TABLE IF NOT EXISTS tareas (id INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT, descripcion TEXT, tags TEXT, raw_desc TEXT, foto TEXT)')
+        for columna in ("raw_desc", "foto"):
+            try: c.execute(f"ALTER TABLE tareas ADD COLUMN {columna} TEXT")
+            except sqlite3.OperationalError: pass
+        c.execute('CREATE TABLE IF NOT EXISTS dias_especiales (fecha TEXT PRIMARY KEY, tipo TEXT)')
+        c.execute('CREATE TABLE IF NOT EXISTS pendientes (id INTEGER PRIMARY KEY AUTOINCREMENT, titulo TEXT, detalles TEXT)')
+        c.execute('CREATE TABLE IF NOT EXISTS config (clave TEXT PRIMARY KEY, valor TEXT)')
+
+        # Avisos del formato antiguo (por 'mes'): se descartan
+        if 'mes' in [info[1] for info in c.execute("PRAGMA table_info(avisos_recurrentes)").fetchall()]:
+            c.execute("DROP TABLE avisos_recurrentes")
+        c.execute('''CREATE TABLE IF NOT EXISTS avisos_recurrentes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    titulo TEXT, fecha_inicio TEXT, frecuencia TEXT, duracion_dias INTEGER, ultima_completada TEXT)''')
+        # Índice para el historial paginado por (fecha, id) y los listados cronológicos
+        c.execute("CREATE INDEX IF NOT EXISTS idx_tareas_fecha_id ON tareas (fecha, id)")
+        # El índice de texto completo se crea en la 6 (indexa la columna 'texto', que llega en la 3)
+        self.inicializar_registro_cambios(c)
+        # Respuestas ya dadas por clave de idempotencia (reintentos de la app móvil)
+        c.execute('''CREATE TABLE IF NOT EXISTS idempotencia (
+                    clave TEXT PRIMARY KEY, endpoint TEXT NOT NULL, estado INTEGER NOT NULL,
+                    cuerpo TEXT, tipo TEXT, fecha TEXT DEFAULT CURRENT_TIMESTAMP)''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_idempotencia_fecha ON idempotencia (fecha)")
+        # Nombres descriptivos de las fotos (el fichero se llama por su contenido)
+        c.execute('''CREATE TABLE IF NOT EXISTS fotos_alias (
+                    alias TEXT PRIMARY KEY, foto TEXT NOT NULL, fecha TEXT DEFAULT CURRENT_TIMESTAMP, original TEXT)''')
+        try: c.execute("ALTER TABLE fotos_alias ADD COLUMN original TEXT") # Nombre en fotos_originales (si se archivan)
+        except sqlite3.OperationalError: pass
+        c.execute("CREATE INDEX IF NOT EXISTS idx_fotos_alias_foto ON fotos_alias (foto)")
+
+    def _esquema_tags(self, c):
+        # 2: índice de tags (clave sin acentos -> tareas)
+        c.execute('''CREATE TABLE IF NOT EXISTS tareas_tags (
+                    clave TEXT NOT NULL, tarea_id INTEGER NOT NULL, PRIMARY KEY (clave, tarea_id)) WITHOUT ROWID''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_tareas_tags_tarea ON tareas_tags (tarea_id)")
+        c.execute("""CREATE TRIGGER IF NOT EXISTS tareas_tags_delete AFTER DELETE ON tareas
+                     BEGIN DELETE FROM tareas_tags WHERE tarea_id=OLD.id; END""")
+        sin_indexar = c.execute("""SELECT id, tags FROM tareas t WHERE tags <> ''
+                                   AND NOT EXISTS (SELECT 1 FROM tareas_tags x WHERE x.tarea_id = t.id)""").fetchall()
+        for tarea_id, tags in sin_indexar: guardar_tags(c, tarea_id, tags)
+        if sin_indexar: log_bd.info("Tags indexados en %d tareas", len(sin_indexar))
+
+    def _esquema_adjuntos(self, c):
+        # 3: adjuntos (fotos de cada registro) y texto sin marcas
+        for tabla in CAMPO_MARCAS:
+            for columna in ("texto", "ref"):
+                try: c.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} TEXT")
+                except sqlite3.OperationalError: pass
+            # Filas aún sin separar (antiguas o escritas desde fuera de la app): se encuentran sin recorrer la tabla
+            c.execute(f"CREATE INDEX IF NOT EXISTS idx_{tabla}_sin_texto ON {tabla} (id) WHERE texto IS NULL")
+        c.execute('''CREATE TABLE IF NOT EXISTS adjuntos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    entidad TEXT NOT NULL, registro_id INTEGER NOT NULL, rol TEXT NOT NULL, foto TEXT NOT NULL)''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_adjuntos_registro ON adjuntos (entidad, registro_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_adjuntos_foto ON adjuntos (foto)")
+        for tabla in CAMPO_MARCAS:
+            c.execute(f"""CREATE TRIGGER IF NOT EXISTS adjuntos_{tabla}_delete AFTER DELETE ON {tabla}
+                          BEGIN DELETE FROM adjuntos WHERE entidad='{tabla}' AND registro_id=OLD.id; END""")
+        self._cambios_sin_derivados(c) # Separar todas las filas no debe apuntar un cambio por cada una
+        self.migrar_marcas(c)
+
+    def _indices_tareas(self, c):
+        # 4: búsqueda de la tarea que generó un aviso (descripción + fecha) sin recorrer la tabla
+        c.execute("CREATE INDEX IF NOT EXISTS idx_tareas_descripcion_fecha ON tareas (descripcion, fecha)")
+
+    def _indice_cambios_entidad(self, c):
+        # 5: último cambio de una entidad (firma de CacheRangosAvisos) sin recorrer el registro
+        c.execute("CREATE INDEX IF NOT EXISTS idx_cambios_entidad ON cambios (entidad, id)")
+
+    def _fts_texto(self, c):
+        # 6: el índice de texto completo pasa de 'descripcion' (con marcas de foto y matrícula) a 'texto'
+        self.migrar_marcas(c) # 'rebuild' lee 'texto' de la tabla: que no quede ninguna fila sin separar
+        for evento in ("insert", "delete", "update"): c.execute(f"DROP TRIGGER IF EXISTS tareas_fts_{evento}")
+        c.execute("DROP TABLE IF EXISTS tareas_fts")
+        self.inicializar_fts(c)
+
+    def _cambios_sin_derivados(self, c):
+        # 7: rellenar 'texto' y 'ref' (sacados de la descripción) no es un cambio que los móviles tengan que descargar
+        for tabla in TABLAS_SINCRONIZADAS: c.execute(f"DROP TRIGGER IF EXISTS cambios_{tabla}_update")
+        self.crear_triggers_cambios(c)
+
+    def _tags_por_palabra(self, c):
+        # 8: el índice de tags guarda también cada palabra del tag ("Cuadro Eléctrico" cuenta como eléctrico)
+        c.execute("DELETE FROM tareas_tags")
+        for tarea_id, tags in c.execute("SELECT id, tags FROM tareas WHERE tags <> ''").fetchall(): guardar_tags(c, tarea_id, tags)
+
+    MIGRACIONES = (_esquema_base, _esquema_tags, _esquema_adjuntos, _indices_tareas, _indice_cambios_entidad, _fts_texto,
+                   _cambios_sin_derivados, _tags_por_palabra)
+
+    def migrar_marcas(self, c):
+        """ Separa las marcas (y en tareas indexa los tags) de las filas que aún no lo están: la primera vez todas, después las escritas desde fuera """
+        filas = {tabla: c.execute(f"SELECT id, {campo}, {'tags' if tabla == 'tareas' else 'NULL'} FROM {tabla} WHERE texto IS NULL").fetchall()
+                 for tabla, campo in CAMPO_MARCAS.items()}
+        if not any(filas.values()): return
+        for tabla, pendientes in filas.items():
+            for registro_id, texto, tags in pendientes:
+                limpio, ref, fotos = separar_marcas(texto)
+                c.execute(f"UPDATE {tabla} SET texto=?, ref=? WHERE id=?", (limpio, ref, registro_id))
+                guardar_adjuntos(c, tabla, registro_id, fotos)
+                if tabla == "tareas": guardar_tags(c, registro_id, tags)
+        log_bd.info("Marcas separadas en %d registros", sum(len(f) for f in filas.values()))
+
+    def inicializar_fts(self, c):
+        # --- ÍNDICE DE TEXTO COMPLETO (FTS5) ---
+        # Sin acentos ni mayúsculas: "electrico" encuentra "Eléctrico". Se mantiene con triggers.
+        # Indexa el texto sin marcas; una fila escrita desde fuera aún no lo tiene y se indexa su descripción
+        # hasta que migrar_marcas() la separa (el trigger de UPDATE cambia una cosa por la otra).
+        try:
+            c.execute("SELECT 1 FROM sqlite_master WHERE name='tareas_fts'")
+            nuevo = c.fetchone() is None
+            c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS tareas_fts USING fts5(
+                        texto, tags, content='tareas', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2')''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS tareas_fts_insert AFTER INSERT ON tareas BEGIN
+                        INSERT INTO tareas_fts (rowid, texto, tags) VALUES (NEW.id, COALESCE(NEW.texto, NEW.descripcion), NEW.tags); END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS tareas_fts_delete AFTER DELETE ON tareas BEGIN
+                        INSERT INTO tareas_fts (tareas_fts, rowid, texto, tags) VALUES ('delete', OLD.id, COALESCE(OLD.texto, OLD.descripcion), OLD.tags); END''')
+            c.execute('''CREATE TRIGGER IF NOT EXISTS tareas_fts_update AFTER UPDATE OF descripcion, texto, tags ON tareas BEGIN
+                        INSERT INTO tareas_fts (tareas_fts, rowid, texto, tags) VALUES ('delete', OLD.id, COALESCE(OLD.texto, OLD.descripcion), OLD.tags);
+                        INSERT INTO tareas_fts (rowid, texto, tags) VALUES (NEW.id, COALESCE(NEW.texto, NEW.descripcion), NEW.tags); END''')
+            if nuevo: c.execute("INSERT INTO tareas_fts (tareas_fts) VALUES ('rebuild')") # Indexar lo que ya había
+            return True
+        except sqlite3.OperationalError as e:
+            log_bd.warning("FTS5 no disponible, la búsqueda usará LIKE: %s", e)
+            return False
+
+    def inicializar_registro_cambios(self, c):
+        # --- REGISTRO DE CAMBIOS (sincronización delta con el móvil) ---
+        # Lo rellenan triggers, así que cubre igual a la app de escritorio y a la API.
+        c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='cambios'")
+        registro_nuevo = c.fetchone() is None
+        c.execute('''CREATE TABLE IF NOT EXISTS cambios (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    entidad TEXT NOT NULL, entidad_id INTEGER NOT NULL, tipo TEXT NOT NULL,
+                    fecha TEXT DEFAULT CURRENT_TIMESTAMP)''')
+        self.crear_triggers_cambios(c)
+        if registro_nuevo:
+            # Lo que ya existía antes del registro no está apuntado: los cursores anteriores
+            # a esta marca obligan al móvil a una recarga completa.
+            minimo = 0
+            if any(c.execute(f"SELECT 1 FROM {t} LIMIT 1").fetchone() for t in TABLAS_SINCRONIZADAS):
+                c.execute("INSERT INTO cambios (entidad, entidad_id, tipo) VALUES ('registro', 0, 'inicio')")
+                minimo = c.lastrowid
+            c.execute("INSERT OR REPLACE INTO config (clave, valor) VALUES ('cambios_minimo', ?)", (str(minimo),))
+            c.execute("INSERT OR REPLACE INTO config (clave, valor) VALUES ('cambios_epoca', ?)", (uuid.uuid4().hex,))
+
+    def crear_triggers_cambios(self, c):
+        for tabla in TABLAS_SINCRONIZADAS:
+            # Las columnas derivadas de la descripción no cuentan como cambio (las rellena migrar_marcas)
+            columnas = ", ".join(info[1] for info in c.execute(f"PRAGMA table_info({tabla})").fetchall() if info[1] not in ("texto", "ref"))
+            for evento, fila in (("INSERT", "NEW"), (f"UPDATE OF {columnas}", "NEW"), ("DELETE", "OLD")):
+                tipo = evento.split()[0].lower()
+                c.execute(f"""CREATE TRIGGER IF NOT EXISTS cambios_{tabla}_{tipo} AFTER {evento} ON {tabla}
+                              BEGIN INSERT INTO cambios (entidad, entidad_id, tipo) VALUES ('{tabla}', {fila}.id, '{tipo}'); END""")
+
+    def podar_registros(self, c):
+        # Poda: los cambios viejos ya no le sirven a ningún móvil (el que llegue tarde recarga todo)
+        podado = c.execute("SELECT MAX(id) FROM cambios WHERE fecha < datetime('now', ?)", (f"-{DIAS_REGISTRO_CAMBIOS} days",)).fetchone()[0]
+        if podado:
+            c.execute("DELETE FROM cambios WHERE id <= ?", (podado,))
+            c.execute("INSERT OR REPLACE INTO config (clave, valor) VALUES ('cambios_minimo', ?)", (str(podado),))
+        c.execute("DELETE FROM idempotencia WHERE fecha < datetime('now', ?)", (f"-{DIAS_IDEMPOTENCIA} days",))
+
+    def cursor_cambios(self):
+        """ Último id del registro de cambios (el punto desde el que la interfaz está al día) """
+        try:
+            with self.lectura() as conn: fila = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='cambios'").fetchone()
+            return fila[0] if fila else 0
+        except sqlite3.Error: return None
+
+    def cambios_desde(self, desde, maximo=500):
+        """
+        Cambios posteriores al cursor 'desde' como (entidad, id, tipo), solo el último de
+        cada fila. Devuelve (cambios, cursor). 'cambios' es None si el cursor ya no sirve
+        (registro podado) o si hay más de 'maximo': entonces sale más barato recargarlo todo.
+        """
+        try:
+            with self.lectura() as conn:
+                fila = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='cambios'").fetchone()
+                actual = fila[0] if fila else 0
+                fila = conn.execute("SELECT valor FROM config WHERE clave='cambios_minimo'").fetchone()
+                if desde is None or desde < int(fila[0] if fila else 0) or desde > actual: return None, actual
+                filas = conn.execute("""SELECT entidad, entidad_id, tipo FROM cambios WHERE id IN (
+                                            SELECT MAX(id) FROM cambios WHERE id > ? AND id <= ? GROUP BY entidad, entidad_id)
+                                        ORDER BY id LIMIT ?""", (desde, actual, maximo + 1)).fetchall()
+                return (None if len(filas) > maximo else filas), actual
+        except sqlite3.Error: return None, None
 
     def set_config(self, clave, valor):
         try:
-            conn = self.conectar()
-            c = conn.cursor()
-            c.execute('INSERT OR REPLACE INTO config (clave, valor) VALUES (?, ?)', (clave, valor))
-            conn.commit()
-            conn.close()
+            self._ejecutar_escritura('INSERT OR REPLACE INTO config (clave, valor) VALUES (?, ?)', (clave, valor))
             return True
         except: return False
 
     def get_config(self, clave):
         try:
-            conn = self.conectar()
-            c = conn.cursor()
-            c.execute('SELECT valor FROM config WHERE clave = ?', (clave,))
-            res = c.fetchone()
-            conn.close()
+            with self.lectura() as conn: res = conn.execute('SELECT valor FROM config WHERE clave = ?', (clave,)).fetchone()
             return res[0] if res else None
         except: return None
 
     def agregar_aviso(self, titulo, fecha_inicio, frecuencia, duracion):
         try:
-            conn = self.conectar(); c = conn.cursor()
-            c.execute('INSERT INTO avisos_recurrentes (titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada) VALUES (?,?,?,?,?)',
-                      (titulo, fecha_inicio, frecuencia, duracion, ""))
-            conn.commit(); conn.close(); return True
+            self._ejecutar_escritura('INSERT INTO avisos_recurrentes (titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada) VALUES (?,?,?,?,?)',
+                                     (titulo, fecha_inicio, frecuencia, duracion, ""))
+            return True
         except Exception as e: return False
 
     def actualizar_aviso(self, id_aviso, titulo, fecha_inicio, frecuencia, duracion):
         try:
-            conn = self.conectar(); c = conn.cursor()
-            c.execute('UPDATE avisos_recurrentes SET titulo=?, fecha_inicio=?, frecuencia=?, duracion_dias=? WHERE id=?',
-                      (titulo, fecha_inicio, frecuencia, duracion, id_aviso))
-            conn.commit(); conn.close(); return True
+            self._ejecutar_escritura('UPDATE avisos_recurrentes SET titulo=?, fecha_inicio=?, frecuencia=?, duracion_dias=? WHERE id=?',
+                                     (titulo, fecha_inicio, frecuencia, duracion, id_aviso))
+            return True
         except: return False
 
     def obtener_avisos(self):
-        try: conn = self.conectar(); c = conn.cursor(); c.execute('SELECT id, titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada FROM avisos_recurrentes'); return c.fetchall()
+        try:
+            with self.lectura() as conn: return conn.execute('SELECT id, titulo, fecha_inicio, frecuencia, duracion_dias, ultima_completada FROM avisos_recurrentes').fetchall()
         except: return []
     def borrar_aviso(self, i):
-        try: conn = self.conectar(); c = conn.cursor(); c.execute('DELETE FROM avisos_recurrentes WHERE id=?', (i,)); conn.commit(); conn.close(); return True
-        except: return False
-    def marcar_aviso_completado(self, id_aviso, fecha_completada, estado):
-        try:
-            conn = self.conectar(); c = conn.cursor(); val = fecha_completada if estado else ""
-            c.execute('UPDATE avisos_recurrentes SET ultima_completada=? WHERE id=?', (val, id_aviso))
-            conn.commit(); conn.close(); return True
+        try: self._ejecutar_escritura('DELETE FROM avisos_recurrentes WHERE id=?', (i,)); return True
         except: return False
+    def completar_aviso_async(self, id_aviso, fecha, estado, titulo):
+        """
+        Marca (o desmarca) la ocurrencia del aviso y añade (o borra) su entrada del historial,
+        todo en una transacción del escritor. No espera: devuelve el Future.
+        """
+        desc_historial = f"Mantenimiento Preventivo: {titulo}"
+        def completar(conn):
+            conn.execute('UPDATE avisos_recurrentes SET ultima_completada=? WHERE id=?', (fecha if estado else "", id_aviso))
+            if estado:
+                guardar_con_marcas(conn, "tareas", {"fecha": fecha, "descripcion": desc_historial, "tags": "Preventivo, Aviso Recurrente"})
+            else:
+                conn.execute("DELETE FROM tareas WHERE fecha=? AND descripcion=?", (fecha, desc_historial))
+        return self.escribir_async(completar)
+
+    # Filas de tarea para las vistas: (id, fecha, texto sin marcas, tags, foto)
+    COLUMNAS_TAREA = f"id, fecha, COALESCE(texto, descripcion), tags, {sql_foto('tareas')}"
 
     def agregar_tarea(self, f, d, t):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('INSERT INTO tareas (fecha,descripcion,tags) VALUES (?,?,?)',(f,d,t)); conn.commit(); conn.close(); return True
+        try: self.escribir(lambda conn: guardar_con_marcas(conn, "tareas", {"fecha": f, "descripcion": d, "tags": t})); return True
         except: return False
-    def obtener_todas_cronologico(self):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('SELECT id,fecha,descripcion,tags FROM tareas ORDER BY fecha DESC'); return c.fetchall()
+    def obtener_todas_cronologico(self, limite=-1):
+        try:
+            with self.lectura() as conn: return conn.execute(f'SELECT {self.COLUMNAS_TAREA} FROM tareas ORDER BY fecha DESC, id DESC LIMIT ?', (limite,)).fetchall()
         except: return []
+    def estadisticas_tareas(self, mes):
+        """ (total, del mes 'yyyy-MM', {categoría: nº de tareas}) con las categorías de CATEGORIAS_TAGS """
+        casos = " ".join(f"WHEN clave GLOB '{patron_tag(tag)}' THEN '{cat}'" for cat, tags in CATEGORIAS_TAGS.items() for tag in tags)
+        patrones = [patron_tag(tag) for tags in CATEGORIAS_TAGS.values() for tag in tags]
+        try:
+            with self.lectura() as conn:
+                total = conn.execute("SELECT COUNT(*) FROM tareas").fetchone()[0]
+                del_mes = conn.execute("SELECT COUNT(*) FROM tareas WHERE fecha BETWEEN ? AND ?", (f"{mes}-01", f"{mes}-31")).fetchone()[0]
+                por_tag = dict(conn.execute(f"""SELECT CASE {casos} END AS cat, COUNT(DISTINCT tarea_id) FROM tareas_tags
+                                                WHERE {" OR ".join("clave GLOB ?" for _ in patrones)} GROUP BY cat""", patrones).fetchall())
+            return total, del_mes, {cat: por_tag.get(cat, 0) for cat in CATEGORIAS_TAGS}
+        except: return 0, 0, {cat: 0 for cat in CATEGORIAS_TAGS}
     def obtener_tareas_por_fecha(self,f):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('SELECT id,descripcion,tags FROM tareas WHERE fecha=?',(f,)); return c.fetchall()
+        try:
+            with self.lectura() as conn: return conn.execute(f'SELECT id, COALESCE(texto, descripcion), tags, {sql_foto("tareas")} FROM tareas WHERE fecha=?',(f,)).fetchall()
         except: return []
     def borrar_tarea(self,i):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('DELETE FROM tareas WHERE id=?',(i,)); conn.commit(); conn.close(); return True
+        try: self._ejecutar_escritura('DELETE FROM tareas WHERE id=?',(i,)); return True
         except: return False
     def actualizar_tarea(self,i,f,d,t):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('UPDATE tareas SET fecha=?,descripcion=?,tags=? WHERE id=?',(f,d,t,i)); conn.commit(); conn.close(); return True
+        try: self.escribir(lambda conn: guardar_con_marcas(conn, "tareas", {"fecha": f, "descripcion": d, "tags": t}, i)); return True
         except: return False
+    def guardar_foto(self, ruta_origen, carpeta, alias):
+        """ Copia una foto al almacén por contenido y apunta su nombre descriptivo. Devuelve (nombre, ruta) """
+        nombre, ruta, _, original = guardar_foto_por_contenido(ruta_origen, carpeta, alias, normalizador=self.normalizador)
+        # Sin esperar (la foto se elige antes de guardar el registro), pero un fallo no se pierde en silencio
+        futuro = self.escribir_async(lambda conn: anotar_alias_foto(conn, alias, nombre, original))
+        futuro.add_done_callback(lambda f: f.exception() and log_bd.error("No se pudo apuntar el alias '%s' de la foto %s: %s", alias, nombre, f.exception()))
+        return nombre, ruta
+    def foto_en_uso(self, nombre, excluir_tarea=None):
+        """ ¿Algún otro registro o pendiente apunta a esta foto? (antes de borrarla del disco) """
+        try:
+            with self.lectura() as conn:
+                # Filas sin separar todavía (escritas desde fuera): ahí solo queda mirar el texto
+                fila = conn.execute("""SELECT 1 FROM adjuntos WHERE foto=? AND NOT (entidad='tareas' AND registro_id IS ?)
+                                       UNION ALL SELECT 1 FROM tareas WHERE texto IS NULL AND instr(descripcion, ?) > 0 AND id IS NOT ?
+                                       UNION ALL SELECT 1 FROM pendientes WHERE texto IS NULL AND instr(detalles, ?) > 0 LIMIT 1""",
+                                    (nombre, excluir_tarea, nombre, excluir_tarea, nombre)).fetchone()
+            return fila is not None
+        except: return True # Ante la duda, no se borra
+    def plazos_avisos(self, desde, hasta):
+        try:
+            with self.lectura() as conn: return self.rangos_avisos.obtener(conn, desde, hasta)
+        except sqlite3.Error: return []
+    def fotos_de(self, entidad, registro_id):
+        try:
+            with self.lectura() as conn: return [f for (f,) in conn.execute("SELECT foto FROM adjuntos WHERE entidad=? AND registro_id=? ORDER BY id", (entidad, registro_id))]
+        except: return []
     def obtener_tarea_por_id(self,i):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('SELECT id,fecha,descripcion,tags FROM tareas WHERE id=?',(i,)); return c.fetchone()
+        try:
+            with self.lectura() as conn: return conn.execute('SELECT id,fecha,descripcion,tags FROM tareas WHERE id=?',(i,)).fetchone()
         except: return None
-    def buscar_tareas_avanzado(self, texto, fecha=None):
+    def buscar_tareas_avanzado(self, texto, fecha=None, con_fragmento=False, tags=()):
+        # Con texto y FTS5: ordenado por relevancia y, si se pide, con el fragmento que coincide («resaltado»).
+        # 'tags': la tarea debe tenerlos todos (sin distinguir acentos ni mayúsculas)
         try:
-            conn = self.conectar(); c = conn.cursor(); param_texto = f"%{texto}%"
-            query = "SELECT id, fecha, descripcion, tags FROM tareas WHERE (descripcion LIKE ? OR tags LIKE ?)"
-            parametros = [param_texto, param_texto]
-            if fecha: query += " AND fecha = ?"; parametros.append(fecha)
-            query += " ORDER BY fecha DESC"; c.execute(query, parametros); return c.fetchall()
+            filtro_tags = "".join(" AND {tabla}.id IN (SELECT tarea_id FROM tareas_tags WHERE clave GLOB ?)" for _ in tags)
+            claves = [patron_tag(tag) for tag in tags]
+            consulta = consulta_fts(texto) if self.usar_fts else ""
+            if consulta:
+                query = f'''SELECT t.id, t.fecha, COALESCE(t.texto, t.descripcion), t.tags, {sql_foto('tareas', alias='t')}, snippet(tareas_fts, -1, '«', '»', '…', 12)
+                           FROM tareas_fts f JOIN tareas t ON t.id = f.rowid WHERE tareas_fts MATCH ?'''
+                parametros = [consulta]
+                if fecha: query += " AND t.fecha = ?"; parametros.append(fecha)
+                query += filtro_tags.format(tabla="t"); parametros += claves
+                query += " ORDER BY f.rank"
+            else:
+                param_texto = f"%{texto}%"
+                query = f"SELECT {self.COLUMNAS_TAREA}, NULL FROM tareas WHERE (COALESCE(texto, descripcion) LIKE ? OR tags LIKE ?)"
+                parametros = [param_texto, param_texto]
+                if fecha: query += " AND fecha = ?"; parametros.append(fecha)
+                query += filtro_tags.format(tabla="tareas"); parametros += claves
+                query += " ORDER BY fecha DESC"
+            with self.lectura() as conn: filas = conn.execute(query, parametros).fetchall()
+            return filas if con_fragmento else [f[:5] for f in filas]
         except: return []
-    def obtener_fechas_con_tareas(self):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('SELECT DISTINCT fecha FROM tareas'); return [x[0] for x in c.fetchall()]
+    def obtener_fechas_con_tareas(self, fechas=None):
+        try:
+            with self.lectura() as conn:
+                if fechas is None: c=conn.execute('SELECT DISTINCT fecha FROM tareas')
+                else: fechas=list(fechas); c=conn.execute(f'SELECT DISTINCT fecha FROM tareas WHERE fecha IN ({",".join("?"*len(fechas))})', fechas)
+                return [x[0] for x in c.fetchall()]
         except: return []
+    def obtener_tareas_por_ids(self, ids):
+        try:
+            ids=list(ids)
+            with self.lectura() as conn: filas=conn.execute(f'SELECT {self.COLUMNAS_TAREA} FROM tareas WHERE id IN ({",".join("?"*len(ids))})', ids).fetchall()
+            return {f[0]: f for f in filas}
+        except: return {}
     def obtener_todas_las_descripciones(self):
         try:
-            conn=self.conectar(); c=conn.cursor(); c.execute('SELECT DISTINCT descripcion FROM tareas'); l=[]
-            for r in c.fetchall(): t=re.sub(r"\[FOTO:.*?\]","",r[0]).strip().split('\n')[0].replace("[DESDE PENDIENTES] ","").strip(); (l.append(t) if t else None)
-            conn.close(); return sorted(list(set(l)))
+            with self.lectura() as conn: filas=conn.execute('SELECT DISTINCT COALESCE(texto, descripcion) FROM tareas').fetchall()
+            l=[]
+            for r in filas: t=r[0].split('\n')[0].replace("[DESDE PENDIENTES] ","").strip(); (l.append(t) if t else None)
+            return sorted(list(set(l)))
         except: return []
     def marcar_dia_especial(self,f,t):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('INSERT OR REPLACE INTO dias_especiales (fecha,tipo) VALUES (?,?)',(f,t)); conn.commit(); conn.close(); return True
+        try: self._ejecutar_escritura('INSERT OR REPLACE INTO dias_especiales (fecha,tipo) VALUES (?,?)',(f,t)); return True
         except: return False
     def borrar_dia_especial(self,f):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('DELETE FROM dias_especiales WHERE fecha=?',(f,)); conn.commit(); conn.close(); return True
+        try: self._ejecutar_escritura('DELETE FROM dias_especiales WHERE fecha=?',(f,)); return True
         except: return False
     def obtener_dias_especiales(self):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('SELECT fecha,tipo FROM dias_especiales'); return {r[0]:r[1] for r in c.fetchall()}
+        try:
+            with self.lectura() as conn: return dict(conn.execute('SELECT fecha,tipo FROM dias_especiales').fetchall())
         except: return {}
     def agregar_pendiente(self,t,d):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('INSERT INTO pendientes (titulo,detalles) VALUES (?,?)',(t,d)); conn.commit(); conn.close(); return True
+        try: self.escribir(lambda conn: guardar_con_marcas(conn, "pendientes", {"titulo": t, "detalles": d})); return True
         except: return False
     def obtener_pendientes(self):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('SELECT id,titulo,detalles FROM pendientes ORDER BY id DESC'); return c.fetchall()
+        try:
+            # (id, titulo, detalles con marcas para editar, texto sin marcas, foto)
+            with self.lectura() as conn: return conn.execute(f'SELECT id, titulo, detalles, COALESCE(texto, detalles), {sql_foto("pendientes")} FROM pendientes ORDER BY id DESC').fetchall()
         except: return []
     def borrar_pendiente(self,i):
-        try: conn=self.conectar(); c=conn.cursor(); c.execute('DELETE FROM pendientes WHERE id=?',(i,)); conn.commit(); conn.close(); return True
+        try: self._ejecutar_escritura('DELETE FROM pendientes WHERE id=?',(i,)); return True
         except: return False
     def actualizar_pendiente(self, i, t, d):
         try:
-            conn = self.conectar(); c = conn.cursor()
-            c.execute('UPDATE pendientes SET titulo=?, detalles=? WHERE id=?', (t, d, i))
-            conn.commit(); conn.close(); return True
+            self.escribir(lambda conn: guardar_con_marcas(conn, "pendientes", {"titulo": t, "detalles": d}, i))
+            return True
         except: return False
 
 class GestorFestivos:
@@ -1242,6 +3385,7 @@ class EditDialog(QDialog):
     def __init__(self, parent=None, fecha="", desc="", tags=""):
         super().__init__(parent)
         self.carpeta_fotos = parent.carpeta_fotos if parent else ""
+        self.db = parent.db if parent else None
         self.foto_filename = None
         self.ref_oculta = ""
         self.setWindowTitle("Editar Registro")
@@ -1331,8 +3475,8 @@ class EditDialog(QDialog):
         if dlg.exec() and dlg.selectedFiles(): self.procesar_nueva_foto(dlg.selectedFiles()[0])
     def procesar_nueva_foto(self, ruta_origen):
         try:
-            nuevo = f"pc_drag_{datetime.now().strftime('%Y%m%d_%H%M%S')}{os.path.splitext(ruta_origen)[1]}"; destino = os.path.join(self.carpeta_fotos, nuevo)
-            shutil.copy2(ruta_origen, destino); self.foto_filename = nuevo; self.actualizar_vista_foto()
+            alias = f"pc_drag_{datetime.now().strftime('%Y%m%d_%H%M%S')}{os.path.splitext(ruta_origen)[1]}"
+            self.foto_filename, _ = self.db.guardar_foto(ruta_origen, self.carpeta_fotos, alias); self.actualizar_vista_foto()
         except Exception as e: QMessageBox.critical(self, "Error", str(e))
 
     def abrir_o_buscar_d(self, event):
@@ -1343,8 +3487,8 @@ class EditDialog(QDialog):
         if dlg.exec() and dlg.selectedFiles(): self.procesar_nueva_foto_d(dlg.selectedFiles()[0])
     def procesar_nueva_foto_d(self, ruta_origen):
         try:
-            nuevo = f"pc_drag_d_{datetime.now().strftime('%Y%m%d_%H%M%S')}{os.path.splitext(ruta_origen)[1]}"; destino = os.path.join(self.carpeta_fotos, nuevo)
-            shutil.copy2(ruta_origen, destino); self.foto_despues_filename = nuevo; self.actualizar_vista_foto()
+            alias = f"pc_drag_d_{datetime.now().strftime('%Y%m%d_%H%M%S')}{os.path.splitext(ruta_origen)[1]}"
+            self.foto_despues_filename, _ = self.db.guardar_foto(ruta_origen, self.carpeta_fotos, alias); self.actualizar_vista_foto()
         except Exception as e: QMessageBox.critical(self, "Error", str(e))
     def get_data(self):
         d = self.te.toPlainText().strip()
@@ -1398,6 +3542,7 @@ class CompleteDialog(QDialog):
     def __init__(self, parent=None, titulo="", detalles=""):
         super().__init__(parent)
         self.carpeta_fotos = parent.carpeta_fotos if parent else ""
+        self.db = parent.db if parent else None
         self.foto_filename = None
         self.setWindowTitle(f"Completar: {titulo}"); self.resize(500, 550); l = QVBoxLayout()
         lbl_info = QLabel(f"<b>Trabajo:</b> {titulo}<br><i>{detalles}</i>"); lbl_info.setWordWrap(True); lbl_info.setStyleSheet("background-color: #333; padding: 10px; border-radius: 5px; color: #eee;"); l.addWidget(lbl_info)
@@ -1422,8 +3567,7 @@ class CompleteDialog(QDialog):
     def procesar_foto(self, ruta):
         try:
             ts = datetime.now().strftime("%Y%m%d_%H%M%S"); ext = os.path.splitext(ruta)[1]
-            nuevo = f"pc_complete_{ts}{ext}"; dest = os.path.join(self.carpeta_fotos, nuevo)
-            shutil.copy2(ruta, dest); self.foto_filename = nuevo
+            self.foto_filename, dest = self.db.guardar_foto(ruta, self.carpeta_fotos, f"pc_complete_{ts}{ext}")
             self.lbl_foto.setPixmap(QPixmap(dest).scaled(self.lbl_foto.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
             self.lbl_foto.setStyleSheet("border: 2px solid #3daee9;")
         except Exception as e: QMessageBox.critical(self, "Error", str(e))
@@ -1455,6 +3599,92 @@ class AvisoEditDialog(QDialog):
         b.accepted.connect(self.accept); b.rejected.connect(self.reject); l.addWidget(b); self.setLayout(l)
     def get_data(self): return (self.titulo.text(), self.inicio.date().toString("yyyy-MM-dd"), self.freq.currentText(), self.dur.value())
 
+class DialogoConfigServidor(QDialog):
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("⚙️ Servidor de Sincronización"); self.resize(460, 560)
+        l = QVBoxLayout()
+        g = QGroupBox("Motor HTTP"); gl = QGridLayout()
+        self.combo_modo = QComboBox(); self.combo_modo.addItem("Producción (pool de hilos, keep-alive)", "produccion"); self.combo_modo.addItem("Desarrollo (Werkzeug)", "desarrollo")
+        idx = self.combo_modo.findData(db.get_config("servidor_modo") or "produccion"); self.combo_modo.setCurrentIndex(max(idx, 0))
+        gl.addWidget(QLabel("Modo:"), 0, 0); gl.addWidget(self.combo_modo, 0, 1)
+        self.spin_hilos = QSpinBox(); self.spin_hilos.setRange(2, 64); self.spin_hilos.setValue(int(db.get_config("servidor_hilos") or 16))
+        gl.addWidget(QLabel("Hilos:"), 1, 0); gl.addWidget(self.spin_hilos, 1, 1)
+        self.spin_timeout = QSpinBox(); self.spin_timeout.setRange(5, 300); self.spin_timeout.setValue(int(db.get_config("servidor_timeout") or 30)); self.spin_timeout.setSuffix(" s")
+        gl.addWidget(QLabel("Timeout petición:"), 2, 0); gl.addWidget(self.spin_timeout, 2, 1)
+        self.combo_modo.currentIndexChanged.connect(self.toggle_modo); self.toggle_modo()
+        g.setLayout(gl); l.addWidget(g)
+        g2 = QGroupBox("Fotos"); gl2 = QGridLayout()
+        self.spin_foto = QSpinBox(); self.spin_foto.setRange(1, 500); self.spin_foto.setValue(int(db.get_config("foto_max_mb") or 25)); self.spin_foto.setSuffix(" MB")
+        gl2.addWidget(QLabel("Tamaño máximo por foto:"), 0, 0); gl2.addWidget(self.spin_foto, 0, 1)
+        self.chk_normalizar = QCheckBox("Reducir y girar las fotos al recibirlas"); self.chk_normalizar.setChecked((db.get_config("foto_normalizar") or "1") == "1")
+        gl2.addWidget(self.chk_normalizar, 1, 0, 1, 2)
+        self.spin_lado = QSpinBox(); self.spin_lado.setRange(640, 8000); self.spin_lado.setSingleStep(256); self.spin_lado.setValue(int(db.get_config("foto_lado_max") or 2048)); self.spin_lado.setSuffix(" px")
+        gl2.addWidget(QLabel("Lado máximo:"), 2, 0); gl2.addWidget(self.spin_lado, 2, 1)
+        self.spin_calidad = QSpinBox(); self.spin_calidad.setRange(50, 95); self.spin_calidad.setValue(int(db.get_config("foto_calidad") or 85))
+        gl2.addWidget(QLabel("Calidad JPEG:"), 3, 0); gl2.addWidget(self.spin_calidad, 3, 1)
+        self.chk_originales = QCheckBox("Guardar el original en 'fotos_originales' (fuera del backup)"); self.chk_originales.setChecked(db.get_config("foto_archivar_original") == "1")
+        gl2.addWidget(self.chk_originales, 4, 0, 1, 2)
+        self.chk_normalizar.toggled.connect(self.toggle_normalizar); self.toggle_normalizar()
+        g2.setLayout(gl2); l.addWidget(g2)
+        g3 = QGroupBox("Carga (peticiones simultáneas)"); gl3 = QGridLayout(); self.spins_limite = {}
+        for fila, (clase, texto) in enumerate((("subidas", "Subidas:"), ("lecturas", "Consultas:"), ("fotos", "Descargas de fotos:"))):
+            spin = QSpinBox(); spin.setRange(1, 64); spin.setValue(int(db.get_config(f"limite_{clase}") or ServidorSincronizacion.LIMITES_CONCURRENCIA[clase]))
+            gl3.addWidget(QLabel(texto), fila, 0); gl3.addWidget(spin, fila, 1); self.spins_limite[clase] = spin
+        self.spin_cola = QSpinBox(); self.spin_cola.setRange(0, 100); self.spin_cola.setValue(int(db.get_config("limite_cola") or ServidorSincronizacion.COLA_ESPERA))
+        self.spin_cola.setToolTip("Peticiones que esperan turno antes de contestar 503 (0 = rechazar enseguida)")
+        gl3.addWidget(QLabel("Cola de espera:"), 3, 0); gl3.addWidget(self.spin_cola, 3, 1)
+        g3.setLayout(gl3); l.addWidget(g3)
+        l.addWidget(QLabel("Los cambios se aplican al reiniciar el programa."))
+        b = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel); b.accepted.connect(self.accept); b.rejected.connect(self.reject); l.addWidget(b); self.setLayout(l)
+    def toggle_modo(self):
+        produccion = self.combo_modo.currentData() == "produccion"; self.spin_hilos.setEnabled(produccion); self.spin_timeout.setEnabled(produccion)
+    def toggle_normalizar(self):
+        activo = self.chk_normalizar.isChecked()
+        for w in (self.spin_lado, self.spin_calidad, self.chk_originales): w.setEnabled(activo)
+    def get_data(self):
+        return (self.combo_modo.currentData(), self.spin_hilos.value(), self.spin_timeout.value(), self.spin_foto.value(),
+                self.chk_normalizar.isChecked(), self.spin_lado.value(), self.spin_calidad.value(), self.chk_originales.isChecked(),
+                {clase: spin.value() for clase, spin in self.spins_limite.items()}, self.spin_cola.value())
+
+class DialogoMetricas(QDialog):
+    """ Panel de métricas del servidor: se refresca solo mientras está abierto """
+    COLUMNAS = ("Ruta", "Peticiones", "Errores %", "p50 ms", "p95 ms", "p99 ms", "KB recibidos", "KB enviados", "BD ms/pet.")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("📈 Estado del Servidor"); self.resize(900, 420)
+        l = QVBoxLayout()
+        self.lbl_estado = QLabel(); l.addWidget(self.lbl_estado)
+        self.tabla = QTableWidget(0, len(self.COLUMNAS)); self.tabla.setHorizontalHeaderLabels(self.COLUMNAS)
+        self.tabla.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.tabla.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        l.addWidget(self.tabla)
+        h = QHBoxLayout()
+        btn_reiniciar = QPushButton("Poner a cero"); btn_reiniciar.clicked.connect(self.reiniciar); h.addWidget(btn_reiniciar)
+        h.addStretch()
+        b = QDialogButtonBox(QDialogButtonBox.StandardButton.Close); b.rejected.connect(self.reject); h.addWidget(b)
+        l.addLayout(h); self.setLayout(l)
+        self.timer = QTimer(self); self.timer.timeout.connect(self.actualizar); self.timer.start(2000)
+        self.actualizar()
+
+    def reiniciar(self):
+        METRICAS.reiniciar(); self.actualizar()
+
+    def actualizar(self):
+        filas = METRICAS.resumen()
+        total = sum(f["peticiones"] for f in filas)
+        self.lbl_estado.setText(f"Peticiones: {total}   ·   En curso: {METRICAS.en_curso}   ·   Versión BD: {VERSION_BD.valor}")
+        self.tabla.setRowCount(len(filas))
+        for i, f in enumerate(filas):
+            valores = (f["ruta"], str(f["peticiones"]), f"{f['errores_pct']:.1f}", f"{f['p50']:.1f}", f"{f['p95']:.1f}", f"{f['p99']:.1f}",
+                       f"{f['entrada'] / 1024:.0f}", f"{f['salida'] / 1024:.0f}", f"{f['bd_ms']:.1f}")
+            for j, v in enumerate(valores):
+                item = QTableWidgetItem(v)
+                if j: item.setTextAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+                if j == 2 and f["errores_pct"] >= 5: item.setForeground(QBrush(QColor("#c0392b")))
+                self.tabla.setItem(i, j, item)
+
 class DialogoExportarPDF(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -1480,6 +3710,8 @@ class DialogoExportarPDF(QDialog):
 # ==========================================
 
 class MaintenanceApp(QMainWindow):
+    aviso_guardado = pyqtSignal(str, bool, str) # título, marcado, error ("" si se guardó)
+
     def __init__(self):
         super().__init__()
         self.db = GestorBaseDatos()
@@ -1520,9 +3752,27 @@ class MaintenanceApp(QMainWindow):
 
         self.qr_dialog = None
         self.settings = QSettings("MyCompany", "MantenimientoApp")
-        self.server_thread = ServidorSincronizacion(self.carpeta_fotos, self.db.db_name)
+        # Misma normalización para las fotos del móvil y las que se adjuntan desde el PC
+        self.db.normalizador = NormalizadorFotos.desde_config(self.db, self.carpeta_fotos)
+        # Niveles guardados en la config; MANTPRO_LOG tiene la última palabra
+        aplicar_niveles_log(",".join(filter(None, [self.db.get_config("log_niveles"), os.environ.get("MANTPRO_LOG")])))
+        self.server_thread = ServidorSincronizacion(self.carpeta_fotos, self.db.db_name,
+                                                    modo=self.db.get_config("servidor_modo") or "produccion",
+                                                    hilos=int(self.db.get_config("servidor_hilos") or 16),
+                                                    timeout=int(self.db.get_config("servidor_timeout") or 30),
+                                                    max_foto_mb=int(self.db.get_config("foto_max_mb") or 25),
+                                                    normalizador=self.db.normalizador,
+                                                    limites={clase: int(self.db.get_config(f"limite_{clase}") or n)
+                                                             for clase, n in ServidorSincronizacion.LIMITES_CONCURRENCIA.items()},
+                                                    cola_espera=int(self.db.get_config("limite_cola") or ServidorSincronizacion.COLA_ESPERA))
         self.server_thread.registro_recibido.connect(self.on_registro_recibido)
-        self.server_thread.pendiente_actualizado.connect(self.refresh_all)
+        # Cada petición del móvil solo abre (o alarga) la ventana de agrupación; ver aplicar_cambios()
+        self.cursor_cambios = None; self.busqueda_obsoleta = False
+        self.avisos_calendario = {} # 'yyyy-MM-dd' -> estado del plazo de aviso más urgente de ese día
+        self.timer_cambios = QTimer(self); self.timer_cambios.setSingleShot(True); self.timer_cambios.setInterval(self.VENTANA_CAMBIOS_MS)
+        self.timer_cambios.timeout.connect(self.aplicar_cambios)
+        self.server_thread.pendiente_actualizado.connect(self.programar_cambios)
+        self.aviso_guardado.connect(self.on_aviso_guardado) # Lo emite el hilo escritor: llega en cola al hilo de la interfaz
         self.server_thread.start()
         self.setWindowTitle("Control Mantenimiento")
         self.resize(1100, 750)
@@ -1553,12 +3803,21 @@ class MaintenanceApp(QMainWindow):
     def closeEvent(self, e):
         self.settings.setValue("geometry", self.saveGeometry())
 
-        # 1. Limpieza de fotos antes del backup
-        print("Iniciando limpieza de fotos...")
+        # 0. Parar el servidor antes de tocar fotos/BD para que no entren escrituras a medias
+        log_app.info("Deteniendo servidor de sincronización...")
+        self.server_thread.detener()
+        detener_pool_fotos()
+
+        # 1. Limpieza de fotos antes del backup (todavía escribe: borra alias de fotos que ya no existen)
+        log_app.info("Iniciando limpieza de fotos...")
         self.limpiar_fotos_huerfanas(silencioso=True)
+        # Ya no hay más escrituras: el escritor vacía su cola y cierra la única conexión de escritura
+        detener_escritores()
+        # Quedan las de lectura de la interfaz; al cerrar la última, SQLite vuelca el WAL y el .db del zip queda completo
+        self.db.cerrar_conexiones()
 
         # 2. Backup automático
-        print("Iniciando Auto-Backup...")
+        log_app.info("Iniciando Auto-Backup...")
         try:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             nombre_zip = f"auto_backup_full_{timestamp}.zip"
@@ -1580,15 +3839,16 @@ class MaintenanceApp(QMainWindow):
                 if os.path.isfile(ruta_completa) and f.startswith("auto_backup_full_") and f.endswith(".zip"): backups.append(ruta_completa)
             backups.sort(key=os.path.getmtime)
             while len(backups) > 3: archivo_a_borrar = backups.pop(0); os.remove(archivo_a_borrar)
-        except Exception as ex: print(f"Error en auto-backup: {ex}")
+        except Exception as ex: log_app.exception("Error en auto-backup: %s", ex)
+        # Los logs no se paran aquí: aún puede escribirse algo hasta que acabe el proceso (lo hace atexit)
         super().closeEvent(e)
 
     def on_registro_recibido(self, titulo, detalles, tags, filename, ruta_foto):
         if self.qr_dialog: self.qr_dialog.accept(); self.qr_dialog = None
 
         # ELIMINADO EL GUARDADO DUPLICADO (self.db.agregar_tarea).
-        # La BD ya se actualizó en la API, así que solo refrescamos la vista:
-        self.refresh_all()
+        # La BD ya se actualizó en la API, así que solo refrescamos lo que ha cambiado:
+        self.programar_cambios()
         self.statusBar().showMessage(f"📲 Recibido: {titulo}", 4000)
 
     def mostrar_dialogo_qr(self):
@@ -1611,22 +3871,8 @@ class MaintenanceApp(QMainWindow):
         elif "Día Libre" in ti: c = "#F48FB1"
         self.lbl_info.setStyleSheet(f"font-weight:bold; font-size:16px; color:{c};"); self.lbl_info.setText(ti)
 
-        for aid, tit, finicio, freq, dur, ult in self.db.obtener_avisos():
-            if not finicio: continue
-            fi = QDate.fromString(finicio, "yyyy-MM-dd")
-            if not freq: freq = "Anual"
-            ocurrencia = fi
-            while ocurrencia.addDays(dur) < sd:
-                if freq == "Diario": ocurrencia = ocurrencia.addDays(1)
-                elif freq == "Semanal": ocurrencia = ocurrencia.addDays(7)
-                elif freq == "Mensual": ocurrencia = ocurrencia.addMonths(1)
-                elif freq == "Trimestral": ocurrencia = ocurrencia.addMonths(3)
-                elif freq == "Semestral": ocurrencia = ocurrencia.addMonths(6)
-                elif freq == "Anual": ocurrencia = ocurrencia.addYears(1)
-                else: break
-            ff = ocurrencia.addDays(dur)
-            if ocurrencia <= sd <= ff:
-                es_completado = (ult == ocurrencia.toString("yyyy-MM-dd"))
+        for (aid, tit, *_), _, _, activa, es_completado in estados_avisos(self.db.obtener_avisos(), sd.toPyDate()):
+            if activa:
                 color_bg = "#27ae60" if es_completado else "#e74c3c"
                 estado_txt = "[OK]" if es_completado else "[PENDIENTE]"
                 it = QListWidgetItem(f"⚠️ AVISO: {tit} {estado_txt}")
@@ -1636,71 +3882,60 @@ class MaintenanceApp(QMainWindow):
         ts = self.db.obtener_tareas_por_fecha(sds)
         if not ts and self.task_list.count() == 0: self.task_list.addItem("--- Día no laborable ---" if ets else "--- Nada registrado ---")
         for t in ts:
-            # --- LIMPIEZA VISUAL COMPLETA ---
-            texto_limpio = re.sub(r"\[FOTO:.*?\]", "", t[1])
-            texto_limpio = re.sub(r"\[REF:.*?\]", "", texto_limpio).strip()
-            # --------------------------------
-
-            it = QListWidgetItem(f"{texto_limpio} | {t[2]}")
-            if "[FOTO:" in t[1]: it.setIcon(QIcon.fromTheme("camera-photo")); it.setToolTip("Tiene foto adjunta")
+            it = QListWidgetItem(f"{t[1]} | {t[2]}")
+            if t[3]: it.setIcon(QIcon.fromTheme("camera-photo")); it.setToolTip("Tiene foto adjunta")
             it.setData(Qt.ItemDataRole.UserRole, t[0])
             self.task_list.addItem(it)
 
-    def fill_t(self, table, data):
-        table.setRowCount(len(data))
+    def iconos_tabla(self):
         pm_foto = QPixmap(16, 16); pm_foto.fill(QColor("#3daee9")); icon_foto = QIcon(pm_foto)
         pm_vacio = QPixmap(16, 16); pm_vacio.fill(Qt.GlobalColor.transparent); icon_vacio = QIcon(pm_vacio)
+        return icon_foto, icon_vacio
 
-        for r, (id_t, fecha, desc, tags) in enumerate(data):
-            # LIMPIEZA VISUAL (FOTO Y REF)
-            desc_limpia = re.sub(r"\[FOTO:.*?\]", "", desc)
-            desc_limpia = re.sub(r"\[REF:.*?\]", "", desc_limpia).strip()
-
-            desc_visual = desc_limpia.replace("\n", "  ➜  ")
-
-            tags_lower = tags.lower(); color_bg = None
-            if any(x in tags_lower for x in ["urgente", "avería", "rotura", "fallo", "paro"]): color_bg = QColor("#5a2d2d")
-            elif any(x in tags_lower for x in ["preventivo", "revisión", "ok", "limpieza"]): color_bg = QColor("#2d4a2d")
-            elif "eléctrico" in tags_lower or "cuadro" in tags_lower: color_bg = QColor("#2d3b5a")
-            elif "mecánico" in tags_lower: color_bg = QColor("#5a4a2d")
-
-            item_f = QTableWidgetItem(fecha); item_f.setData(Qt.ItemDataRole.UserRole, id_t)
-            item_d = QTableWidgetItem(desc_visual); item_d.setToolTip(desc_limpia)
-
-            if "[FOTO:" in desc:
-                item_d.setIcon(icon_foto)
-                item_d.setToolTip(f"📸 CON FOTO ADJUNTA\n\n{desc_limpia}")
-            else:
-                item_d.setIcon(icon_vacio)
+    def fill_t(self, table, data):
+        table.setRowCount(len(data))
+        iconos = self.iconos_tabla()
+        for r, fila in enumerate(data):
+            for col, item in enumerate(self.items_tarea(*fila, iconos)): table.setItem(r, col, item)
+
+    def items_tarea(self, id_t, fecha, desc_limpia, tags, foto, iconos):
+        """ Las tres celdas (fecha, descripción, tags) de una tarea en las tablas de registros """
+        icon_foto, icon_vacio = iconos
+        desc_visual = desc_limpia.replace("\n", "  ➜  ")
+
+        tags_lower = tags.lower(); color_bg = None
+        if any(x in tags_lower for x in ["urgente", "avería", "rotura", "fallo", "paro"]): color_bg = QColor("#5a2d2d")
+        elif any(x in tags_lower for x in ["preventivo", "revisión", "ok", "limpieza"]): color_bg = QColor("#2d4a2d")
+        elif "eléctrico" in tags_lower or "cuadro" in tags_lower: color_bg = QColor("#2d3b5a")
+        elif "mecánico" in tags_lower: color_bg = QColor("#5a4a2d")
+
+        item_f = QTableWidgetItem(fecha); item_f.setData(Qt.ItemDataRole.UserRole, id_t)
+        item_d = QTableWidgetItem(desc_visual); item_d.setToolTip(desc_limpia)
+
+        if foto:
+            item_d.setIcon(icon_foto)
+            item_d.setToolTip(f"📸 CON FOTO ADJUNTA\n\n{desc_limpia}")
+        else:
+            item_d.setIcon(icon_vacio)
 
-            item_t = QTableWidgetItem(tags)
+        item_t = QTableWidgetItem(tags)
 
-            if color_bg:
-                item_f.setBackground(color_bg); item_d.setBackground(color_bg); item_t.setBackground(color_bg)
+        if color_bg:
+            item_f.setBackground(color_bg); item_d.setBackground(color_bg); item_t.setBackground(color_bg)
 
-            table.setItem(r, 0, item_f); table.setItem(r, 1, item_d); table.setItem(r, 2, item_t)
+        return item_f, item_d, item_t
 
     def search(self):
+        self.busqueda_obsoleta = False
         texto = self.s_in.text().strip(); fecha = None
         if self.s_chk_date.isChecked(): fecha = self.s_date.date().toString("yyyy-MM-dd")
-        resultados = self.db.buscar_tareas_avanzado(texto, fecha)
-        self.fill_t(self.s_table, resultados)
-        filtros_activos = []
-        if self.chk_s_urg.isChecked(): filtros_activos.append("urgente")
-        if self.chk_s_elec.isChecked(): filtros_activos.append("léctrico")
-        if self.chk_s_mec.isChecked(): filtros_activos.append("ecánico")
-        if self.chk_s_prev.isChecked(): filtros_activos.append("preventivo")
-        filas_visibles = 0
-        for row in range(self.s_table.rowCount()):
-            item_tags = self.s_table.item(row, 2).text().lower()
-            mostrar = True
-            for f in filtros_activos:
-                if f not in item_tags:
-                    sin_tilde = f.replace("léctrico", "lectrico").replace("ecánico", "ecanico")
-                    if sin_tilde not in item_tags: mostrar = False; break
-            self.s_table.setRowHidden(row, not mostrar)
-            if mostrar: filas_visibles += 1
-        self.statusBar().showMessage(f"🔍 Mostrando {filas_visibles} resultados", 3000)
+        filtros = [tag for chk, tag in ((self.chk_s_urg, "urgente"), (self.chk_s_elec, "electrico"),
+                                        (self.chk_s_mec, "mecanico"), (self.chk_s_prev, "preventivo")) if chk.isChecked()]
+        resultados = self.db.buscar_tareas_avanzado(texto, fecha, con_fragmento=True, tags=filtros)
+        self.fill_t(self.s_table, [r[:5] for r in resultados])
+        for row, r in enumerate(resultados):
+            if r[5]: item = self.s_table.item(row, 1); item.setToolTip(f"🔎 {r[5]}\n\n{item.toolTip()}")
+        self.statusBar().showMessage(f"🔍 Mostrando {len(resultados)} resultados", 3000)
 
     def refresh_history(self): self.fill_t(self.h_table, self.db.obtener_todas_cronologico())
     def crear_menu(self):
@@ -1740,9 +3975,31 @@ class MaintenanceApp(QMainWindow):
         tm.addAction(act_prov)
         # ---------------------------------
 
+        tm.addAction(QAction("⚙️ Servidor de Sincronización", self, triggered=self.configurar_servidor))
+        tm.addAction(QAction("📈 Estado del Servidor", self, triggered=self.mostrar_metricas))
+
         fm.addSeparator()
         tm.addAction(QAction("🧹 Limpiar Fotos Basura", self, triggered=self.limpiar_fotos_huerfanas))
 
+    def configurar_servidor(self):
+        dlg = DialogoConfigServidor(self.db, self)
+        if dlg.exec():
+            modo, hilos, timeout, foto_mb, normalizar, lado, calidad, originales, limites, cola = dlg.get_data()
+            self.db.set_config("servidor_modo", modo)
+            self.db.set_config("servidor_hilos", str(hilos))
+            self.db.set_config("servidor_timeout", str(timeout))
+            self.db.set_config("foto_max_mb", str(foto_mb))
+            self.db.set_config("foto_normalizar", "1" if normalizar else "0")
+            self.db.set_config("foto_lado_max", str(lado))
+            self.db.set_config("foto_calidad", str(calidad))
+            self.db.set_config("foto_archivar_original", "1" if originales else "0")
+            for clase, n in limites.items(): self.db.set_config(f"limite_{clase}", str(n))
+            self.db.set_config("limite_cola", str(cola))
+            QMessageBox.information(self, "Servidor", "✅ Configuración guardada.\nSe aplicará la próxima vez que abras el programa.")
+
+    def mostrar_metricas(self):
+        DialogoMetricas(self).exec()
+
     def cambiar_provincia(self):
         # Abre el diálogo para seleccionar la provincia
         dlg = DialogoSeleccionRegion(self.db, self)
@@ -1847,8 +4104,7 @@ class MaintenanceApp(QMainWindow):
     def procesar_foto_entry_d(self, ruta_origen):
         try:
             ts = datetime.now().strftime("%Y%m%d_%H%M%S"); ext = os.path.splitext(ruta_origen)[1]
-            nuevo = f"pc_entry_d_{ts}{ext}"; destino = os.path.join(self.carpeta_fotos, nuevo)
-            shutil.copy2(ruta_origen, destino); self.entry_foto_despues_filename = nuevo
+            self.entry_foto_despues_filename, destino = self.db.guardar_foto(ruta_origen, self.carpeta_fotos, f"pc_entry_d_{ts}{ext}")
             pix = QPixmap(destino); self.lbl_entry_foto_d.setPixmap(pix.scaled(self.lbl_entry_foto_d.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
             self.lbl_entry_foto_d.setStyleSheet("border: 2px solid #2ecc71;"); self.lbl_entry_foto_d.setText(""); self.btn_del_foto_d.show()
         except Exception as e: QMessageBox.critical(self, "Error", str(e))
@@ -1862,8 +4118,7 @@ class MaintenanceApp(QMainWindow):
     def procesar_foto_entry(self, ruta_origen):
         try:
             ts = datetime.now().strftime("%Y%m%d_%H%M%S"); ext = os.path.splitext(ruta_origen)[1]
-            nuevo = f"pc_entry_{ts}{ext}"; destino = os.path.join(self.carpeta_fotos, nuevo)
-            shutil.copy2(ruta_origen, destino); self.entry_foto_filename = nuevo
+            self.entry_foto_filename, destino = self.db.guardar_foto(ruta_origen, self.carpeta_fotos, f"pc_entry_{ts}{ext}")
             pix = QPixmap(destino); self.lbl_entry_foto.setPixmap(pix.scaled(self.lbl_entry_foto.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
             self.lbl_entry_foto.setStyleSheet("border: 2px solid #2ecc71;"); self.lbl_entry_foto.setText(""); self.btn_del_foto.show()
         except Exception as e: QMessageBox.critical(self, "Error", str(e))
@@ -1935,39 +4190,13 @@ class MaintenanceApp(QMainWindow):
         self.table_avisos.setRowCount(0)
         avisos = self.db.obtener_avisos()
         hoy = QDate.currentDate()
-        self.table_avisos.setRowCount(len(avisos))
+        # Sin fecha de inicio: desde el 1 de enero de este año
+        estados = estados_avisos(avisos, hoy.toPyDate(), inicio_por_defecto=date(hoy.year(), 1, 1))
+        self.table_avisos.setRowCount(len(estados))
 
-        for r, (aid, tit, finicio, freq, dur, ult) in enumerate(avisos):
-            if not finicio: finicio = f"{hoy.year()}-01-01"
+        for r, ((aid, tit, finicio, freq, dur, ult), ocurrencia, fin_ocurrencia, es_activo, completado) in enumerate(estados):
             if not freq: freq = "Anual"
-
-            fi = QDate.fromString(finicio, "yyyy-MM-dd")
-            ocurrencia = fi
-
-            # Avanzamos la fecha hasta el ciclo actual
-            while ocurrencia.addDays(dur) < hoy:
-                if freq == "Diario": ocurrencia = ocurrencia.addDays(1)
-                elif freq == "Semanal": ocurrencia = ocurrencia.addDays(7)
-                elif freq == "Mensual": ocurrencia = ocurrencia.addMonths(1)
-                elif freq == "Trimestral": ocurrencia = ocurrencia.addMonths(3)
-                elif freq == "Semestral": ocurrencia = ocurrencia.addMonths(6)
-                elif freq == "Anual": ocurrencia = ocurrencia.addYears(1)
-                else: break
-
-            fin_ocurrencia = ocurrencia.addDays(dur)
-
-            # --- CORRECCIÓN CLAVE: RANGO FLEXIBLE ---
-            s_inicio = ocurrencia.toString("yyyy-MM-dd")
-            s_fin = fin_ocurrencia.toString("yyyy-MM-dd")
-
-            es_activo = (ocurrencia <= hoy <= fin_ocurrencia)
-            completado = False
-
-            # Si hay fecha de última completada (ult), comprobamos si cae DENTRO del rango
-            # Antes comprobábamos si era EXACTAMENTE igual al inicio (ult == s_inicio)
-            if ult:
-                if ult >= s_inicio and ult <= s_fin:
-                    completado = True
+            s_inicio = ocurrencia.isoformat()
 
             # Configurar celda
             cw = QWidget()
@@ -2003,31 +4232,22 @@ class MaintenanceApp(QMainWindow):
             self.table_avisos.setItem(r, 1, item_t)
             self.table_avisos.setItem(r, 2, QTableWidgetItem(freq))
 
-            rango = f"{ocurrencia.toString('dd/MM')} - {fin_ocurrencia.toString('dd/MM')}"
+            rango = f"{ocurrencia.strftime('%d/%m')} - {fin_ocurrencia.strftime('%d/%m')}"
             self.table_avisos.setItem(r, 3, QTableWidgetItem(rango))
             self.table_avisos.setItem(r, 4, QTableWidgetItem(estado_txt))
 
     def tog_aviso(self, id_aviso, fecha_ocurrencia, estado, titulo):
-        # Actualizar fecha última completada
-        self.db.marcar_aviso_completado(id_aviso, fecha_ocurrencia, estado)
-
-        desc_historial = f"Mantenimiento Preventivo: {titulo}"
-
-        if estado:
-            # MARCADO -> Añadir al historial
-            tags = "Preventivo, Aviso Recurrente"
-            self.db.agregar_tarea(fecha_ocurrencia, desc_historial, tags)
-            self.statusBar().showMessage(f"✅ Guardado en historial: {titulo}", 3000)
-        else:
-            # DESMARCADO -> Borrar del historial
-            try:
-                with get_db_connection(self.db.db_name) as conn:
-                    c = conn.cursor()
-                    c.execute("DELETE FROM tareas WHERE fecha=? AND descripcion=?", (fecha_ocurrencia, desc_historial))
-                    conn.commit()
-                self.statusBar().showMessage(f"🗑️ Eliminado del historial: {titulo}", 3000)
-            except Exception as e:
-                print(f"Error borrando historial: {e}")
+        # Fecha de la última completada y entrada del historial (añadir al marcar, borrar al desmarcar),
+        # sin bloquear la interfaz: on_aviso_guardado refresca cuando el escritor lo ha confirmado
+        futuro = self.db.completar_aviso_async(id_aviso, fecha_ocurrencia, estado, titulo)
+        futuro.add_done_callback(lambda f: self.aviso_guardado.emit(titulo, estado, str(f.exception() or "")))
+
+    def on_aviso_guardado(self, titulo, estado, error):
+        if error:
+            log_app.error("Error guardando el aviso '%s' en el historial: %s", titulo, error)
+            self.statusBar().showMessage(f"❌ No se pudo guardar: {titulo}", 5000)
+        elif estado: self.statusBar().showMessage(f"✅ Guardado en historial: {titulo}", 3000)
+        else: self.statusBar().showMessage(f"🗑️ Eliminado del historial: {titulo}", 3000)
 
         self.refresh_avisos()
         self.update_calendar_list()
@@ -2085,28 +4305,132 @@ class MaintenanceApp(QMainWindow):
     # --- LÓGICA GENERAL ---
     def go_today(self): self.calendar.setSelectedDate(QDate.currentDate()); self.update_calendar_list()
     def gest_dias(self, c=False): DialogoDiasEspeciales(self.db, self.gestor_festivos, self).exec(); self.pintar_calendario()
+    # Subrayado de los días con plazo de algún aviso (y prioridad si se solapan varios)
+    COLORES_PLAZO = {"PENDIENTE": "#e74c3c", "FUTURO": "#3daee9", "OK": "#27ae60"}
+
+    def formato_dia(self, tipo, aviso=None):
+        """
+        Formato de un día del calendario: 'festivo', 'tareas', un tipo de día especial o None (sin marcar),
+        subrayado con el color del estado si cae en el plazo de algún aviso
+        """
+        fm = QTextCharFormat()
+        if tipo == "festivo": fm.setBackground(QBrush(QColor("#502828"))); fm.setForeground(QBrush(QColor("#ddd")))
+        elif tipo == "tareas": fm.setBackground(QBrush(QColor("#A5D6A7"))); fm.setForeground(QBrush(Qt.GlobalColor.black)); fm.setFontWeight(750)
+        elif tipo:
+            cols = {"Vacaciones": "#FFF59D", "Puente": "#1565C0", "Día Libre": "#F48FB1", "Festivo (Manual)": "#502828"}
+            tcols = {"Vacaciones": "black", "Puente": "white", "Día Libre": "black", "Festivo (Manual)": "ddd"}
+            fm.setBackground(QBrush(QColor(cols.get(tipo, "#555")))); fm.setForeground(QBrush(QColor(tcols.get(tipo, "black"))))
+        if aviso:
+            fm.setFontUnderline(True); fm.setUnderlineColor(QColor(self.COLORES_PLAZO[aviso])); fm.setFontWeight(750)
+            if not tipo: fm.setForeground(QBrush(QColor(self.COLORES_PLAZO[aviso])))
+        return fm
+
+    def plazos_por_dia(self, desde, hasta):
+        """ {'yyyy-MM-dd': estado} de los días de [desde, hasta] que caen en el plazo de algún aviso """
+        hoy = date.today(); prioridad = list(self.COLORES_PLAZO); dias = {}
+        for _, ocurrencia, fin, completada in self.db.plazos_avisos(desde, hasta):
+            estado = estado_plazo(ocurrencia, completada, hoy)
+            d = max(ocurrencia, desde)
+            while d <= min(fin, hasta):
+                s = d.isoformat()
+                if s not in dias or prioridad.index(estado) < prioridad.index(dias[s]): dias[s] = estado
+                d += timedelta(days=1)
+        return dias
+
     def pintar_calendario(self):
-        self.calendar.setUpdatesEnabled(False); ac = QDate.currentDate().year(); fc = QDate(ac - 1, 1, 1); ff = QDate(ac + 1, 12, 31); fl = QTextCharFormat()
-        while fc <= ff: self.calendar.setDateTextFormat(fc, fl); fc = fc.addDays(1)
-        ffst = QTextCharFormat(); ffst.setBackground(QBrush(QColor("#502828"))); ffst.setForeground(QBrush(QColor("#ddd")))
-        for f in self.gestor_festivos.obtener_festivos(): self.calendar.setDateTextFormat(f, ffst)
-        cols = {"Vacaciones": "#FFF59D", "Puente": "#1565C0", "Día Libre": "#F48FB1", "Festivo (Manual)": "#502828"}
-        tcols = {"Vacaciones": "black", "Puente": "white", "Día Libre": "black", "Festivo (Manual)": "ddd"}
-        for s, t in self.db.obtener_dias_especiales().items(): fm = QTextCharFormat(); fm.setBackground(QBrush(QColor(cols.get(t, "#555")))); fm.setForeground(QBrush(QColor(tcols.get(t, "black")))); self.calendar.setDateTextFormat(QDate.fromString(s, "yyyy-MM-dd"), fm)
-        ft = QTextCharFormat(); ft.setBackground(QBrush(QColor("#A5D6A7"))); ft.setForeground(QBrush(Qt.GlobalColor.black)); ft.setFontWeight(750)
-        for f in self.db.obtener_fechas_con_tareas(): self.calendar.setDateTextFormat(QDate.fromString(f, "yyyy-MM-dd"), ft)
+        """ Una pasada por los tres años alrededor del actual (y los días marcados fuera de ellos): cada día, un formato """
+        ac = QDate.currentDate().year(); desde = date(ac - 1, 1, 1); hasta = date(ac + 1, 12, 31)
+        # Misma prioridad que pintar_dias: tareas > día especial > festivo
+        tipos = {f.toString("yyyy-MM-dd"): "festivo" for f in self.gestor_festivos.obtener_festivos()}
+        tipos.update(self.db.obtener_dias_especiales())
+        tipos.update(dict.fromkeys(self.db.obtener_fechas_con_tareas(), "tareas"))
+        self.avisos_calendario = self.plazos_por_dia(desde, hasta)
+        fechas = {(desde + timedelta(days=n)).isoformat() for n in range((hasta - desde).days + 1)} | tipos.keys()
+        formatos = {}
+        self.calendar.setUpdatesEnabled(False)
+        for s in fechas:
+            d = QDate.fromString(s, "yyyy-MM-dd")
+            if not d.isValid(): continue
+            clave = (tipos.get(s), self.avisos_calendario.get(s))
+            if clave not in formatos: formatos[clave] = self.formato_dia(*clave)
+            self.calendar.setDateTextFormat(d, formatos[clave])
         self.calendar.setUpdatesEnabled(True)
 
+    def pintar_dias(self, fechas):
+        """ Repinta solo estos días, con la misma prioridad que pintar_calendario (las tareas mandan) """
+        if not fechas: return
+        con_tareas = set(self.db.obtener_fechas_con_tareas(fechas))
+        especiales = self.db.obtener_dias_especiales(); festivos = self.gestor_festivos.obtener_festivos()
+        for s in fechas:
+            d = QDate.fromString(s, "yyyy-MM-dd")
+            if not d.isValid(): continue
+            tipo = "tareas" if s in con_tareas else especiales.get(s) or ("festivo" if d in festivos else None)
+            self.calendar.setDateTextFormat(d, self.formato_dia(tipo, self.avisos_calendario.get(s)))
+
     def on_tab_changed(self, i):
         if i == 0: self.refresh_dashboard()
         elif i == 1: self.pintar_calendario(); self.update_calendar_list()
         elif i == 2: self.refresh_avisos()
         elif i == 4: self.refresh_history()
+        elif i == 5 and self.busqueda_obsoleta: self.search()
         self.refresh_todos()
 
     def refresh_all(self):
+        # Lo que entre a partir de aquí lo recogerá aplicar_cambios()
+        self.cursor_cambios = self.db.cursor_cambios()
         self.refresh_dashboard(); self.pintar_calendario(); self.update_calendar_list()
         self.refresh_history(); self.search(); self.refresh_todos(); self.refresh_avisos()
+
+    # --- REFRESCO INCREMENTAL (cambios que llegan del móvil) ---
+    VENTANA_CAMBIOS_MS = 250
+    MAX_CAMBIOS_INCREMENTAL = 500 # Con más cambios sale más barato recargarlo todo
+
+    def programar_cambios(self):
+        # La primera señal abre la ventana y las que llegan mientras tanto van en la misma pasada:
+        # un lote de 50 registros es una sola actualización, no 50 recargas completas
+        if not self.timer_cambios.isActive(): self.timer_cambios.start()
+
+    def aplicar_cambios(self):
+        """ Lee del registro de cambios qué filas han cambiado y toca solo las vistas afectadas """
+        cambios, cursor = self.db.cambios_desde(self.cursor_cambios, self.MAX_CAMBIOS_INCREMENTAL)
+        if cambios is None: self.refresh_all(); return
+        self.cursor_cambios = cursor
+        if not cambios: return
+        por_entidad = {}
+        for entidad, entidad_id, tipo in cambios: por_entidad.setdefault(entidad, {})[entidad_id] = tipo
+
+        if "tareas" in por_entidad:
+            fechas = self.actualizar_filas_historial(por_entidad["tareas"])
+            self.pintar_dias(fechas)
+            if "avisos_recurrentes" not in por_entidad and self.calendar.selectedDate().toString("yyyy-MM-dd") in fechas: self.update_calendar_list()
+            self.busqueda_obsoleta = True
+        if "avisos_recurrentes" in por_entidad: self.refresh_avisos(); self.pintar_calendario(); self.update_calendar_list()
+        if "pendientes" in por_entidad: self.refresh_todos()
+        # El dashboard y el buscador se recalculan enteros: solo si están a la vista (si no, al cambiar de pestaña)
+        visible = self.tabs.currentIndex()
+        if visible == 0: self.refresh_dashboard()
+        elif visible == 5 and self.busqueda_obsoleta: self.search()
+
+    def actualizar_filas_historial(self, cambios):
+        """ Quita y vuelve a poner solo las tareas cambiadas en el historial; devuelve las fechas afectadas (antes y después) """
+        tabla = self.h_table; fechas = set()
+        filas = self.db.obtener_tareas_por_ids(cambios)
+        tabla.setUpdatesEnabled(False)
+        viejas = [r for r in range(tabla.rowCount()) if tabla.item(r, 0) and tabla.item(r, 0).data(Qt.ItemDataRole.UserRole) in cambios]
+        for r in reversed(viejas): fechas.add(tabla.item(r, 0).text()); tabla.removeRow(r)
+        iconos = self.iconos_tabla()
+        for id_t, fecha, desc, tags, foto in filas.values():
+            # La tabla va por (fecha, id) descendente, como obtener_todas_cronologico: búsqueda binaria del hueco
+            inicio, fin = 0, tabla.rowCount()
+            while inicio < fin:
+                medio = (inicio + fin) // 2; item = tabla.item(medio, 0)
+                if (item.text(), item.data(Qt.ItemDataRole.UserRole)) > (fecha, id_t): inicio = medio + 1
+                else: fin = medio
+            tabla.insertRow(inicio)
+            for col, item in enumerate(self.items_tarea(id_t, fecha, desc, tags, foto, iconos)): tabla.setItem(inicio, col, item)
+            fechas.add(fecha)
+        tabla.setUpdatesEnabled(True)
+        return fechas
     def setup_table(self, t):
         t.setColumnCount(3); t.setHorizontalHeaderLabels(["Fecha", "Descripción", "Tag"]); t.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch); t.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows); t.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection); t.setAlternatingRowColors(True)
     def configurar_deseleccion(self, widget):
@@ -2156,32 +4480,24 @@ class MaintenanceApp(QMainWindow):
                         if desc_tarea.startswith(prefijo):
                             titulo_aviso = desc_tarea.replace(prefijo, "").strip()
 
-                            # Abrimos conexión manual segura usando el método de tu clase DB
-                            conn = self.db.conectar()
-                            c = conn.cursor()
-
-                            # Buscamos si hay un aviso con ese título Y esa fecha de 'ultima_completada'
-                            c.execute("SELECT id FROM avisos_recurrentes WHERE titulo=? AND ultima_completada=?", (titulo_aviso, fecha_tarea))
-                            aviso = c.fetchone()
-
-                            if aviso:
-                                # Lo "descompletamos" poniendo NULL
-                                c.execute("UPDATE avisos_recurrentes SET ultima_completada=NULL WHERE id=?", (aviso[0],))
-                                conn.commit()
-                                print(f"Aviso '{titulo_aviso}' restaurado a pendiente.")
-
-                            conn.close()
+                            def restaurar_aviso(conn):
+                                # Buscamos si hay un aviso con ese título Y esa fecha de 'ultima_completada'
+                                aviso = conn.execute("SELECT id FROM avisos_recurrentes WHERE titulo=? AND ultima_completada=?", (titulo_aviso, fecha_tarea)).fetchone()
+                                if aviso:
+                                    # Lo "descompletamos" poniendo NULL
+                                    conn.execute("UPDATE avisos_recurrentes SET ultima_completada=NULL WHERE id=?", (aviso[0],))
+                                    log_app.info("Aviso '%s' restaurado a pendiente.", titulo_aviso)
+                            self.db.escribir(restaurar_aviso)
                     except Exception as e:
-                        print(f"Error intentando restaurar aviso: {e}")
+                        log_app.exception("Error intentando restaurar aviso: %s", e)
 
                     # -------------------------------------------------------
                     # 2. BORRADO DE FOTO (Lógica original que ya tenías)
                     # -------------------------------------------------------
-                    m = re.search(r"\[FOTO:\s*(.*?)\]", d[2])
-                    if m:
-                        nombre = m.group(1).split("]")[0].strip()
+                    for nombre in self.db.fotos_de("tareas", i):
                         ruta = os.path.join(self.carpeta_fotos, nombre)
-                        if os.path.exists(ruta):
+                        # Con el almacén por contenido la misma foto puede estar en varios registros
+                        if os.path.exists(ruta) and not self.db.foto_en_uso(nombre, excluir_tarea=i):
                             try: os.remove(ruta)
                             except: pass
 
@@ -2206,12 +4522,8 @@ class MaintenanceApp(QMainWindow):
         if not ps:
             self.todo_list.addItem("--- Nada ---")
 
-        for i, t, d in ps:
-            # 1. LIMPIEZA TOTAL (Quitamos FOTO y REF)
-            d_limpio = re.sub(r"\[FOTO:.*?\]", "", d)
-            d_limpio = re.sub(r"\[REF:.*?\]", "", d_limpio).strip()
-
-            tiene_foto = "[FOTO:" in d
+        for i, t, d, d_limpio, foto in ps:
+            tiene_foto = foto is not None
 
             # Texto visual limpio
             texto_visual = f"⬜ {t}"
@@ -2322,7 +4634,17 @@ class MaintenanceApp(QMainWindow):
             try:
                 # Restaurar en DATA_DIR o carpeta local según donde estemos
                 restore_path = os.path.dirname(self.db.db_name)
-                with zipfile.ZipFile(archivo_zip, 'r') as zipf: zipf.extractall(path=restore_path)
+                # Las conexiones del pool apuntan al fichero viejo: se cierran y se reabren solas
+                self.server_thread.pool_bd.cerrar()
+                self.server_thread.difusor.liberar_bd() # Ninguna conexión puede seguir con el WAL del fichero viejo
+                obtener_escritor(self.db.db_name).liberar()
+                self.db.cerrar_conexiones()
+                try:
+                    with zipfile.ZipFile(archivo_zip, 'r') as zipf: zipf.extractall(path=restore_path)
+                    # Datos distintos => nueva época del registro de cambios: los móviles recargan todo
+                    self.db.inicializar_tablas(); self.db.set_config("cambios_epoca", uuid.uuid4().hex)
+                finally: self.server_thread.difusor.reanudar_bd()
+                VERSION_BD.incrementar()
                 QMessageBox.information(self, "Restauración", "✅ Sistema restaurado correctamente."); self.refresh_all()
             except Exception as e: QMessageBox.critical(self, "Error Restauración", f"ZIP corrupto:\n{str(e)}")
 
@@ -2334,15 +4656,8 @@ class MaintenanceApp(QMainWindow):
             datos = self.db.obtener_todas_cronologico()
             with open(archivo, 'w', newline='', encoding='utf-8') as f:
                 writer = csv.writer(f, delimiter=';'); writer.writerow(["ID", "Fecha", "Descripción", "Tags", "Nombre Foto"])
-                for tarea in datos:
-                    # Limpiamos FOTO y REF también aquí para que quede perfecto
-                    desc_limpia = re.sub(r"\[FOTO:.*?\]", "", tarea[2])
-                    desc_limpia = re.sub(r"\[REF:.*?\]", "", desc_limpia).strip()
-
-                    nombre_foto = "NO"
-                    m = re.search(r"\[FOTO:\s*(.*?)\]", tarea[2])
-                    if m: nombre_foto = m.group(1).split("]")[0].strip()
-                    writer.writerow([tarea[0], tarea[1], desc_limpia, tarea[3], nombre_foto])
+                for id_t, fecha, desc_limpia, tags, foto in datos:
+                    writer.writerow([id_t, fecha, desc_limpia, tags, foto or "NO"])
             QMessageBox.information(self, "Exportado", "CSV guardado correctamente.")
         except Exception as e: QMessageBox.critical(self, "Error", str(e))
 
@@ -2362,15 +4677,10 @@ class MaintenanceApp(QMainWindow):
             datos = self.db.obtener_todas_cronologico(); row = 1
             for tarea in datos:
                 worksheet.write(row, 0, tarea[0], center); worksheet.write(row, 1, tarea[1], center)
-
-                # Limpieza de FOTO y REF
-                desc_limpia = re.sub(r"\[FOTO:.*?\]", "", tarea[2])
-                desc_limpia = re.sub(r"\[REF:.*?\]", "", desc_limpia).strip()
-
-                worksheet.write(row, 2, desc_limpia, wrap); worksheet.write(row, 3, tarea[3], wrap)
-                m = re.search(r"\[FOTO:\s*(.*?)\]", tarea[2])
-                if m:
-                    nombre = m.group(1).split("]")[0].strip(); ruta = os.path.join(self.carpeta_fotos, nombre)
+                worksheet.write(row, 2, tarea[2], wrap); worksheet.write(row, 3, tarea[3], wrap)
+                nombre = tarea[4]
+                if nombre:
+                    ruta = os.path.join(self.carpeta_fotos, nombre)
                     if os.path.exists(ruta):
                         try: worksheet.insert_image(row, 4, ruta, {'x_scale': 0.1, 'y_scale': 0.1, 'object_position': 1}); worksheet.set_row(row, 80)
                         except: worksheet.write(row, 4, "Err Img", center)
@@ -2412,34 +4722,16 @@ class MaintenanceApp(QMainWindow):
         layout_stats.addStretch(); self.group_stats.setLayout(layout_stats); v_stats.addWidget(self.group_stats); h_split.addLayout(v_stats, 20); l.addLayout(h_split); self.tab_dashboard.setLayout(l)
 
     def refresh_dashboard(self):
-        avisos = self.db.obtener_avisos(); hoy = QDate.currentDate(); pendientes_reales = 0
-        for aid, tit, finicio, freq, dur, ult in avisos:
-            if not finicio: continue
-            fi = QDate.fromString(finicio, "yyyy-MM-dd")
-            if not freq: freq = "Anual"
-            ocurrencia = fi
-            while ocurrencia.addDays(dur) < hoy:
-                if freq == "Diario": ocurrencia = ocurrencia.addDays(1)
-                elif freq == "Semanal": ocurrencia = ocurrencia.addDays(7)
-                elif freq == "Mensual": ocurrencia = ocurrencia.addMonths(1)
-                elif freq == "Trimestral": ocurrencia = ocurrencia.addMonths(3)
-                elif freq == "Semestral": ocurrencia = ocurrencia.addMonths(6)
-                elif freq == "Anual": ocurrencia = ocurrencia.addYears(1)
-                else: break
-            fin_ocurrencia = ocurrencia.addDays(dur)
-            if ocurrencia <= hoy <= fin_ocurrencia and ult != ocurrencia.toString("yyyy-MM-dd"): pendientes_reales += 1
+        hoy = QDate.currentDate()
+        pendientes_reales = sum(1 for _, _, _, activa, completada in estados_avisos(self.db.obtener_avisos(), hoy.toPyDate()) if activa and not completada)
         self.lbl_count_avisos.setText(str(pendientes_reales))
         self.lbl_count_avisos.setStyleSheet("color: #e74c3c; font-size: 32px; font-weight: bold;" if pendientes_reales > 0 else "color: #2ecc71; font-size: 32px; font-weight: bold;")
         todos = self.db.obtener_pendientes(); self.lbl_count_todos.setText(str(len(todos))); self.lbl_count_todos.setStyleSheet("color: #f1c40f; font-size: 32px; font-weight: bold;")
-        registros = self.db.obtener_todas_cronologico(); mes_actual = hoy.toString("yyyy-MM"); count_mes = sum(1 for r in registros if r[1].startswith(mes_actual))
+        total_tareas, count_mes, por_tag = self.db.estadisticas_tareas(hoy.toString("yyyy-MM"))
         self.lbl_count_regs.setText(str(count_mes)); self.lbl_count_regs.setStyleSheet("color: #3daee9; font-size: 32px; font-weight: bold;")
-        self.fill_t(self.dash_table, registros[:15])
-        total_tareas = len(registros)
+        self.fill_t(self.dash_table, self.db.obtener_todas_cronologico(15))
         if total_tareas > 0:
-            c_elec = sum(1 for r in registros if "eléctrico" in r[3].lower() or "electrico" in r[3].lower())
-            c_mec = sum(1 for r in registros if "mecánico" in r[3].lower() or "mecanico" in r[3].lower())
-            c_prev = sum(1 for r in registros if "preventivo" in r[3].lower())
-            c_urg = sum(1 for r in registros if "urgente" in r[3].lower() or "avería" in r[3].lower())
+            c_elec, c_mec, c_prev, c_urg = por_tag["electrico"], por_tag["mecanico"], por_tag["preventivo"], por_tag["urgente"]
             self.bar_elec.setValue(int((c_elec/total_tareas)*100)); self.bar_elec.setFormat(f"{int((c_elec/total_tareas)*100)}% ({c_elec})")
             self.bar_mec.setValue(int((c_mec/total_tareas)*100)); self.bar_mec.setFormat(f"{int((c_mec/total_tareas)*100)}% ({c_mec})")
             self.bar_prev.setValue(int((c_prev/total_tareas)*100)); self.bar_prev.setFormat(f"{int((c_prev/total_tareas)*100)}% ({c_prev})")
@@ -2486,16 +4778,16 @@ class MaintenanceApp(QMainWindow):
 
         # 1. Recuperar datos en el hilo principal (rápido)
         try:
-            conn = self.db.conectar()
-            c = conn.cursor()
-            if inicio and fin:
-                c.execute("SELECT fecha, descripcion, tags FROM tareas WHERE fecha BETWEEN ? AND ? ORDER BY fecha DESC", (inicio, fin))
-                titulo_doc = f"Reporte de Mantenimiento ({inicio} a {fin})"
-            else:
-                c.execute("SELECT fecha, descripcion, tags FROM tareas ORDER BY fecha DESC")
-                titulo_doc = "Reporte Histórico Completo"
-            datos = c.fetchall()
-            conn.close()
+            with self.db.lectura() as conn:
+                c = conn.cursor()
+                columnas = f"fecha, COALESCE(texto, descripcion), tags, {sql_foto('tareas')}"
+                if inicio and fin:
+                    c.execute(f"SELECT {columnas} FROM tareas WHERE fecha BETWEEN ? AND ? ORDER BY fecha DESC", (inicio, fin))
+                    titulo_doc = f"Reporte de Mantenimiento ({inicio} a {fin})"
+                else:
+                    c.execute(f"SELECT {columnas} FROM tareas ORDER BY fecha DESC")
+                    titulo_doc = "Reporte Histórico Completo"
+                datos = c.fetchall()
         except Exception as e:
             QMessageBox.critical(self, "Error DB", str(e))
             return
@@ -2536,16 +4828,11 @@ class MaintenanceApp(QMainWindow):
 
     def limpiar_fotos_huerfanas(self, silencioso=False):
         try:
-            fotos_en_uso = set(); conn = self.db.conectar(); c = conn.cursor()
-            c.execute("SELECT descripcion FROM tareas")
-            for row in c.fetchall():
-                m = re.search(r"\[FOTO:\s*(.*?)\]", row[0])
-                if m: fotos_en_uso.add(m.group(1).strip())
-            c.execute("SELECT detalles FROM pendientes")
-            for row in c.fetchall():
-                m = re.search(r"\[FOTO:\s*(.*?)\]", row[0])
-                if m: fotos_en_uso.add(m.group(1).strip())
-            conn.close()
+            with self.db.lectura() as conn:
+                fotos_en_uso = {f for (f,) in conn.execute("SELECT foto FROM adjuntos UNION SELECT foto FROM tareas WHERE foto IS NOT NULL")}
+                # Filas escritas desde fuera de la app que aún no tienen sus adjuntos separados
+                for (texto,) in conn.execute("SELECT descripcion FROM tareas WHERE texto IS NULL UNION ALL SELECT detalles FROM pendientes WHERE texto IS NULL"):
+                    fotos_en_uso.update(foto for _, foto in separar_marcas(texto)[2])
             if not os.path.exists(self.carpeta_fotos): return
             basura = []
             for f in os.listdir(self.carpeta_fotos):
@@ -2557,7 +4844,9 @@ class MaintenanceApp(QMainWindow):
                 for f in basura:
                     try: os.remove(os.path.join(self.carpeta_fotos, f))
                     except: pass
-        except Exception as e: print(f"Error limpieza: {e}")
+                # Los alias de fotos que ya no existen sobran
+                self.db.escribir(lambda conn: conn.executemany("DELETE FROM fotos_alias WHERE foto=?", [(f,) for f in basura]))
+        except Exception as e: log_app.exception("Error limpieza: %s", e)
 
     def edit_todo(self, item=None): # Añadimos argumento opcional para el doble click
         row = self.todo_list.currentRow()
@@ -2610,9 +4899,7 @@ class MaintenanceApp(QMainWindow):
                     nombre_final = os.path.basename(nueva_foto)
                     if nueva_foto != ruta_foto_actual:
                         ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-                        nombre_final = f"pc_edit_{ts}_{nombre_final}"
-                        destino = os.path.join(self.carpeta_fotos, nombre_final)
-                        try: shutil.copy2(nueva_foto, destino)
+                        try: nombre_final, _ = self.db.guardar_foto(nueva_foto, self.carpeta_fotos, f"pc_edit_{ts}_{nombre_final}")
                         except: pass
 
                     desc_final += f"\n[FOTO: {nombre_final}]"
@@ -2626,7 +4913,7 @@ import traceback
 
 def manejador_excepciones(exc_type, exc_value, exc_tb):
     error_msg = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
-    print(error_msg) # Por si lo ejecutas en terminal
+    log_app.critical("Excepción no capturada", exc_info=(exc_type, exc_value, exc_tb))
     try:
         # Intentamos mostrar el error en una ventanita antes de morir
         msg = QMessageBox()
@@ -2643,6 +4930,13 @@ sys.excepthook = manejador_excepciones
 if __name__ == "__main__":
     # YA NO forzamos "xcb", dejamos que Wayland gestione la ventana nativamente
 
+    # Los procesos del pool de fotos ('spawn') arrancan este mismo ejecutable: en el .exe
+    # de PyInstaller tienen que salir por aquí en lugar de abrir otra ventana
+    multiprocessing.freeze_support()
+
+    # Logs en DATA_DIR/logs; MANTPRO_LOG="servidor=DEBUG,peticiones=INFO" sube el detalle sin tocar la BD
+    configurar_logs(os.path.join(DATA_DIR, "logs"), os.environ.get("MANTPRO_LOG"))
+
     app = QApplication(sys.argv)
 
     # --- 1. CONFIGURACIÓN DE IDENTIDAD ---
@@ -2658,22 +4952,13 @@ if __name__ == "__main__":
         app_icon = QIcon(ruta_icono)
         app.setWindowIcon(app_icon)
 
-    # --- 2. REPARACIÓN DE BASE DE DATOS (CRÍTICO) ---
-    # Esto es lo que faltaba. Sin esto, no se crea la columna 'raw_desc' y falla el sync.
-    try:
-        ruta_db = os.path.join(DATA_DIR, "mantenimiento.db")
-        reparar_base_datos(ruta_db)
-        print(f"✅ Base de datos verificada en: {ruta_db}")
-    except Exception as e:
-        print(f"❌ Error verificando BD: {e}")
-
-    # --- 3. INSTANCIAR VENTANA PRINCIPAL ---
+    # --- 2. INSTANCIAR VENTANA PRINCIPAL ---
     try:
         ventana = MaintenanceApp()
     except NameError:
-        print("Error: Revisa el nombre de la clase de la ventana principal.")
+        log_app.critical("Error: Revisa el nombre de la clase de la ventana principal.")
 
-    # --- 4. SPLASH SCREEN ESTÁTICO (Compatible con Wayland) ---
+    # --- 3. SPLASH SCREEN ESTÁTICO (Compatible con Wayland) ---
     if os.path.exists(ruta_logo):
         pixmap = QPixmap(ruta_logo)
 
@@ -0,0 +1,153 @@
+"""
+Comprobación y medida del cálculo de ocurrencias de los avisos recurrentes de MantPro.
+
+1. Propiedades: con fechas, frecuencias y duraciones aleatorias (incluidos días 29-31 y
+   años bisiestos) comprueba que ocurrencia_aviso():
+     - coincide con avanzar periodo a periodo desde el inicio,
+     - coincide con el bucle anterior (QDate.addMonths) cuando no hay fin de mes de por medio,
+     - cae en el calendario del aviso, no antes del inicio, y la ocurrencia anterior ya terminó,
+     - nunca retrocede al avanzar la fecha,
+     - en los periodos de meses conserva el día del inicio o el último día del mes.
+2. Rendimiento: compara los bucles anteriores (QDate de la interfaz y datetime de la API)
+   con estados_avisos() sobre avisos que empezaron hace años.
+
+    python prueba_avisos.py
+    python prueba_avisos.py --casos 100000 --avisos 500 --anios 20
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from calendar import monthrange
+from datetime import date, timedelta
+
+# ==========================================
+# BUCLES ANTERIORES (REFERENCIA)
+# ==========================================
+def ocurrencia_bucle_qt(inicio, frecuencia, duracion, fecha):
+    """ El bucle que repetían la tabla de avisos, el calendario y el panel """
+    from PyQt6.QtCore import QDate
+    ocurrencia = QDate(inicio.year, inicio.month, inicio.day); hoy = QDate(fecha.year, fecha.month, fecha.day)
+    while ocurrencia.addDays(duracion) < hoy:
+        if frecuencia == "Diario": ocurrencia = ocurrencia.addDays(1)
+        elif frecuencia == "Semanal": ocurrencia = ocurrencia.addDays(7)
+        elif frecuencia == "Mensual": ocurrencia = ocurrencia.addMonths(1)
+        elif frecuencia == "Trimestral": ocurrencia = ocurrencia.addMonths(3)
+        elif frecuencia == "Semestral": ocurrencia = ocurrencia.addMonths(6)
+        elif frecuencia == "Anual": ocurrencia = ocurrencia.addYears(1)
+        else: break
+    return ocurrencia.toPyDate()
+
+def ocurrencia_bucle_api(inicio, frecuencia, duracion, fecha):
+    """ El bucle de /api/avisos (datetime, sin QDate) """
+    ocurrencia = inicio
+    while (ocurrencia + timedelta(days=duracion)) < fecha:
+        if frecuencia == "Diario": ocurrencia += timedelta(days=1)
+        elif frecuencia == "Semanal": ocurrencia += timedelta(days=7)
+        elif frecuencia in ("Mensual", "Trimestral", "Semestral"):
+            m_add = ocurrencia.month + {"Mensual": 1, "Trimestral": 3, "Semestral": 6}[frecuencia]
+            ny = ocurrencia.year + (m_add - 1) // 12
+            nm = (m_add - 1) % 12 + 1
+            try: ocurrencia = ocurrencia.replace(year=ny, month=nm)
+            except ValueError: ocurrencia = ocurrencia.replace(year=ny, month=nm, day=28)
+        elif frecuencia == "Anual":
+            try: ocurrencia = ocurrencia.replace(year=ocurrencia.year + 1)
+            except ValueError: ocurrencia = ocurrencia.replace(year=ocurrencia.year + 1, day=28) # 29 de febrero
+        else: break
+    return ocurrencia
+
+def ocurrencia_por_pasos(main, inicio, frecuencia, duracion, fecha):
+    """ La definición, sin atajos: ocurrencia N = inicio + N periodos, la primera que no ha terminado """
+    dias, meses = main.PERIODOS_AVISO.get(frecuencia, (0, 0))
+    if not (dias or meses): return inicio
+    n = 0
+    while True:
+        ocurrencia = inicio + timedelta(days=n * dias) if dias else main.sumar_meses(inicio, n * meses)
+        if ocurrencia + timedelta(days=duracion) >= fecha: return ocurrencia
+        n += 1
+
+# ==========================================
+# PROPIEDADES
+# ==========================================
+def fecha_aleatoria(rnd, desde, hasta):
+    if rnd.random() < 0.3: # Forzamos finales de mes y 29 de febrero, donde están los fallos
+        anio = rnd.randint(desde, hasta); mes = rnd.randint(1, 12)
+        return date(anio, mes, rnd.randint(max(1, monthrange(anio, mes)[1] - 3), monthrange(anio, mes)[1]))
+    return date(desde, 1, 1) + timedelta(days=rnd.randint(0, (date(hasta, 12, 31) - date(desde, 1, 1)).days))
+
+def verificar(main, casos, semilla):
+    rnd = random.Random(semilla); fallos = []
+    frecuencias = list(main.PERIODOS_AVISO) + ["Otra"]
+    for _ in range(casos):
+        inicio = fecha_aleatoria(rnd, 2000, 2030); fecha = fecha_aleatoria(rnd, 1995, 2040)
+        frecuencia = rnd.choice(frecuencias); duracion = rnd.choice((0, 0, 1, 3, 7, 15, 30, 45, 200, 400))
+        oc = main.ocurrencia_aviso(inicio, frecuencia, duracion, fecha)
+        caso = (inicio, frecuencia, duracion, fecha, oc)
+        dias, meses = main.PERIODOS_AVISO.get(frecuencia, (0, 0))
+
+        if oc != ocurrencia_por_pasos(main, inicio, frecuencia, duracion, fecha): fallos.append(("por_pasos", caso))
+        if (dias or inicio.day <= 28) and oc != ocurrencia_bucle_qt(inicio, frecuencia, duracion, fecha): fallos.append(("bucle_qt", caso))
+        if oc < inicio: fallos.append(("antes_del_inicio", caso))
+        if dias or meses:
+            if fecha > inicio + timedelta(days=duracion) and oc + timedelta(days=duracion) < fecha: fallos.append(("ya_terminada", caso))
+            if dias and (oc - inicio).days % dias: fallos.append(("fuera_de_calendario", caso))
+            if meses:
+                n = (oc.year - inicio.year) * 12 + oc.month - inicio.month
+                if n % meses or oc.day != min(inicio.day, monthrange(oc.year, oc.month)[1]): fallos.append(("fin_de_mes", caso))
+                anterior = main.sumar_meses(inicio, n - meses) if n else None
+            else:
+                anterior = oc - timedelta(days=dias) if oc > inicio else None
+            if anterior and anterior + timedelta(days=duracion) >= fecha: fallos.append(("no_es_la_primera", caso))
+        despues = fecha + timedelta(days=rnd.randint(1, 400))
+        if main.ocurrencia_aviso(inicio, frecuencia, duracion, despues) < oc: fallos.append(("retrocede", caso))
+    return fallos
+
+# ==========================================
+# RENDIMIENTO
+# ==========================================
+def avisos_de_ejemplo(rnd, cuantos, anios):
+    hoy = date.today()
+    return [(n, f"Aviso {n}", (hoy - timedelta(days=rnd.randint(0, anios * 365))).isoformat(),
+             rnd.choice(("Diario", "Diario", "Semanal", "Mensual", "Trimestral", "Anual")), rnd.choice((0, 1, 7)), None)
+            for n in range(cuantos)]
+
+def medir(funcion, repeticiones):
+    inicio = time.perf_counter()
+    for _ in range(repeticiones): funcion()
+    return (time.perf_counter() - inicio) / repeticiones * 1000
+
+def comparar(main, avisos, repeticiones):
+    hoy = date.today()
+    def con_bucle(bucle):
+        return lambda: [bucle(date.fromisoformat(a[2]), a[3], a[4], hoy) for a in avisos]
+    tiempos = {"bucle QDate (interfaz)": medir(con_bucle(ocurrencia_bucle_qt), repeticiones),
+               "bucle datetime (API)": medir(con_bucle(ocurrencia_bucle_api), repeticiones),
+               "estados_avisos()": medir(lambda: main.estados_avisos(avisos, hoy), repeticiones)}
+    base = tiempos["estados_avisos()"]
+    print(f"\n{'Cálculo':<26}{'ms por refresco':>16}{'veces':>10}")
+    for nombre, ms in tiempos.items(): print(f"{nombre:<26}{ms:>16.2f}{ms / base:>10.0f}")
+
+def main_prueba():
+    parser = argparse.ArgumentParser(description="Propiedades y rendimiento de la recurrencia de avisos de MantPro")
+    parser.add_argument("--casos", type=int, default=20000, help="Casos aleatorios para las propiedades")
+    parser.add_argument("--avisos", type=int, default=100, help="Avisos en la medida de rendimiento")
+    parser.add_argument("--anios", type=int, default=10, help="Antigüedad máxima de los avisos (años)")
+    parser.add_argument("--repeticiones", type=int, default=5, help="Refrescos medidos por cálculo")
+    parser.add_argument("--semilla", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    import main
+
+    fallos = verificar(main, args.casos, args.semilla)
+    print(f"Propiedades: {args.casos} casos, {len(fallos)} fallos")
+    for nombre, caso in fallos[:20]: print(f"  {nombre}: inicio={caso[0]} {caso[1]} dur={caso[2]} fecha={caso[3]} -> {caso[4]}")
+
+    avisos = avisos_de_ejemplo(random.Random(args.semilla), args.avisos, args.anios)
+    print(f"\nRendimiento: {args.avisos} avisos de hasta {args.anios} años, {args.repeticiones} refrescos")
+    comparar(main, avisos, args.repeticiones)
+    return 1 if fallos else 0
+
+if __name__ == "__main__":
+    sys.exit(main_prueba())
@@ -0,0 +1,291 @@
+"""
+Prueba de carga de la API de sincronización de MantPro.
+
+Simula N técnicos con el móvil contra un ServidorSincronizacion sin interfaz y con
+una base de datos temporal (o contra un servidor ya arrancado con --url):
+  - consultas de historial, avisos y fotos con tiempos de "pensar" entre acciones,
+  - subidas con fotos de tamaño realista,
+  - ráfagas de la cola offline (varios registros seguidos al recuperar la Wi-Fi),
+  - completar pendientes.
+
+Al terminar muestra peticiones/s, latencias p50/p95/p99 por operación y cuántas
+peticiones fallaron por bloqueo de la base de datos, para comparar cambios del
+servidor antes de publicar una versión.
+
+    python prueba_carga.py --tecnicos 30 --duracion 60
+    python prueba_carga.py --modo desarrollo --json resultado.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import requests
+
+# Peso de cada acción en el día a día de un técnico
+ACCIONES = (("historial", 30), ("avisos", 15), ("foto", 20), ("upload", 15), ("completar_pendiente", 10), ("rafaga_offline", 10))
+
+# ==========================================
+# FOTOS SINTÉTICAS
+# ==========================================
+def jpeg_base():
+    """ Un JPEG pequeño pero válido (si hay Pillow), para que las miniaturas funcionen """
+    try:
+        from PIL import Image
+        img = Image.effect_noise((640, 480), 64).convert("RGB")
+        buf = BytesIO(); img.save(buf, "JPEG", quality=85)
+        return buf.getvalue()
+    except ImportError:
+        return b"\xff\xd8\xff\xe0" + b"\x00" * 1020 + b"\xff\xd9"
+
+def tamano_foto(rnd, mediana_kb):
+    # Las fotos de móvil rondan la mediana pero con cola larga (fotos nocturnas, 48 MP...)
+    return int(min(rnd.lognormvariate(0, 0.5) * mediana_kb, mediana_kb * 5) * 1024)
+
+def foto_sintetica(base, tamano):
+    # Los visores ignoran lo que va detrás del marcador de fin de imagen: rellenamos hasta el tamaño pedido
+    return base + os.urandom(max(tamano - len(base), 0))
+
+# ==========================================
+# SERVIDOR SIN INTERFAZ
+# ==========================================
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def arrancar_servidor(args, carpeta):
+    """ ServidorSincronizacion real sobre una BD temporal con datos de ejemplo """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    import main
+    from PyQt6.QtCore import QCoreApplication
+    app = QCoreApplication.instance() or QCoreApplication([])
+
+    main.DATA_DIR = carpeta
+    # Logs como en la aplicación (werkzeug en WARNING): sin una línea de acceso por petición en la consola
+    main.configurar_logs(os.path.join(carpeta, "logs"), os.environ.get("MANTPRO_LOG"))
+    db = main.GestorBaseDatos()
+    fotos = os.path.join(carpeta, "fotos_recibidas"); os.makedirs(fotos, exist_ok=True)
+    # La misma etapa de ingesta que la aplicación (normalización en el pool de procesos), salvo --sin-normalizar
+    if args.sin_normalizar: db.set_config("foto_normalizar", "0")
+    db.normalizador = main.NormalizadorFotos.desde_config(db, fotos)
+    sembrar_datos(main, db, args, fotos)
+
+    servidor = main.ServidorSincronizacion(fotos, db.db_name, modo=args.modo, hilos=args.hilos, timeout=args.timeout,
+                                           normalizador=db.normalizador)
+    servidor.server_port = args.puerto or puerto_libre()
+    servidor.start()
+    url = f"http://127.0.0.1:{servidor.server_port}"
+    limite = time.time() + 10
+    while time.time() < limite:
+        try:
+            requests.get(f"{url}/api/dashboard", timeout=1); break
+        except requests.RequestException: time.sleep(0.1)
+    else:
+        raise RuntimeError("El servidor no ha arrancado")
+    return main, app, servidor, url
+
+def sembrar_datos(main, db, args, fotos):
+    """
+    Historial de un año (con fotos y tags), avisos y pendientes suficientes para toda la prueba.
+    Se escribe por GestorBaseDatos, como la aplicación: así se llenan también adjuntos y tareas_tags.
+    """
+    rnd = random.Random(args.semilla)
+    hoy = datetime.now()
+    base = jpeg_base(); nombres = []
+    for i in range(20):
+        ruta = os.path.join(os.path.dirname(fotos), f"semilla_{i}.jpg")
+        with open(ruta, "wb") as f: f.write(base + bytes([i])) # Contenido distinto: 20 fotos distintas
+        nombres.append(db.guardar_foto(ruta, fotos, f"semilla_{i}.jpg")[0])
+        if os.path.exists(ruta): os.remove(ruta)
+
+    tareas = []
+    for i in range(args.historial):
+        descripcion = f"Revisión {rnd.choice(['caldera', 'ascensor', 'extintores', 'bomba', 'cuadro eléctrico'])} nº {i}"
+        if rnd.random() < 0.3: descripcion += f"\n[FOTO: {rnd.choice(nombres)}]"
+        if rnd.random() < 0.1: descripcion += f"\n[FOTO_DESPUES: {rnd.choice(nombres)}]"
+        tags = ", ".join(rnd.sample(["General", "Preventivo", "Averías", "Eléctrico", "Fontanería", "Urgente"], rnd.randint(1, 3)))
+        tareas.append({"fecha": (hoy - timedelta(days=rnd.randint(0, 365))).strftime("%Y-%m-%d"), "descripcion": descripcion, "tags": tags})
+    def sembrar(conn):
+        for tarea in tareas: main.guardar_con_marcas(conn, "tareas", tarea)
+        for i in range(args.tecnicos * 50):
+            main.guardar_con_marcas(conn, "pendientes", {"titulo": f"Pendiente {i}", "detalles": "Generado por la prueba de carga"})
+    db.escribir(sembrar) # Una sola transacción: miles de registros en un momento
+    for i in range(40):
+        db.agregar_aviso(f"Aviso {i}", (hoy - timedelta(days=rnd.randint(0, 200))).strftime("%Y-%m-%d"),
+                         rnd.choice(["Semanal", "Mensual", "Trimestral", "Anual"]), 1)
+
+# ==========================================
+# TÉCNICO SIMULADO
+# ==========================================
+class Resultados:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = defaultdict(list)
+        self.errores = defaultdict(int)
+        self.bloqueos = 0  # "database is locked" / busy
+        self.saturado = 0  # 503 del servidor
+        self.bytes_subidos = 0
+
+    def anotar(self, operacion, segundos, resp=None, error=None, subidos=0):
+        with self._lock:
+            self.latencias[operacion].append(segundos)
+            self.bytes_subidos += subidos
+            if error is not None:
+                self.errores[operacion] += 1
+                return
+            if resp.status_code >= 400 and resp.status_code != 404:
+                self.errores[operacion] += 1
+                if resp.status_code == 503: self.saturado += 1
+                texto = resp.text.lower()
+                if "locked" in texto or "busy" in texto: self.bloqueos += 1
+
+class Tecnico(threading.Thread):
+    def __init__(self, n, args, url, resultados, fin, base_jpeg):
+        super().__init__(name=f"tecnico-{n}", daemon=True)
+        self.args = args; self.url = url; self.resultados = resultados; self.fin = fin
+        self.base_jpeg = base_jpeg
+        self.rnd = random.Random(args.semilla * 1000 + n)
+        self.sesion = requests.Session() # Keep-alive, como el cliente HTTP del móvil
+        self.fotos_vistas = []
+        self.pendientes = []
+
+    def run(self):
+        nombres, pesos = zip(*ACCIONES)
+        while time.time() < self.fin:
+            accion = self.rnd.choices(nombres, weights=pesos)[0]
+            getattr(self, accion)()
+            # Tiempo de "pensar" (exponencial: casi siempre poco, a veces mucho)
+            time.sleep(min(self.rnd.expovariate(1 / self.args.pensar), self.args.pensar * 5) if self.args.pensar else 0)
+
+    def peticion(self, operacion, metodo, ruta, subidos=0, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            resp = self.sesion.request(metodo, self.url + ruta, timeout=self.args.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.resultados.anotar(operacion, time.perf_counter() - t0, error=e, subidos=subidos)
+            return None
+        self.resultados.anotar(operacion, time.perf_counter() - t0, resp, subidos=subidos)
+        return resp
+
+    def historial(self):
+        params = {"limite": 50}
+        if self.rnd.random() < 0.2: params["q"] = self.rnd.choice(["caldera", "ascensor", "bomba", "extint"])
+        resp = self.peticion("historial", "GET", "/api/historial", params=params)
+        if resp is not None and resp.ok:
+            self.fotos_vistas = [t["foto"] for t in resp.json() if t.get("foto")][:20] or self.fotos_vistas
+
+    def avisos(self):
+        self.peticion("avisos", "GET", "/api/avisos")
+
+    def foto(self):
+        if not self.fotos_vistas: return self.historial()
+        params = {"w": 256} if self.rnd.random() < 0.7 else {} # La lista pide miniaturas; el detalle, la foto entera
+        self.peticion("foto", "GET", f"/api/foto/{self.rnd.choice(self.fotos_vistas)}", params=params)
+
+    def upload(self, operacion="upload"):
+        foto = foto_sintetica(self.base_jpeg, tamano_foto(self.rnd, self.args.foto_kb))
+        datos = {"titulo": f"Trabajo {uuid.uuid4().hex[:6]}", "detalles": "Prueba de carga", "tags": "General",
+                 "fecha": datetime.now().strftime("%Y-%m-%d")}
+        self.peticion(operacion, "POST", "/api/upload", subidos=len(foto), data=datos,
+                      files={"foto": ("foto.jpg", foto, "image/jpeg")}, headers={"Idempotency-Key": uuid.uuid4().hex})
+
+    def rafaga_offline(self):
+        # Vuelve la cobertura: la cola offline se vacía de golpe, sin pausas
+        for _ in range(self.rnd.randint(2, self.args.rafaga)): self.upload("rafaga_offline")
+
+    def completar_pendiente(self):
+        if not self.pendientes:
+            resp = self.peticion("pendientes", "GET", "/api/pendientes")
+            if resp is None or not resp.ok: return
+            self.pendientes = [p["id"] for p in resp.json()]
+            self.rnd.shuffle(self.pendientes)
+            if not self.pendientes: return
+        datos = {"id": self.pendientes.pop(), "titulo": "Pendiente resuelto", "detalles": "Prueba de carga"}
+        self.peticion("completar_pendiente", "POST", "/api/completar_pendiente", data=datos,
+                      headers={"Idempotency-Key": uuid.uuid4().hex})
+
+# ==========================================
+# INFORME
+# ==========================================
+def percentil(valores, p):
+    return valores[min(int(p * len(valores)), len(valores) - 1)] if valores else 0.0
+
+def informe(resultados, duracion):
+    filas = {}
+    for operacion, latencias in sorted(resultados.latencias.items()):
+        latencias = sorted(latencias)
+        filas[operacion] = {"peticiones": len(latencias), "errores": resultados.errores[operacion],
+                            "por_segundo": len(latencias) / duracion,
+                            "p50_ms": percentil(latencias, 0.50) * 1000, "p95_ms": percentil(latencias, 0.95) * 1000,
+                            "p99_ms": percentil(latencias, 0.99) * 1000}
+    total = sum(f["peticiones"] for f in filas.values())
+    return {"duracion_s": duracion, "peticiones": total, "por_segundo": total / duracion if duracion else 0.0,
+            "errores": sum(resultados.errores.values()), "bloqueos_bd": resultados.bloqueos, "saturado_503": resultados.saturado,
+            "mb_subidos": resultados.bytes_subidos / (1024 * 1024), "operaciones": filas}
+
+def imprimir_informe(datos):
+    print(f"\n{'Operación':<22}{'Pet.':>8}{'Err.':>7}{'Pet/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for operacion, f in datos["operaciones"].items():
+        print(f"{operacion:<22}{f['peticiones']:>8}{f['errores']:>7}{f['por_segundo']:>9.1f}{f['p50_ms']:>10.1f}{f['p95_ms']:>10.1f}{f['p99_ms']:>10.1f}")
+    print(f"\nTotal: {datos['peticiones']} peticiones en {datos['duracion_s']:.0f} s ({datos['por_segundo']:.1f}/s), "
+          f"{datos['errores']} errores, {datos['mb_subidos']:.0f} MB subidos")
+    print(f"Bloqueos de BD (database is locked): {datos['bloqueos_bd']}   ·   Rechazadas por saturación (503): {datos['saturado_503']}")
+
+def main_prueba():
+    parser = argparse.ArgumentParser(description="Prueba de carga de la API de sincronización de MantPro")
+    parser.add_argument("--tecnicos", type=int, default=20, help="Técnicos (móviles) simultáneos")
+    parser.add_argument("--duracion", type=float, default=60, help="Segundos de prueba")
+    parser.add_argument("--pensar", type=float, default=2.0, help="Tiempo medio entre acciones de un técnico (s)")
+    parser.add_argument("--rafaga", type=int, default=8, help="Registros como mucho en una ráfaga de la cola offline")
+    parser.add_argument("--foto-kb", type=int, default=2500, help="Tamaño mediano de las fotos (KB)")
+    parser.add_argument("--historial", type=int, default=5000, help="Tareas de ejemplo en la BD temporal")
+    parser.add_argument("--sin-normalizar", action="store_true", help="Guardar las fotos tal cual llegan (foto_normalizar=0)")
+    parser.add_argument("--modo", choices=("produccion", "desarrollo"), default="produccion", help="Motor HTTP del servidor")
+    parser.add_argument("--hilos", type=int, default=16, help="Hilos del servidor (modo producción)")
+    parser.add_argument("--timeout", type=int, default=30, help="Timeout por petición (s)")
+    parser.add_argument("--puerto", type=int, default=0, help="Puerto del servidor temporal (0 = uno libre)")
+    parser.add_argument("--url", help="Probar un servidor ya arrancado en lugar de uno temporal (¡escribe datos!)")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--json", help="Guardar también el resultado en este fichero")
+    args = parser.parse_args()
+
+    carpeta = None; servidor = None; main = None
+    try:
+        if args.url:
+            url = args.url.rstrip("/")
+        else:
+            carpeta = tempfile.mkdtemp(prefix="mantpro_carga_")
+            main, _app, servidor, url = arrancar_servidor(args, carpeta)
+        print(f"Prueba de carga contra {url}: {args.tecnicos} técnicos durante {args.duracion:.0f} s")
+
+        resultados = Resultados(); base = jpeg_base()
+        inicio = time.time(); fin = inicio + args.duracion
+        tecnicos = [Tecnico(n, args, url, resultados, fin, base) for n in range(args.tecnicos)]
+        for t in tecnicos:
+            t.start(); time.sleep(0.05) # No todos los móviles llegan en el mismo milisegundo
+        for t in tecnicos: t.join()
+        datos = informe(resultados, time.time() - inicio)
+        imprimir_informe(datos)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f: json.dump(datos, f, indent=2, ensure_ascii=False)
+    finally:
+        if servidor is not None:
+            servidor.detener()
+            main.detener_pool_fotos()
+            main.detener_escritores()
+            main.detener_logs()
+        if carpeta: shutil.rmtree(carpeta, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main_prueba())
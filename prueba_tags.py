@@ -0,0 +1,81 @@
+"""
+Comprobación del índice de tags de MantPro (tareas_tags).
+
+Sobre una base de datos temporal guarda tareas con tags de varias palabras, en plural,
+con y sin acentos, y comprueba que las barras del panel (estadisticas_tareas) y los
+filtros de la búsqueda (buscar_tareas_avanzado) las cuentan y las encuentran igual que
+antes de tener el índice, cuando se buscaba el texto dentro de los tags:
+  - "Cuadro Eléctrico" cuenta como eléctrico y "Averías" como urgente,
+  - "electrico" encuentra "Eléctrico" y "averia" encuentra "Averías",
+  - un tag de varias palabras también se puede filtrar entero,
+  - editar los tags de una tarea cambia lo que se cuenta.
+
+    python prueba_tags.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+# Descripción -> tags
+TAREAS = {
+    "cuadro": "Cuadro Eléctrico",
+    "averias": "Averías, Mecánico",
+    "urgente": "URGENTE",
+    "preventivo": "Preventivo, Aviso Recurrente",
+    "sin acentos": "cuadro electrico, averia",
+    "otra": "General",
+}
+
+# Barras del panel esperadas (nº de tareas por categoría)
+BARRAS = {"electrico": 2, "mecanico": 1, "preventivo": 1, "urgente": 3}
+
+# Filtros de la búsqueda -> tareas que deben salir
+FILTROS = {
+    ("electrico",): {"cuadro", "sin acentos"},
+    ("Eléctrico",): {"cuadro", "sin acentos"},
+    ("averia",): {"averias", "sin acentos"},
+    ("urgente",): {"urgente"},
+    ("cuadro electrico",): {"cuadro", "sin acentos"},
+    ("aviso recurrente",): {"preventivo"},
+    ("averia", "mecanico"): {"averias"},
+    ("electrico", "averia"): {"sin acentos"},
+    ("general",): {"otra"},
+    ("inexistente",): set(),
+}
+
+def comprobar(main, db):
+    fallos = []
+    for descripcion, tags in TAREAS.items(): db.agregar_tarea("2026-01-15", descripcion, tags)
+
+    _, _, barras = db.estadisticas_tareas("2026-01")
+    if barras != BARRAS: fallos.append(f"barras: {barras} en lugar de {BARRAS}")
+
+    for tags, esperadas in FILTROS.items():
+        encontradas = {r[2] for r in db.buscar_tareas_avanzado("", tags=tags)}
+        if encontradas != esperadas: fallos.append(f"filtro {tags}: {sorted(encontradas)} en lugar de {sorted(esperadas)}")
+
+    # Al editar, las claves de la tarea se rehacen
+    with db.lectura() as conn: tarea_id = conn.execute("SELECT id FROM tareas WHERE descripcion='otra'").fetchone()[0]
+    db.actualizar_tarea(tarea_id, "2026-01-15", "otra", "Averías Eléctricas")
+    _, _, barras = db.estadisticas_tareas("2026-01")
+    if barras["urgente"] != BARRAS["urgente"] + 1: fallos.append(f"tras editar: urgente={barras['urgente']}")
+    if {r[2] for r in db.buscar_tareas_avanzado("", tags=("general",))}: fallos.append("tras editar: 'general' sigue encontrando la tarea")
+    return fallos
+
+def main_prueba():
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    import main
+    carpeta = tempfile.mkdtemp(prefix="mantpro_tags_")
+    try:
+        main.DATA_DIR = carpeta
+        fallos = comprobar(main, main.GestorBaseDatos())
+    finally:
+        main.detener_escritores()
+        shutil.rmtree(carpeta, ignore_errors=True)
+    print(f"Tags: {len(TAREAS)} tareas, {len(FILTROS)} filtros, {len(fallos)} fallos")
+    for fallo in fallos: print(f"  {fallo}")
+    return 1 if fallos else 0
+
+if __name__ == "__main__":
+    sys.exit(main_prueba())